@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 import languagebot.secrets
 
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'server.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -114,6 +116,30 @@ USE_I18N = True
 USE_TZ = True
 
 
+# Logging
+# https://docs.djangoproject.com/en/5.1/topics/logging/
+
+# The tests fail LLM calls and lock the database on purpose, so they only log when LOG_LEVEL is set
+TESTING = sys.argv[1:2] == ['test']
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # Set LOG_LEVEL=DEBUG to see every sentence picked and word score updated
+        'server': {
+            'handlers': ['console'],
+            'level': os.environ.get('LOG_LEVEL', 'CRITICAL' if TESTING else 'INFO'),
+        },
+    },
+}
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
@@ -124,3 +150,33 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Buffer word score updates in memory and write them to the database in batches. The buffer belongs to one
+# process and writes the scores it has worked out, so with more than one worker process against the same
+# database the last one to flush would win. Only turn it on for a single worker process.
+WORD_SCORE_WRITE_BEHIND = False
+
+# Stream sentences from the LLM and store each one as soon as it's complete, so a new topic can be served
+# before the whole batch has been generated
+LLM_STREAMING = True
+
+# Parsed LLM completions are kept on disk so the same prompt isn't paid for twice. Set LLM_CACHE_MODE to
+# "replay" to only answer from the cache, e.g. for offline runs, or "off" to always call the LLM.
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", os.path.join(BASE_DIR, "llm_cache"))
+LLM_CACHE_MODE = os.environ.get("LLM_CACHE_MODE", "readwrite")
+LLM_CACHE_TTL = 30 * 24 * 60 * 60
+LLM_CACHE_MAX_ENTRIES = 10000
+
+# How often, in seconds, each worker process looks for sentences other processes have stored since it cached
+# the topics they belong to
+SENTENCE_CACHE_CHECK_INTERVAL = 5
+
+# Keep recently active learners' word scores in memory so reading them never touches the database. Like
+# the write behind buffer this belongs to one process and doesn't see other processes' updates, so only turn
+# it on for a single worker process.
+WORD_SCORE_STORE = False
+
+# A read only copy of the sentences table written by the export_snapshot command. Every worker process maps
+# the same file, and sentences generated since the export are read from the database as before. Restart the
+# workers after exporting to pick up a new snapshot.
+SENTENCE_SNAPSHOT = os.environ.get("SENTENCE_SNAPSHOT", os.path.join(BASE_DIR, "sentences.snapshot"))
@@ -0,0 +1,125 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    # A thread-safe least recently used cache, bounded both by number of entries and by an estimate of the
+    # memory its values take up
+
+    def __init__(self, max_entries, max_bytes, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped on every invalidation so a value read from the database before an invalidation isn't cached
+        # after it
+        self.version = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, version=None):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._remove(key)
+            self._entries[key] = (value, size)
+            self.bytes += size
+            self._evict()
+
+    def resize(self, key):
+        # Measure a value again after it has been changed in place, evicting entries if it has outgrown the cache
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            size = self.sizeof(entry[0])
+            self._entries[key] = (entry[0], size)
+            self.bytes += size - entry[1]
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self.version += 1
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self.bytes -= entry[1]
+        return entry[0]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class PeriodicCheck:
+    # Runs check(state) at most once every interval seconds, in whichever thread calls first, keeping what it
+    # returns as the state for the next run
+
+    def __init__(self, interval, check, state=None):
+        self.interval = interval
+        self.check = check
+        self.state = state
+        self.next_check = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        if time.monotonic() < self.next_check or not self._lock.acquire(blocking=False):
+            return
+        try:
+            now = time.monotonic()
+            if now >= self.next_check:
+                self.state = self.check(self.state)
+                self.next_check = now + self.interval
+        finally:
+            self._lock.release()
+
+    def reset(self, state=None):
+        with self._lock:
+            self.state = state
+            self.next_check = 0.0
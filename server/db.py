@@ -0,0 +1,79 @@
+import atexit
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+
+from server import instrumentation
+
+# Number of prepared statements sqlite3 keeps compiled on each connection
+STATEMENT_CACHE_SIZE = 256
+
+
+class PooledConnection(sqlite3.Connection):
+    # A subclass so that the pool can hold weak references to its connections
+    pass
+
+
+def connect(db_path) -> sqlite3.Connection:
+    # check_same_thread is off so the pool can close connections at shutdown. Each connection is
+    # otherwise only ever used by the thread that opened it.
+    connection = sqlite3.connect(db_path, factory=PooledConnection, check_same_thread=False,
+                                 cached_statements=STATEMENT_CACHE_SIZE)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    return connection
+
+
+@contextmanager
+def transaction(connection, mode="DEFERRED"):
+    # Run the block in one explicit transaction which is rolled back if anything goes wrong
+    connection.execute(f"BEGIN {mode}")
+    try:
+        yield connection
+    except BaseException:
+        connection.rollback()
+        raise
+    else:
+        connection.commit()
+
+
+class ConnectionPool:
+    # Keeps one long-lived connection per thread and database file. The connections are closed when
+    # their thread goes away, or all at once with close_all().
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakSet()
+        self._generation = 0
+
+    def connection(self, db_path) -> sqlite3.Connection:
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            local.connections = {}
+            local.generation = self._generation
+
+        connection = local.connections.get(db_path)
+        if connection is None:
+            connection = connect(db_path)
+            # Count every statement run on the connection towards the current request and the totals
+            connection.set_trace_callback(instrumentation.count_query)
+            instrumentation.count_connection()
+            local.connections[db_path] = connection
+            with self._lock:
+                self._connections.add(connection)
+        return connection
+
+    def close_all(self):
+        with self._lock:
+            # Threads notice the new generation and reconnect the next time they need a connection
+            self._generation += 1
+            connections = list(self._connections)
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+pool = ConnectionPool()
+atexit.register(pool.close_all)
@@ -0,0 +1,152 @@
+import random
+import re
+import unicodedata
+import zlib
+from typing import NamedTuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Same words as languagebot.split_words
+WORD_PATTERN = re.compile(r"[\w']+")
+# Sentences sharing at least this fraction of their words and pairs of adjacent words are taken to be the same
+# prompt. Sentences that differ in a word are usually different exercises, so only long ones that add or drop a
+# single word, like "please", can be this close. The pairs keep "Is he here?" apart from "He is here".
+SIMILARITY_THRESHOLD = 0.85
+# MinHash signatures are split into bands and sentences whose signatures agree on a whole band are compared.
+# With 12 bands of 8 a pair at the threshold is compared with probability 0.98, and one sharing half its
+# shingles with probability 0.05, so sentences that only share a template aren't all compared.
+BANDS = 12
+ROWS_PER_BAND = 8
+PRIME = (1 << 31) - 1
+_rng = random.Random(0)
+PERMUTATIONS = [(_rng.randrange(1, PRIME), _rng.randrange(PRIME)) for _ in range(BANDS * ROWS_PER_BAND)]
+
+
+class Fingerprint(NamedTuple):
+    normalized: str
+    shingles: set[str]
+    # (band, bucket) pairs
+    buckets: list[tuple[int, int]]
+
+
+def normalize(text) -> str:
+    # Case, punctuation and spacing don't make two sentences different
+    text = unicodedata.normalize("NFKC", text).replace("’", "'").casefold()
+    return " ".join(WORD_PATTERN.findall(text))
+
+
+def shingles(normalized) -> set[str]:
+    words = normalized.split()
+    return {*words, *(f"{first} {second}" for first, second in zip(words, words[1:]))} or {""}
+
+
+def similarity(shingles1, shingles2) -> float:
+    return len(shingles1 & shingles2) / len(shingles1 | shingles2)
+
+
+# Each band of a signature is hashed to one bucket as a polynomial in these, modulo 2^64
+BAND_MULTIPLIERS = [pow(1000003, ROWS_PER_BAND - 1 - row, 1 << 64) for row in range(ROWS_PER_BAND)]
+
+
+def band_buckets_python(hashes) -> list[int]:
+    # The MinHash signature of the shingle hashes, one bucket per band
+    signature = [min((a * h + b) % PRIME for h in hashes) for a, b in PERMUTATIONS]
+    return [(sum(value * multiplier for value, multiplier in
+                 zip(signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND], BAND_MULTIPLIERS)) % (1 << 64)) >> 1
+            for band in range(BANDS)]
+
+
+def band_buckets_numpy(hashes) -> list[int]:
+    # Same as band_buckets_python. a and h are below 2^31 so a * h + b fits in 64 bits, and the band hashes
+    # wrap around at 2^64 like the Python version's modulo.
+    a, b = PERMUTATION_ARRAYS
+    signature = ((a * np.array(hashes, dtype=np.uint64) + b) % PRIME).min(axis=1)
+    buckets = (signature.reshape(BANDS, ROWS_PER_BAND) * BAND_MULTIPLIER_ARRAY).sum(axis=1, dtype=np.uint64)
+    return (buckets >> np.uint64(1)).tolist()
+
+
+if np is not None:
+    PERMUTATION_ARRAYS = tuple(column[:, None] for column in np.array(PERMUTATIONS, dtype=np.uint64).T)
+    BAND_MULTIPLIER_ARRAY = np.array(BAND_MULTIPLIERS, dtype=np.uint64)
+band_buckets = band_buckets_numpy if np is not None else band_buckets_python
+
+
+def many_band_buckets_numpy(hashes_list) -> list[list[int]]:
+    # band_buckets_numpy for many sentences at once, as the per call overhead dominates for short sentences.
+    # Each sentence's hashes are padded with its first, which doesn't change their minimums.
+    a, b = PERMUTATION_ARRAYS
+    buckets = []
+    for i in range(0, len(hashes_list), FINGERPRINT_BATCH_SIZE):
+        batch = hashes_list[i:i + FINGERPRINT_BATCH_SIZE]
+        width = max(len(hashes) for hashes in batch)
+        padded = np.array([hashes + [hashes[0]] * (width - len(hashes)) for hashes in batch], dtype=np.uint64)
+        signatures = ((a * padded[:, None, :] + b) % PRIME).min(axis=2)
+        batch_buckets = (signatures.reshape(len(batch), BANDS, ROWS_PER_BAND)
+                         * BAND_MULTIPLIER_ARRAY).sum(axis=2, dtype=np.uint64)
+        buckets.extend((batch_buckets >> np.uint64(1)).tolist())
+    return buckets
+
+
+# Sentences whose signatures are worked out together, which keeps the arrays to a few megabytes
+FINGERPRINT_BATCH_SIZE = 512
+
+
+def shingle_hashes(english_shingles) -> list[int]:
+    # Python's own string hashes change from process to process and buckets are stored
+    return [zlib.crc32(shingle.encode()) % PRIME for shingle in english_shingles]
+
+
+def fingerprint(english) -> Fingerprint:
+    normalized = normalize(english)
+    english_shingles = shingles(normalized)
+    # Halving the bucket hashes keeps them within SQLite's signed 64 bit integers
+    buckets = band_buckets(shingle_hashes(english_shingles))
+    return Fingerprint(normalized, english_shingles, list(enumerate(buckets)))
+
+
+def fingerprints(texts) -> dict[str, Fingerprint]:
+    # fingerprint for each of the texts, with the signatures worked out in batches when numpy is available
+    texts = list(dict.fromkeys(texts))
+    if np is None:
+        return {english: fingerprint(english) for english in texts}
+    normalized = [normalize(english) for english in texts]
+    all_shingles = [shingles(english) for english in normalized]
+    all_buckets = many_band_buckets_numpy([shingle_hashes(english_shingles) for english_shingles in all_shingles])
+    return {english: Fingerprint(english_normalized, english_shingles, list(enumerate(buckets)))
+            for english, english_normalized, english_shingles, buckets in
+            zip(texts, normalized, all_shingles, all_buckets)}
+
+
+class SentenceIndex:
+    # The normalized English and MinHash buckets of one language's sentences, to find the sentence that a new
+    # one duplicates. Keys are whatever the caller identifies sentences by.
+
+    def __init__(self):
+        self.shingles = {}
+        self.keys = {}
+        self.buckets = {}
+
+    def add(self, key, normalized, buckets=(), key_shingles=None):
+        if key not in self.shingles:
+            self.shingles[key] = key_shingles or shingles(normalized)
+        self.keys.setdefault(normalized, key)
+        for bucket in buckets:
+            self.buckets.setdefault(bucket, []).append(key)
+
+    def exact(self, normalized):
+        # The sentence with the same normalized English, which may be the same sentence
+        return self.keys.get(normalized)
+
+    def similar(self, fingerprint: Fingerprint):
+        # The first sentence found that's similar enough to count as the same prompt
+        seen = set()
+        for bucket in fingerprint.buckets:
+            for key in self.buckets.get(bucket, ()):
+                if key not in seen:
+                    seen.add(key)
+                    if similarity(fingerprint.shingles, self.shingles[key]) >= SIMILARITY_THRESHOLD:
+                        return key
+        return None
@@ -0,0 +1,93 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class RequestTimings:
+    # What one request spent its time on. Phases can nest, e.g. db inside selection.
+
+    def __init__(self):
+        self.phases = {}
+        self.queries = 0
+        self.connections = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+class Metrics:
+    # Totals across all requests and background work since the server started
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.queries = 0
+        self.connections = 0
+        self.requests = 0
+        self.request_seconds = 0.0
+
+    def add(self, phase, seconds):
+        with self._lock:
+            total, count = self.phases.get(phase, (0.0, 0))
+            self.phases[phase] = (total + seconds, count + 1)
+
+    def count_query(self):
+        # Called from SQLite's trace callback, where a lock would be too slow for an approximate count
+        self.queries += 1
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def add_request(self, seconds):
+        with self._lock:
+            self.requests += 1
+            self.request_seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "request_seconds": self.request_seconds,
+                "queries": self.queries,
+                "queries_per_request": self.queries / self.requests if self.requests else 0.0,
+                "connections": self.connections,
+                "phases": {phase: {"seconds": total, "count": count, "mean_ms": total / count * 1000}
+                           for phase, (total, count) in self.phases.items()},
+            }
+
+
+metrics = Metrics()
+current_timings: ContextVar[RequestTimings | None] = ContextVar("current_timings", default=None)
+
+
+def record(phase, seconds):
+    metrics.add(phase, seconds)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+@contextmanager
+def timed(phase):
+    # Records the time spent in the block, or decorated function, for the current request and the totals
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+
+def count_query(statement):
+    metrics.count_query()
+    timings = current_timings.get()
+    if timings is not None:
+        timings.queries += 1
+
+
+def count_connection():
+    metrics.count_connection()
+    timings = current_timings.get()
+    if timings is not None:
+        timings.connections += 1
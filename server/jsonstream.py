@@ -0,0 +1,56 @@
+import json
+import re
+
+# The characters that can change what the parser is looking at
+STRUCTURE = re.compile(r'[{}\[\]"\\]')
+
+
+class ObjectStreamParser:
+    # Picks complete JSON objects out of a JSON document as it streams in, e.g. each sentence of
+    # {"sentences": [{...}, {...}]} as soon as its closing brace arrives rather than once the whole document
+    # has. Objects are found by how many objects and arrays they're nested in.
+
+    def __init__(self, depth=2):
+        self.depth = depth
+        self._level = 0
+        self._in_string = False
+        self._escaped = False
+        # The text of the object being read so far, if we're in one
+        self._parts = None
+
+    def feed(self, text) -> list:
+        objects = []
+        start = 0
+        # Skip the character after a backslash, which may be the first one of this chunk
+        skip = 1 if self._escaped else 0
+        self._escaped = False
+
+        for match in STRUCTURE.finditer(text):
+            i = match.start()
+            if i < skip:
+                continue
+            char = match.group()
+
+            if self._in_string:
+                if char == "\\":
+                    skip = i + 2
+                    self._escaped = skip > len(text)
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if char == "{" and self._level == self.depth and self._parts is None:
+                    self._parts = []
+                    start = i
+                self._level += 1
+            elif char in "}]":
+                self._level -= 1
+                if self._parts is not None and self._level == self.depth:
+                    self._parts.append(text[start:i + 1])
+                    objects.append(json.loads("".join(self._parts)))
+                    self._parts = None
+
+        if self._parts is not None:
+            self._parts.append(text[start:])
+        return objects
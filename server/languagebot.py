@@ -1,24 +1,72 @@
+import atexit
 import datetime
+import logging
 import math
 import re
+import sys
+import time
 
-from pydantic import BaseModel
-from openai import OpenAI
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from pydantic import BaseModel, PrivateAttr, ValidationError
+from openai import OpenAI, AsyncOpenAI
 from server.secrets import OPENAIAPI_KEY
+from server.cache import LRUCache, PeriodicCheck
+from server.db import pool, transaction
+from server.dedup import SentenceIndex, fingerprints, normalize
+from server.instrumentation import record, timed
+from server.jsonstream import ObjectStreamParser
+from server.llmcache import CompletionCache
+from server.scoring import decay_word_scores, calculate_words_score, score_sentences
+from server.singleflight import SingleFlight
+from server.snapshot import open_snapshot
+from server.wordstore import WordScoreStore
+from server.writebehind import WordScoreBuffer
 import sqlite3
-from datetime import datetime, timedelta
+from typing import NamedTuple
 
 from difflib import SequenceMatcher
 
 
 DB_PATH = "db.sqlite3"
+# Older SQLite builds only allow 999 variables per statement and we need one for the language
+MAX_QUERY_WORDS = 900
+WORD_PATTERN = re.compile(r"[\w']+")
+# Rough size of a Sentence object and its containers on top of its strings
+SENTENCE_OVERHEAD = 400
+logger = logging.getLogger(__name__)
+MODEL = "gpt-4o-mini"
 client = OpenAI(api_key=OPENAIAPI_KEY)
+async_client = AsyncOpenAI(api_key=OPENAIAPI_KEY)
+topic_loads = SingleFlight()
+# Sentences exported by the export_snapshot command. Anything stored since then is read from the database.
+sentence_snapshot = open_snapshot(getattr(settings, "SENTENCE_SNAPSHOT", None))
 
 
 class Sentence(BaseModel):
     english: str
     translations: list[str]
     topic: str
+    # The words of each translation, either loaded from the database or split on first use. Private
+    # attributes are left out of the schema the LLM fills in.
+    _words: list[list[str]] | None = PrivateAttr(default=None)
+    _folded_words: list[list[str]] | None = PrivateAttr(default=None)
+
+    def translation_words(self) -> list[list[str]]:
+        if self._words is None:
+            self._words = [split_words(translation) for translation in self.translations]
+        return self._words
+
+    def translation_folded_words(self) -> list[list[str]]:
+        if self._folded_words is None:
+            self._folded_words = [[word.casefold() for word in words] for words in self.translation_words()]
+        return self._folded_words
+
+    def words_of(self, translation) -> list[str]:
+        return self.translation_words()[self.translations.index(translation)]
+
+    def folded_words_of(self, translation) -> list[str]:
+        return self.translation_folded_words()[self.translations.index(translation)]
 
 
 class Sentences(BaseModel):
@@ -29,23 +77,71 @@ class Topics(BaseModel):
     topics: list[str]
 
 
+class StoreResult(NamedTuple):
+    inserted: int
+    duplicates: int
+    # The (id, english) of the stored sentence each (language, english) ended up as, once deduplicated
+    sentences: dict[tuple[str, str], tuple[int, str]] = {}
+
+
+def sentence_size(sentence: Sentence):
+    return (SENTENCE_OVERHEAD + sys.getsizeof(sentence.english) + sys.getsizeof(sentence.topic)
+            + sum(sys.getsizeof(translation) for translation in sentence.translations))
+
+
+def sentences_size(sentences: list[Sentence]):
+    return sys.getsizeof(sentences) + sum(sentence_size(sentence) for sentence in sentences)
+
+
+# Sentences rarely change once generated so keep the recently used ones in memory. Both caches are
+# invalidated whenever sentences are stored, and checked for sentences other processes have stored every
+# SENTENCE_CACHE_CHECK_INTERVAL seconds.
+topic_cache = LRUCache(max_entries=1000, max_bytes=64 * 1024 * 1024, sizeof=sentences_size)
+sentence_cache = LRUCache(max_entries=20000, max_bytes=32 * 1024 * 1024, sizeof=sentence_size)
+llm_cache = CompletionCache(settings.LLM_CACHE_DIR, mode=settings.LLM_CACHE_MODE, ttl=settings.LLM_CACHE_TTL,
+                            max_entries=settings.LLM_CACHE_MAX_ENTRIES)
+
+
 # models = client.models.list()
 #
 # print("models", models)
 
+def parse_completion(messages, response_format):
+    # Reuse the completion we got last time for exactly the same request if there is one
+    def create():
+        with timed("llm"):
+            completion = client.beta.chat.completions.parse(model=MODEL, messages=messages,
+                                                            response_format=response_format)
+        return completion.choices[0].message.parsed
+
+    return llm_cache.get_or_create(MODEL, messages, response_format, create)
+
+
+async def parse_completion_async(messages, response_format, fresh=False):
+    async def create():
+        with timed("llm"):
+            completion = await async_client.beta.chat.completions.parse(model=MODEL, messages=messages,
+                                                                        response_format=response_format)
+        return completion.choices[0].message.parsed
+
+    return await llm_cache.get_or_create_async(MODEL, messages, response_format, create, fresh)
+
+
+def get_topic_messages():
+    return [
+        {"role": "system", "content": "You are a language tutor"},
+        {"role": "user", "content": "Please give a list of ten topics or categories on which to practice language "
+                                    "learning. For example: [food, technology, the past tense]. Give only a single"
+                                    "topic per item."},
+    ]
+
+
 def get_topics_from_llm():
-    topics_completion = client.beta.chat.completions.parse(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a language tutor"},
-            {"role": "user", "content": "Please give a list of ten topics or categories on which to practice language "
-                                        "learning. For example: [food, technology, the past tense]. Give only a single"
-                                        "topic per item."},
-        ],
-        response_format=Topics,
-    )
+    return parse_completion(get_topic_messages(), Topics)
 
-    return topics_completion.choices[0].message.parsed
+
+async def get_topics_from_llm_async():
+    return await parse_completion_async(get_topic_messages(), Topics)
 
 
 def get_prompt(language, topic):
@@ -111,28 +207,127 @@ def get_prompt(language, topic):
     return prompt + examples
 
 
-def get_sentences_from_llm(language, topic) -> list[Sentence]:
-    sentences_completion = client.beta.chat.completions.parse(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a language tutor"},
-            {"role": "user", "content": get_prompt(language, topic)}
-        ],
-        response_format=Sentences,
-    )
-    return sentences_completion.choices[0].message.parsed.sentences
+def get_sentence_messages(language, topic):
+    return [
+        {"role": "system", "content": "You are a language tutor"},
+        {"role": "user", "content": get_prompt(language, topic)}
+    ]
 
 
-def get_sentences_from_db(language, topic) -> list[Sentence]:
-    connection = None
+def get_sentences_from_llm(language, topic) -> list[Sentence]:
+    return parse_completion(get_sentence_messages(language, topic), Sentences).sentences
+
+
+async def get_sentences_from_llm_async(language, topic, fresh=False) -> list[Sentence]:
+    return (await parse_completion_async(get_sentence_messages(language, topic), Sentences, fresh)).sentences
+
+
+async def stream_sentences_from_llm(language, topic, fresh=False):
+    # Yields each sentence as soon as the LLM has finished writing it
+    messages = get_sentence_messages(language, topic)
+    cached = llm_cache.get(MODEL, messages, Sentences, fresh)
+    if cached is not None:
+        for sentence in cached.sentences:
+            yield sentence
+        return
+
+    sentences = []
+    parser = ObjectStreamParser(depth=2)
+    # Only count the time spent waiting on the LLM, not what the caller does with each sentence
+    waited = 0.0
+    start = time.perf_counter()
+    async with async_client.beta.chat.completions.stream(
+        model=MODEL,
+        messages=messages,
+        response_format=Sentences,
+    ) as stream:
+        async for event in stream:
+            if event.type != "content.delta":
+                continue
+            for item in parser.feed(event.delta):
+                try:
+                    sentence = Sentence.model_validate(item)
+                except ValidationError as e:
+                    logger.warning("Skipping unusable sentence from LLM: %s", e)
+                    continue
+                sentences.append(sentence)
+                waited += time.perf_counter() - start
+                yield sentence
+                start = time.perf_counter()
+    record("llm", waited + time.perf_counter() - start)
+
+    llm_cache.put(MODEL, messages, Sentences, Sentences(sentences=sentences))
+
+
+async def load_sentences_from_llm(language, topic, on_sentence=None, fresh=False, streaming=None) -> list[Sentence]:
+    # Concurrent requests for the same new topic share a single completion and a single insert. When
+    # streaming, each sentence is stored as soon as it arrives and on_sentence is called with the sentences
+    # so far, though only for the request that started the completion. Topics that already have sentences
+    # are topped up with fresh set, as the cached completion for the prompt is the one they came from. streaming
+    # defaults to the LLM_STREAMING setting. Without it all of the sentences are stored together or not at all.
+    # The sentences returned are those that were stored, which may be ones already in the topic that the
+    # LLM's were merged with.
+    def store(generated, stored):
+        result = store_sentences_in_db(language, generated)
+        for sentence in generated:
+            _, english = result.sentences.get((language, sentence.english), (None, None))
+            if english is not None:
+                stored[english] = get_sentence(language, english)
+
+    async def load():
+        # File the sentences under the topic that was asked for, whatever the LLM called it
+        stored = {}
+        if not (getattr(settings, "LLM_STREAMING", False) if streaming is None else streaming):
+            sentences = [sentence.model_copy(update={"topic": topic})
+                         for sentence in await get_sentences_from_llm_async(language, topic, fresh)]
+            await sync_to_async(store)(sentences, stored)
+            return [sentence for sentence in stored.values() if sentence is not None]
+
+        async for sentence in stream_sentences_from_llm(language, topic, fresh):
+            count = len(stored)
+            await sync_to_async(store)([sentence.model_copy(update={"topic": topic})], stored)
+            if on_sentence is not None and len(stored) > count:
+                on_sentence([sentence for sentence in stored.values() if sentence is not None])
+        return [sentence for sentence in stored.values() if sentence is not None]
+
+    return await topic_loads.do((language, topic), load)
+
+
+def get_connection() -> sqlite3.Connection:
+    return pool.connection(DB_PATH)
+
+
+def sentence_from_rows(english, topic, rows) -> Sentence:
+    # rows are (translation, tokens) pairs. Translations stored before tokens were added have none.
+    sentence = Sentence(english=english, translations=[translation for translation, _ in rows], topic=topic)
+    if all(tokens is not None for _, tokens in rows):
+        sentence._words = [tokens.split() for _, tokens in rows]
+    return sentence
+
+
+@timed("db")
+def count_topic_sentences(language, topic) -> int:
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT COUNT(*) FROM sentences WHERE language = ? AND topic = ?", (language, topic))
+    return cursor.fetchone()[0]
+
+
+@timed("db")
+def get_sentences_from_db(language, topic, after_revision=-1) -> list[Sentence]:
+    # Only the translations stored after after_revision, i.e. since a snapshot was exported, if it's given.
+    # Translations stored before revisions were added are all in revision 0.
     try:
-        # Connect to the SQLite database
-        connection = sqlite3.connect(DB_PATH)
-        cursor = connection.cursor()
+        cursor = get_connection().cursor()
 
         # Execute the provided query
-        cursor.execute("SELECT english, translation FROM sentences WHERE language = ? AND topic = ? ORDER BY english",
-                       (language, topic))
+        # Since a snapshot there are usually only a few newer translations, which are found from their revisions
+        # rather than by going through all of the topic's
+        cursor.execute("SELECT english, translation, tokens FROM "
+                       + ("sentences JOIN translations" if after_revision < 0 else
+                          "translations INDEXED BY translations_revision JOIN sentences") +
+                       " ON translations.sentence_id = sentences.id "
+                       "WHERE language = ? AND topic = ? AND revision > ? ORDER BY english, translation",
+                       (language, topic, after_revision))
 
         # Fetch all results from the executed query
         results = cursor.fetchall()
@@ -143,34 +338,31 @@ def get_sentences_from_db(language, topic) -> list[Sentence]:
         for result in results:
             if result[0] != last_english:
                 if last_english is not None:
-                    sentences.append(Sentence(english=last_english, translations=translations, topic=topic))
+                    sentences.append(sentence_from_rows(last_english, topic, translations))
                 translations = []
-            translations.append(result[1])
+            translations.append(result[1:])
             last_english = result[0]
 
         if last_english is not None:
-            sentences.append(Sentence(english=last_english, translations=translations, topic=topic))
+            sentences.append(sentence_from_rows(last_english, topic, translations))
 
         return sentences
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
         return []
-    finally:
-        # Ensure the connection is closed properly
-        if connection:
-            connection.close()
 
 
-def get_sentence_from_db(language, english) -> Sentence | None:
-    connection = None
+@timed("db")
+def get_sentence_from_db(language, english, after_revision=-1) -> Sentence | None:
+    # Like get_sentences_from_db, only the translations stored after after_revision if it's given
     try:
-        # Connect to the SQLite database
-        connection = sqlite3.connect(DB_PATH)
-        cursor = connection.cursor()
+        cursor = get_connection().cursor()
 
         # Execute the provided query
-        cursor.execute("SELECT translation, topic FROM sentences WHERE language = ? AND english = ?",
-                       (language, english))
+        cursor.execute("SELECT translation, tokens, topic FROM sentences "
+                       "JOIN translations ON translations.sentence_id = sentences.id "
+                       "WHERE language = ? AND english = ? AND revision > ? ORDER BY translation",
+                       (language, english, after_revision))
 
         # Fetch all results from the executed query
         results = cursor.fetchall()
@@ -178,131 +370,406 @@ def get_sentence_from_db(language, english) -> Sentence | None:
         if len(results) == 0:
             return None
 
-        translations = [result[0] for result in results]
-        topic = results[0][1]
+        topic = results[0][2]
 
-        return Sentence(english=english, translations=translations, topic=topic)
+        return sentence_from_rows(english, topic, [result[:2] for result in results])
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
         return None
-    finally:
-        # Ensure the connection is closed properly
-        if connection:
-            connection.close()
 
 
-def store_sentences_in_db(language, sentences: list[Sentence]):
-    try:
-        # Connect to the SQLite database
-        connection = sqlite3.connect(DB_PATH)
-        cursor = connection.cursor()
-
-        for sentence in sentences:
-            for translation in sentence.translations:
-                cursor.execute(f"INSERT OR IGNORE INTO sentences (language, english, translation, topic) "
-                               f"VALUES (?, ?, ?, ?)", (language, sentence.english, translation, sentence.topic))
+def translation_rows(sentence: Sentence):
+    # The (translation, tokens) rows of a sentence loaded from the database
+    if sentence._words is None:
+        return [(translation, None) for translation in sentence.translations]
+    return [(translation, " ".join(words)) for translation, words in zip(sentence.translations, sentence._words)]
+
+
+def merge_sentence_rows(rows, delta: Sentence):
+    # The snapshot's (translation, tokens) rows of a sentence plus the translations stored since, in
+    # translation order like the database returns them
+    return sorted(dict(rows + translation_rows(delta)).items())
+
+
+def load_topic_sentences(language, topic) -> list[Sentence]:
+    # The topic's sentences from the snapshot plus the translations stored since it was exported, whether they
+    # belong to new sentences or were added to ones the snapshot has
+    if sentence_snapshot is None:
+        return get_sentences_from_db(language, topic)
+    rows = dict(sentence_snapshot.topic_sentences(language, topic))
+    delta = get_sentences_from_db(language, topic, after_revision=sentence_snapshot.revision)
+    if not delta:
+        return [sentence_from_rows(english, topic, english_rows) for english, english_rows in rows.items()]
+    for sentence in delta:
+        rows[sentence.english] = merge_sentence_rows(rows.get(sentence.english, []), sentence)
+    return [sentence_from_rows(english, topic, rows[english]) for english in sorted(rows)]
+
+
+def load_sentence(language, english) -> Sentence | None:
+    if sentence_snapshot is None:
+        return get_sentence_from_db(language, english)
+    found = sentence_snapshot.sentence(language, english)
+    delta = get_sentence_from_db(language, english, after_revision=sentence_snapshot.revision)
+    if found is None:
+        return delta
+    topic, rows = found
+    if delta is not None:
+        rows = merge_sentence_rows(rows, delta)
+    return sentence_from_rows(english, topic, rows)
+
+
+def drop_sentences_stored_elsewhere(revision):
+    # Drops the cached topics and sentences that got translations after the given revision, which other
+    # processes, such as the pregeneration refills, may have stored. Returns the latest revision.
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT COALESCE(MAX(revision), 0) FROM translations")
+    latest = cursor.fetchone()[0]
+    if revision is None or latest == revision:
+        return latest
+    if latest < revision:
+        # The database has been replaced
+        topic_cache.clear()
+        sentence_cache.clear()
+        return latest
+
+    cursor.execute("SELECT DISTINCT language, english, topic FROM translations INDEXED BY translations_revision "
+                   "JOIN sentences ON translations.sentence_id = sentences.id WHERE revision > ?", (revision, ))
+    stale_topics, stale_sentences = cached_sentence_keys(
+        cursor, [(language, english, None, topic) for language, english, topic in cursor.fetchall()])
+    for key in stale_topics:
+        topic_cache.pop(key)
+    for key in stale_sentences:
+        sentence_cache.pop(key)
+    return latest
+
+
+sentence_cache_check = PeriodicCheck(getattr(settings, "SENTENCE_CACHE_CHECK_INTERVAL", 5),
+                                     drop_sentences_stored_elsewhere)
+
+
+def get_topic_sentences(language, topic) -> list[Sentence]:
+    # Cached version of load_topic_sentences. The returned sentences are shared so must not be modified.
+    sentence_cache_check()
+    sentences = topic_cache.get((language, topic))
+    if sentences is None:
+        topic_version, sentence_version = topic_cache.version, sentence_cache.version
+        sentences = load_topic_sentences(language, topic)
+        # Don't cache empty topics as another process may be generating sentences for them
+        if sentences:
+            topic_cache.put((language, topic), sentences, topic_version)
+            for sentence in sentences:
+                sentence_cache.put((language, sentence.english), sentence, sentence_version)
+    return sentences
+
+
+def get_sentence(language, english) -> Sentence | None:
+    # Cached version of load_sentence. The returned sentence is shared so must not be modified.
+    sentence_cache_check()
+    sentence = sentence_cache.get((language, english))
+    if sentence is None:
+        version = sentence_cache.version
+        sentence = load_sentence(language, english)
+        if sentence is not None:
+            sentence_cache.put((language, english), sentence, version)
+    return sentence
+
+
+def cached_sentence_keys(cursor, rows):
+    # The cache entries that storing the rows makes stale
+    topics = {(language, topic) for language, _, _, topic in rows}
+    sentences = {(language, english) for language, english, _, _ in rows}
+
+    # New translations for a sentence that was already stored under another topic change that topic too
+    if len(topic_cache):
+        for language in {language for language, _ in sentences}:
+            english = [english for sentence_language, english in sentences if sentence_language == language]
+            for i in range(0, len(english), MAX_QUERY_WORDS):
+                chunk = english[i:i + MAX_QUERY_WORDS]
+                placeholders = ', '.join(['?'] * len(chunk))
+                cursor.execute(f"SELECT DISTINCT topic FROM sentences WHERE language = ? AND "
+                               f"english IN ({placeholders})", (language, ) + tuple(chunk))
+                topics.update((language, topic) for topic, in cursor.fetchall())
+
+    return topics, sentences
+
+
+def sentence_rows(language, sentences: list[Sentence]):
+    return [(language, sentence.english, translation, sentence.topic)
+            for sentence in sentences for translation in sentence.translations]
+
+
+def select_in_chunks(cursor, sql, params, values):
+    # Runs sql, which ends in "IN ({placeholders})", for the values in chunks under SQLite's variable limit
+    values = list(values)
+    results = []
+    for i in range(0, len(values), MAX_QUERY_WORDS):
+        chunk = values[i:i + MAX_QUERY_WORDS]
+        cursor.execute(sql.format(placeholders=', '.join(['?'] * len(chunk))), tuple(params) + tuple(chunk))
+        results.extend(cursor.fetchall())
+    return results
 
-        # Commit the transaction
-        connection.commit()
-        print("Sentences commited")
 
-    except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+def deduplicate_topic_rows(cursor, language, topic, rows):
+    # rows are (english, translation) for one topic. English that only differs in case and punctuation from
+    # a sentence already in the topic, stored or earlier in rows, is replaced by that sentence's so the
+    # translations are added to it, while a sentence that's a near duplicate of one is replaced by it but
+    # its translations are dropped, as they translate different English. Sentences are only compared within
+    # a topic so whichever one a sentence ends up as is still in the topic that was asked for. Translations
+    # are only ever dropped when they match one of the sentence's others exactly once normalized, as those
+    # that differ in a word are the variants learners are marked against. Returns the rows to store, the
+    # fingerprints of the new sentences and the English each English ended up as.
+    topic_fingerprints = fingerprints(english for english, _ in rows)
+
+    index = SentenceIndex()
+    for english, normalized in select_in_chunks(
+            cursor, "SELECT english, normalized FROM sentences WHERE language = ? AND topic = ? AND "
+                    "normalized IN ({placeholders})",
+            [language, topic], {english.normalized for english in topic_fingerprints.values()}):
+        index.add(english, normalized)
+    band_buckets = {}
+    for english in topic_fingerprints.values():
+        for band, bucket in english.buckets:
+            band_buckets.setdefault(band, set()).add(bucket)
+    for band, buckets in band_buckets.items():
+        for english, normalized, bucket in select_in_chunks(
+                cursor, "SELECT english, normalized, bucket FROM sentence_fingerprints "
+                        "JOIN sentences ON sentences.id = sentence_fingerprints.sentence_id "
+                        "WHERE sentence_fingerprints.language = ? AND topic = ? AND band = ? AND "
+                        "bucket IN ({placeholders})",
+                [language, topic, band], buckets):
+            index.add(english, normalized, [(band, bucket)])
+    stored = set(index.shingles)
+
+    canonical = {}
+    near_duplicates = set()
+    new_fingerprints = {}
+    for english, english_fingerprint in topic_fingerprints.items():
+        # English without any words can't be compared
+        match = index.exact(english_fingerprint.normalized) if english_fingerprint.normalized else english
+        if match is None:
+            match = index.similar(english_fingerprint)
+            if match is not None:
+                logger.debug("Replacing %r with its near duplicate %r", english, match)
+                near_duplicates.add(english)
+            else:
+                match = english
+                index.add(english, english_fingerprint.normalized, english_fingerprint.buckets,
+                          english_fingerprint.shingles)
+                new_fingerprints[english] = english_fingerprint
+        canonical[english] = match
+
+    seen = {(english, normalize(translation)) for english, translation in select_in_chunks(
+        cursor, "SELECT english, translation FROM sentences "
+                "JOIN translations ON translations.sentence_id = sentences.id "
+                "WHERE language = ? AND english IN ({placeholders})",
+        [language], stored & set(canonical.values()))}
+    deduplicated = []
+    for english, translation in rows:
+        if english not in near_duplicates:
+            key = (canonical[english], normalize(translation))
+            if key not in seen:
+                seen.add(key)
+                deduplicated.append(key[:1] + (translation, ))
+    return deduplicated, new_fingerprints, canonical
+
+
+def deduplicate_rows(cursor, rows):
+    # deduplicate_topic_rows for (language, english, translation, topic) rows of any language and topic. An
+    # English given under several topics is filed under the first. The fingerprints are returned by language,
+    # and the English each (language, english) ended up as by both.
+    topics = {}
+    sentence_topics = {}
+    for language, english, translation, topic in rows:
+        topic = sentence_topics.setdefault((language, english), topic)
+        topics.setdefault((language, topic), []).append((english, translation))
+    deduplicated = []
+    language_fingerprints = {}
+    canonical = {}
+    for (language, topic), topic_rows in topics.items():
+        topic_rows, new_fingerprints, topic_canonical = deduplicate_topic_rows(cursor, language, topic, topic_rows)
+        deduplicated.extend((language, english, translation, topic) for english, translation in topic_rows)
+        language_fingerprints.setdefault(language, {}).update(new_fingerprints)
+        canonical.update(((language, english), stored) for english, stored in topic_canonical.items())
+    return deduplicated, language_fingerprints, canonical
+
+
+def next_translation_revision(cursor) -> int:
+    # The revision for the translations stored in the current write transaction
+    cursor.execute("SELECT COALESCE(MAX(revision), 0) + 1 FROM translations")
+    return cursor.fetchone()[0]
+
+
+@timed("db")
+def store_sentence_rows(rows, deduplicate=True) -> StoreResult:
+    # Insert (language, english, translation, topic) rows in a single transaction. Rows that are already
+    # stored, or that deduplicate_rows drops, are counted as duplicates. Trusted rows, such as those of a bulk
+    # import, can skip deduplicate_rows. Their near duplicates aren't found until compact_sentences has
+    # fingerprinted them.
+    rows = list(rows)
+    connection = get_connection()
+    with transaction(connection, "IMMEDIATE"):
+        if deduplicate:
+            stored_rows, stored_fingerprints, canonical = deduplicate_rows(connection.cursor(), rows)
+        else:
+            stored_rows, stored_fingerprints = rows, {}
+            canonical = {(language, english): english for language, english, _, _ in rows}
+        # A sentence that is already stored keeps its original topic
+        connection.executemany("INSERT OR IGNORE INTO sentences (language, english, topic, normalized) "
+                               "VALUES (?, ?, ?, ?)",
+                               [(language, english, topic, normalize(english)) for language, english, topic in
+                                dict.fromkeys((language, english, topic)
+                                              for language, english, _, topic in stored_rows)])
+        fingerprint_rows = []
+        for language, language_fingerprints in stored_fingerprints.items():
+            for sentence_id, english in select_in_chunks(
+                    connection.cursor(), "SELECT id, english FROM sentences WHERE language = ? AND "
+                                         "english IN ({placeholders})", [language], language_fingerprints):
+                fingerprint_rows.extend((language, band, bucket, sentence_id)
+                                        for band, bucket in language_fingerprints[english].buckets)
+        # In key order, as inserting into the middle of the table's B-tree all over is much slower
+        connection.executemany("INSERT OR IGNORE INTO sentence_fingerprints (language, band, bucket, sentence_id) "
+                               "VALUES (?, ?, ?, ?)", sorted(fingerprint_rows))
+        changes_before = connection.total_changes
+        # The write lock is held so no other process can take the same revision
+        revision = next_translation_revision(connection.cursor())
+        connection.executemany("INSERT OR IGNORE INTO translations (sentence_id, translation, tokens, revision) "
+                               "SELECT id, ?, ?, ? FROM sentences WHERE language = ? AND english = ?",
+                               [(translation, " ".join(split_words(translation)), revision, language, english)
+                                for language, english, translation, _ in stored_rows])
+        inserted = connection.total_changes - changes_before
+        stale_topics, stale_sentences = (cached_sentence_keys(connection.cursor(), stored_rows) if inserted
+                                         else ((), ()))
+        ids = {}
+        for language in {language for language, _ in canonical}:
+            ids.update(((language, english), sentence_id) for sentence_id, english in select_in_chunks(
+                connection.cursor(), "SELECT id, english FROM sentences WHERE language = ? AND "
+                                     "english IN ({placeholders})",
+                [language], {stored for (stored_language, _), stored in canonical.items()
+                             if stored_language == language}))
+
+    for key in stale_topics:
+        topic_cache.pop(key)
+    for key in stale_sentences:
+        sentence_cache.pop(key)
+
+    return StoreResult(inserted=inserted, duplicates=len(rows) - inserted,
+                       sentences={key: (ids[key[0], stored], stored) for key, stored in canonical.items()})
+
+
+def store_sentences_in_db(language, sentences: list[Sentence]) -> StoreResult:
+    result = store_sentence_rows(sentence_rows(language, sentences))
+    logger.debug("Sentences commited: %d inserted, %d duplicates", result.inserted, result.duplicates)
+    return result
+
+
+def select_word_scores(cursor, learner, language, words):
+    # Look the words up in chunks so we stay under SQLite's limit on query variables
+    words = list(words)
+    results = []
+    for i in range(0, len(words), MAX_QUERY_WORDS):
+        chunk = words[i:i + MAX_QUERY_WORDS]
+        placeholders = ', '.join(['?'] * len(chunk))
+        cursor.execute(f"SELECT word, score, last_seen FROM word_scores WHERE learner = ? AND language = ? AND "
+                       f"word IN ({placeholders})", (learner, language) + tuple(chunk))
+        results.extend(cursor.fetchall())
+    return word_score_buffer.overlay(learner, language, words, results)
 
 
-def get_word_scores_from_db(language, words):
-    connection = None
+@timed("db")
+def get_word_scores_from_db(learner, language, words):
     try:
-        # Connect to the SQLite database
-        connection = sqlite3.connect(DB_PATH)
-        cursor = connection.cursor()
-
-        # Execute the provided query
-        placeholders = ', '.join(['?'] * len(words))
-        cursor.execute(f"SELECT word, score, last_seen FROM word_scores WHERE language = ? AND "
-                       f"word IN ({placeholders})", (language, ) + tuple(words))
-
-        # Fetch all results from the executed query
-        return cursor.fetchall()
+        return select_word_scores(get_connection().cursor(), learner, language, words)
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
         return []
-    finally:
-        # Ensure the connection is closed properly
-        if connection:
-            connection.close()
 
 
-def get_word_scores(language, words) -> list[float]:
-    word_scores = get_word_scores_from_db(language, words)
-    format_string = "%Y-%m-%d %H:%M:%S"
-    word_scores = {word: (score, datetime.strptime(last_seen, format_string)) for word, score, last_seen in word_scores}
-    # Default the score to 10 for any words we don't yet have in the db
-    cur_time = datetime.now()
-    cur_time_utc = datetime.now()
+def read_word_scores(learner, language, words):
+    # The learner's (word, score, last_seen) rows for the words, from memory if we're keeping them there
+    if getattr(settings, "WORD_SCORE_STORE", False):
+        return word_score_store.rows(learner, language, words)
+    return get_word_scores_from_db(learner, language, words)
 
-    # print("cur_time", cur_time, cur_time.timestamp())
-    # print("cur_time_utc", cur_time_utc, cur_time_utc.timestamp())
 
-    adjusted_scores = []
-    seconds_in_day = 60 * 60 * 24
-    for word in words:
-        score, last_seen = word_scores.get(word, (10, cur_time - timedelta(days=5)))
-        time_difference = cur_time - last_seen
-        adjusted_score = (-100/score) * (time_difference.total_seconds() / seconds_in_day) + 100
-        adjusted_scores.append(adjusted_score)
-    return adjusted_scores
+def get_word_scores(learner, language, words) -> list[float]:
+    return decay_word_scores(words, read_word_scores(learner, language, words), time.time())
+
+
+def get_word_score_map(learner, language, words) -> dict[str, float]:
+    unique_words = list(dict.fromkeys(words))
+    return dict(zip(unique_words, get_word_scores(learner, language, unique_words)))
 
 
-def calculate_translation_score(language: str, translation: str):
+def calculate_translation_score(learner: str, language: str, translation: str):
     words = split_words(translation)
-    word_scores = get_word_scores(language, words)
-    return sum(word_scores) / len(word_scores)
+    return calculate_words_score(words, get_word_score_map(learner, language, words))
 
 
-def calculate_sentence_scores(language: str, sentences: list[Sentence]):
+@timed("scoring")
+def calculate_sentence_scores(learner: str, language: str, sentences: list[Sentence]):
+    # Fetch the scores for every word in every translation in one go
+    sentence_words = [sentence.translation_words() for sentence in sentences]
+    words = list(dict.fromkeys(word for translations in sentence_words for words in translations for word in words))
+    sentence_scores = score_sentences(sentence_words, read_word_scores(learner, language, words),
+                                      time.time())
+
     results = []
     # Use the user's word scores to calculate a score for the sentences
-    for sentence in sentences:
-        # The sentence score is the maximum score for all the different possible translations
-        sentence_score = max([calculate_translation_score(language, translation) for translation in sentence.translations])
+    for sentence, sentence_score in zip(sentences, sentence_scores):
         results.append((sentence, sentence_score))
-        print("Sentence", sentence.english, "score: ", sentence_score)
+        logger.debug("Sentence %s score: %s", sentence.english, sentence_score)
     return results
 
 
-def update_word_scores_in_db(language, word_scores):
-    connection = None
-    try:
-        # Connect to the SQLite database
-        connection = sqlite3.connect(DB_PATH)
-        cursor = connection.cursor()
-
-        for word_score in word_scores:
-            # Execute the provided query
-            cursor.execute("INSERT INTO word_scores (language, word, score, last_seen) VALUES "
-                           "(?, ?, ?, datetime()) "
-                           "ON CONFLICT (language, word) "
-                           "DO UPDATE SET score = excluded.score, last_seen = excluded.last_seen",
-                           (language, ) + word_score)
-
-        connection.commit()
-        print("Scores commited")
-    except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
-        return []
-    finally:
-        # Ensure the connection is closed properly
-        if connection:
-            connection.close()
+def upsert_word_score_rows(cursor, rows):
+    cursor.executemany("INSERT INTO word_scores (learner, language, word, score, last_seen) VALUES "
+                       "(?, ?, ?, ?, ?) "
+                       "ON CONFLICT (learner, language, word) "
+                       "DO UPDATE SET score = excluded.score, last_seen = excluded.last_seen", rows)
 
 
-def update_word_scores(language, translation, original_word_matches):
+def upsert_word_scores(cursor, learner, language, word_scores) -> int:
+    # Returns the last seen time the words were given
+    now = int(time.time())
+    upsert_word_score_rows(cursor, [(learner, language) + word_score + (now, ) for word_score in word_scores])
+    return now
 
-    words = split_words(translation)
 
-    current_word_scores = get_word_scores(language, words)
+@timed("db")
+def write_word_score_rows(rows):
+    connection = get_connection()
+    with transaction(connection, "IMMEDIATE"):
+        upsert_word_score_rows(connection.cursor(), rows)
+
+
+word_score_buffer = WordScoreBuffer(write_word_score_rows)
+atexit.register(word_score_buffer.stop)
+
+
+@timed("db")
+def load_learner_word_scores(learner, language):
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT word, score, last_seen FROM word_scores WHERE learner = ? AND language = ?",
+                   (learner, language))
+    return word_score_buffer.overlay_learner(learner, language, cursor.fetchall())
+
 
+word_score_store = WordScoreStore(load_learner_word_scores)
+
+
+@timed("db")
+def update_word_scores_in_db(learner, language, word_scores):
+    connection = get_connection()
+    try:
+        with transaction(connection):
+            last_seen = upsert_word_scores(connection.cursor(), learner, language, word_scores)
+        word_score_store.update(learner, language, word_scores, last_seen)
+        logger.debug("Scores commited")
+    except sqlite3.Error as e:
+        logger.error("An error occurred: %s", e)
+
+
+def score_submission(original_word_matches, current_word_scores):
     new_word_scores = []
 
     for i in range(len(original_word_matches)):
@@ -312,62 +779,146 @@ def update_word_scores(language, translation, original_word_matches):
         if correct:
             # new_score = min(100.0, cur_score + math.sqrt(100-cur_score))
             new_score = min(100.0, cur_score + 5)
-            print(f"Updating score for correct word {match[0]} from {cur_score} to {new_score}")
+            logger.debug("Updating score for correct word %s from %s to %s", match[0], cur_score, new_score)
         else:
             new_score = max(0.0, cur_score - 5)
             # new_score = max(0.0, cur_score - math.sqrt(cur_score))
-            print(f"Updating score for incorrect word {match[0]} from {cur_score} to {new_score}")
+            logger.debug("Updating score for incorrect word %s from %s to %s", match[0], cur_score, new_score)
         new_word_scores.append((match[0], new_score))
 
-    update_word_scores_in_db(language, new_word_scores)
+    return new_word_scores
+
+
+def update_word_scores(learner, language, translation, original_word_matches):
+
+    words = [match[0] for match in original_word_matches]
+
+    if getattr(settings, "WORD_SCORE_WRITE_BEHIND", False):
+        # The new scores are visible to reads straight away and get written to the database in the background
+        try:
+            with word_score_buffer.lock:
+                now = time.time()
+                current_word_scores = decay_word_scores(words, read_word_scores(learner, language, words), now)
+                new_word_scores = score_submission(original_word_matches, current_word_scores)
+                word_score_buffer.add(learner, language, new_word_scores, int(now))
+                word_score_store.update(learner, language, new_word_scores, int(now))
+        except sqlite3.Error as e:
+            logger.error("An error occurred: %s", e)
+        return
+
+    connection = get_connection()
+    try:
+        # Read and write the scores in one write transaction so concurrent submissions can't lose updates. The
+        # scores are read from the database rather than the store, which doesn't see other workers' updates.
+        with timed("db"), transaction(connection, "IMMEDIATE"):
+            cursor = connection.cursor()
+            current_rows = select_word_scores(cursor, learner, language, words)
+            new_word_scores = score_submission(original_word_matches,
+                                               decay_word_scores(words, current_rows, time.time()))
+            last_seen = upsert_word_scores(cursor, learner, language, new_word_scores)
+        word_score_store.update(learner, language, new_word_scores, last_seen)
+        logger.debug("Scores commited")
+    except sqlite3.Error as e:
+        logger.error("An error occurred: %s", e)
 
 
 def split_words(translation):
-    words = []
-    for word_match in re.finditer(r'[\w\']+', translation):
-        words.append(word_match.group())
-    return words
+    return WORD_PATTERN.findall(translation)
 
 
+@timed("matching")
 def find_best_translation(sentence, submission):
     # First see if we can find an exact match
     for translation in sentence.translations:
         if submission == translation:
             return translation
 
+    # Otherwise find the first translation with the highest similarity ratio to the submission. The
+    # SequenceMatcher keeps what it has worked out about the submission between translations, and the cheap
+    # upper bounds on the ratio let us skip most translations without calculating the full ratio.
+    matcher = SequenceMatcher(None, "", submission)
+    candidates = []
+    for i, translation in enumerate(sentence.translations):
+        matcher.set_seq1(translation)
+        candidates.append((-matcher.real_quick_ratio(), i, translation))
+    candidates.sort()
+
     best_translation = None
     best_translation_score = 0
+    best_translation_index = len(candidates)
 
-    for translation in sentence.translations:
-        s = SequenceMatcher(None, translation, submission)
-        if s.ratio() > best_translation_score:
-            best_translation_score = s.ratio()
+    def could_beat_best(score, i):
+        # Ties go to the translation that comes first
+        return score > best_translation_score or (score == best_translation_score and i < best_translation_index)
+
+    for length_bound, i, translation in candidates:
+        if not could_beat_best(-length_bound, i):
+            # The remaining translations have lower bounds, or the same bound and come later
+            break
+
+        matcher.set_seq1(translation)
+        if not could_beat_best(matcher.quick_ratio(), i):
+            continue
+
+        score = matcher.ratio()
+        if score > 0 and could_beat_best(score, i):
+            best_translation_score = score
+            best_translation_index = i
             best_translation = translation
 
     return best_translation
 
 
-def find_matches_in_strings(str1, str2):
-    str2matches = {}
-    str1_words = []
+def find_word_positions(string, words=None) -> list[tuple[str, int]]:
+    # The (word, index) of each word in the string. If the words have already been split they just need
+    # finding, which is cheaper than running the regex again.
+    if words is None:
+        return [(word_match.group(), word_match.start()) for word_match in WORD_PATTERN.finditer(string)]
 
-    for word_match in re.finditer(r'[\w\']+', str1):
-        word = word_match.group()
-        str1_idx = word_match.start()
-        prev_str2_idx = str2matches.get(word, -1)
+    positions = []
+    index = 0
+    for word in words:
+        index = string.index(word, index)
+        positions.append((word, index))
+        index += len(word)
+    return positions
+
+
+def fold_words(word_positions) -> list[str]:
+    return [word.casefold() for word, _ in word_positions]
 
-        str2_idx = -1
 
-        # Search the other string for the same word
-        for str2_match in re.finditer(rf"\b{word}\b", str2, re.IGNORECASE):
-            if str2_match.start() > prev_str2_idx:
-                str2_idx = str2_match.start()
-                str2matches[word] = str2_idx
-                break
+def index_word_positions(word_positions, folded_words) -> dict[str, list[int]]:
+    # Where each word appears, ignoring case. folded_words are the casefolded words of word_positions.
+    index = {}
+    for (_, position), folded in zip(word_positions, folded_words):
+        index.setdefault(folded, []).append(position)
+    return index
 
-        str1_words.append((word, str1_idx, str2_idx))
 
-    return str1_words
+def align_words(word_positions, folded_words, other_index):
+    # Pair each word with the next unused position of the same word in the other string. Repeats of a word
+    # take successive positions.
+    next_match = {}
+    matches = []
+
+    for (word, position), folded in zip(word_positions, folded_words):
+        other_positions = other_index.get(folded, ())
+        i = next_match.get(word, 0)
+        if i < len(other_positions):
+            matches.append((word, position, other_positions[i]))
+            next_match[word] = i + 1
+        else:
+            matches.append((word, position, -1))
+
+    return matches
+
+
+def find_matches_in_strings(str1, str2):
+    str1_positions = find_word_positions(str1)
+    str2_positions = find_word_positions(str2)
+    return align_words(str1_positions, fold_words(str1_positions),
+                       index_word_positions(str2_positions, fold_words(str2_positions)))
 
 
 def all_words_match(matches1, matches2):
@@ -388,9 +939,19 @@ def all_words_match(matches1, matches2):
     return True
 
 
-def find_matches_with_positions(str1, str2):
-    str1_words = find_matches_in_strings(str1, str2)
-    str2_words = find_matches_in_strings(str2, str1)
+@timed("matching")
+def find_matches_with_positions(str1, str2, str1_words=None, str1_folded_words=None):
+    # Split and casefold both strings once and align them in each direction. A stored translation's words
+    # come already split and folded.
+    str1_positions = find_word_positions(str1, str1_words)
+    str2_positions = find_word_positions(str2)
+    if str1_folded_words is None:
+        str1_folded_words = fold_words(str1_positions)
+    str2_folded_words = fold_words(str2_positions)
+    str1_words = align_words(str1_positions, str1_folded_words,
+                             index_word_positions(str2_positions, str2_folded_words))
+    str2_words = align_words(str2_positions, str2_folded_words,
+                             index_word_positions(str1_positions, str1_folded_words))
     correct = all_words_match(str1_words, str2_words)
 
     return str1_words, str2_words, correct
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# How the cache is used: READ_WRITE calls the LLM on a miss and stores the result, REPLAY only ever answers
+# from the cache, e.g. for offline runs, and OFF always calls the LLM
+READ_WRITE = "readwrite"
+REPLAY = "replay"
+OFF = "off"
+
+
+class LLMCacheMiss(Exception):
+    pass
+
+
+class CompletionCache:
+    # An on-disk cache of parsed LLM completions. Entries are files named after a hash of the model, messages
+    # and response schema, so the same prompt always finds the same entry and any change to the prompt or
+    # schema misses.
+
+    def __init__(self, directory, mode=READ_WRITE, ttl=30 * 24 * 60 * 60, max_entries=10000):
+        self.directory = directory
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Number of entries on disk, counted the first time it's needed
+        self._count = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(model, messages, response_format):
+        request = {"model": model, "messages": messages, "schema": response_format.model_json_schema()}
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, model, messages, response_format, fresh=False):
+        # Returns the cached response_format instance, or None. With fresh set the entry is skipped, so the
+        # caller asks the LLM again and replaces it, except when replaying.
+        if self.mode == OFF or (fresh and self.mode != REPLAY):
+            return None
+
+        path = self.path(self.key(model, messages, response_format))
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+                os.remove(path)
+                with self._lock:
+                    if self._count is not None:
+                        self._count -= 1
+                parsed = None
+            else:
+                parsed = response_format.model_validate(entry["response"])
+        except FileNotFoundError:
+            parsed = None
+        except (OSError, ValueError) as e:
+            # A damaged or out of date entry is just a miss
+            logger.warning("Ignoring LLM cache entry %s: %s", path, e)
+            parsed = None
+
+        with self._lock:
+            if parsed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if parsed is None and self.mode == REPLAY:
+            raise LLMCacheMiss(f"No cached {model} completion for {messages[-1]['content'][:80]!r}")
+        return parsed
+
+    def put(self, model, messages, response_format, parsed):
+        if self.mode != READ_WRITE:
+            return
+
+        path = self.path(self.key(model, messages, response_format))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        replaced = os.path.exists(path)
+        # Write to a temporary file first so readers never see half an entry
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"created": time.time(), "model": model, "response": parsed.model_dump(mode="json")}, f)
+        os.replace(temporary_path, path)
+
+        count = None if self._count is not None else len(self.entries())
+        with self._lock:
+            self.writes += 1
+            if self._count is None:
+                self._count = count
+            elif not replaced:
+                self._count += 1
+            full = self._count > self.max_entries
+        # Only look through the entries once there are too many
+        if full:
+            self.evict()
+
+    def get_or_create(self, model, messages, response_format, create, fresh=False):
+        parsed = self.get(model, messages, response_format, fresh)
+        if parsed is None:
+            parsed = create()
+            self.put(model, messages, response_format, parsed)
+        return parsed
+
+    async def get_or_create_async(self, model, messages, response_format, create, fresh=False):
+        parsed = self.get(model, messages, response_format, fresh)
+        if parsed is None:
+            parsed = await create()
+            self.put(model, messages, response_format, parsed)
+        return parsed
+
+    def entries(self):
+        # (modified time, path) of every entry
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                entries.extend((entry.stat().st_mtime, entry.path) for entry in os.scandir(shard.path)
+                               if entry.name.endswith(".json"))
+        return entries
+
+    def evict(self):
+        # Remove expired entries, then the oldest ones until we're back under max_entries. A tenth of the room is
+        # freed up so that the entries are only looked through again after that many more puts.
+        entries = sorted(self.entries())
+        now = time.time()
+        expired = [path for mtime, path in entries if self.ttl is not None and now - mtime > self.ttl]
+        remaining = len(entries) - len(expired)
+        keep = self.max_entries - self.max_entries // 10 if remaining > self.max_entries else remaining
+        oldest = [path for _, path in entries[len(expired):len(expired) + remaining - keep]]
+        for path in expired + oldest:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self.evictions += 1
+        with self._lock:
+            self._count = keep
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "writes": self.writes,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,252 @@
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from server import languagebot, scoring
+from server.selection import REFRESH_INTERVAL, SelectionIndex
+from server.snapshot import Snapshot, write_snapshot
+from server.views import TARGET_SCORE
+from server.testing import (temporary_database, populate, make_learner, count_calls, regex_find_matches_in_strings,
+                            sequential_find_best_translation, make_translation_variants, make_submission)
+
+
+def benchmark_scoring(options, write):
+    with temporary_database():
+        language = "italian"
+        learner = make_learner(0)
+        topic = populate(language, sentences_per_topic=options["sentences"],
+                         translations_per_sentence=options["translations"],
+                         words_per_translation=options["words"],
+                         vocabulary_size=options["vocabulary"])[0]
+        sentences = languagebot.get_sentences_from_db(language, topic)
+
+        def per_translation():
+            return [(sentence, max(languagebot.calculate_translation_score(learner, language, translation)
+                                   for translation in sentence.translations))
+                    for sentence in sentences]
+
+        def batched():
+            return languagebot.calculate_sentence_scores(learner, language, sentences)
+
+        # With the word score store on the scores are read from memory, so it's measured separately
+        for store in [False, True]:
+            languagebot.word_score_store.clear()
+            with override_settings(WORD_SCORE_STORE=store):
+                for name, run in [("per translation", per_translation), ("batched", batched)]:
+                    name += " (store)" if store else ""
+                    with count_calls(languagebot.get_word_scores_from_db) as lookups:
+                        run()
+                    start = time.perf_counter()
+                    for _ in range(options["repeat"]):
+                        run()
+                    elapsed = (time.perf_counter() - start) / options["repeat"]
+                    write(f"{name:>24}: {lookups.call_count:4d} db lookups per request, "
+                          f"{elapsed * 1000:8.2f} ms per request")
+
+
+def benchmark_tokenization(options, write):
+    with temporary_database():
+        language = "italian"
+        learner = make_learner(0)
+        topic = populate(language, sentences_per_topic=options["sentences"],
+                         translations_per_sentence=options["translations"],
+                         words_per_translation=options["words"],
+                         vocabulary_size=options["vocabulary"])[0]
+        sentences = languagebot.get_sentences_from_db(language, topic)
+
+        # Before tokens were stored every request split each translation again
+        def unsplit_sentences():
+            return [languagebot.Sentence(english=sentence.english, translations=sentence.translations,
+                                         topic=sentence.topic) for sentence in sentences]
+
+        for name, requests in [("split per request", [unsplit_sentences() for _ in range(options["repeat"])]),
+                               ("stored tokens", [sentences] * options["repeat"])]:
+            start = time.process_time()
+            for request_sentences in requests:
+                languagebot.calculate_sentence_scores(learner, language, request_sentences)
+            elapsed = (time.process_time() - start) / options["repeat"]
+            write(f"{name:>18}: {elapsed * 1000:8.2f} ms cpu per request")
+
+
+def benchmark_alignment(options, write):
+    rng = random.Random(0)
+    vocabulary = [f"parola{i}" for i in range(options["vocabulary"])]
+    for length in [10, 100, 1000]:
+        str1 = " ".join(rng.choices(vocabulary, k=length))
+        str2 = " ".join(rng.choices(vocabulary, k=length))
+        for name, align in [("regex", lambda: (regex_find_matches_in_strings(str1, str2),
+                                               regex_find_matches_in_strings(str2, str1))),
+                            ("linear", lambda: languagebot.find_matches_with_positions(str1, str2))]:
+            start = time.perf_counter()
+            for _ in range(options["repeat"]):
+                align()
+            elapsed = (time.perf_counter() - start) / options["repeat"]
+            write(f"{length:5d} words {name:>7}: {elapsed * 1000:10.3f} ms per submission")
+
+
+def benchmark_best_translation(options, write):
+    rng = random.Random(0)
+    for translations, repeat in [(8, 1), (60, 1), (60, 10)]:
+        sentence = languagebot.Sentence(english="english", translations=make_translation_variants(rng, translations),
+                                        topic="topic")
+        submissions = [make_submission(rng, rng.choice(sentence.translations), repeat=repeat) for _ in range(20)]
+        for name, find in [("sequential", sequential_find_best_translation),
+                           ("pruned", languagebot.find_best_translation)]:
+            start = time.perf_counter()
+            for submission in submissions:
+                find(sentence, submission)
+            elapsed = (time.perf_counter() - start) / len(submissions)
+            write(f"{translations:3d} translations, {len(submissions[0]):4d} char submission {name:>10}: "
+                  f"{elapsed * 1000:8.3f} ms per submission")
+
+
+def benchmark_vectorized(options, write):
+    with temporary_database():
+        language = "italian"
+        learner = make_learner(0)
+        topic = populate(language, sentences_per_topic=options["sentences"],
+                         translations_per_sentence=options["translations"],
+                         words_per_translation=options["words"],
+                         vocabulary_size=options["vocabulary"])[0]
+        sentence_words = [sentence.translation_words()
+                          for sentence in languagebot.get_sentences_from_db(language, topic)]
+        words = {word for translations in sentence_words for words in translations for word in words}
+        word_scores = languagebot.get_word_scores_from_db(learner, language, words)
+
+    kernels = [("python", scoring.score_sentences_python)]
+    if scoring.np is not None:
+        kernels.append(("numpy", scoring.score_sentences_numpy))
+    for name, score_sentences in kernels:
+        now = time.time()
+        start = time.perf_counter()
+        for _ in range(options["repeat"]):
+            score_sentences(sentence_words, word_scores, now)
+        elapsed = (time.perf_counter() - start) / options["repeat"]
+        write(f"{name:>7}: {elapsed * 1000:8.3f} ms per request")
+
+
+def benchmark_selection(options, write):
+    with temporary_database():
+        language = "italian"
+        learner = make_learner(0)
+        topic = populate(language, sentences_per_topic=options["sentences"],
+                         translations_per_sentence=options["translations"],
+                         words_per_translation=options["words"],
+                         vocabulary_size=options["vocabulary"])[0]
+        sentences = languagebot.get_sentences_from_db(language, topic)
+        rng = random.Random(0)
+        # Each request follows a submission that changed the scores of one translation's words
+        submitted = [rng.choice(rng.choice(sentences).translation_words()) for _ in range(options["repeat"])]
+
+        def full_sort(words):
+            scores = languagebot.calculate_sentence_scores(learner, language, sentences)
+            return sorted(scores, key=lambda s: abs(TARGET_SCORE - s[1]))[0]
+
+        index = SelectionIndex(learner, language, sentences)
+        index.select(TARGET_SCORE, time.time())
+
+        def indexed(words):
+            index.words_changed(words)
+            return index.select(TARGET_SCORE, time.time())
+
+        # Every request comes after the refresh interval so the whole topic is re-ranked as it decays
+        later = [time.time()]
+
+        def decayed(words):
+            later[0] += REFRESH_INTERVAL
+            index.words_changed(words)
+            return index.select(TARGET_SCORE, later[0])
+
+        for name, select in [("full sort", full_sort), ("index", indexed), ("re-ranked", decayed)]:
+            start = time.perf_counter()
+            for words in submitted:
+                select(words)
+            elapsed = (time.perf_counter() - start) / len(submitted)
+            write(f"{name:>10}: {elapsed * 1000:8.3f} ms per request")
+
+
+def benchmark_wordstore(options, write):
+    with temporary_database():
+        language = "italian"
+        learner = make_learner(0)
+        topic = populate(language, sentences_per_topic=options["sentences"],
+                         translations_per_sentence=options["translations"],
+                         words_per_translation=options["words"],
+                         vocabulary_size=options["vocabulary"])[0]
+        words = list({word for sentence in languagebot.get_sentences_from_db(language, topic)
+                      for words in sentence.translation_words() for word in words})
+        languagebot.word_score_store.rows(learner, language, words)
+
+        for name, read in [("database", languagebot.get_word_scores_from_db),
+                           ("store", languagebot.word_score_store.rows)]:
+            start = time.perf_counter()
+            for _ in range(options["repeat"]):
+                read(learner, language, words)
+            elapsed = (time.perf_counter() - start) / options["repeat"]
+            write(f"{name:>9}: {elapsed * 1000:8.3f} ms to read {len(words)} word scores")
+        stats = languagebot.word_score_store.stats()
+        write(f"{stats['bytes'] / 1024:.0f} KiB for {stats['words'][language]} words")
+
+
+def benchmark_snapshot(options, write):
+    with temporary_database(), tempfile.TemporaryDirectory() as directory:
+        language = "italian"
+        topics = populate(language, topics=options["topics"], sentences_per_topic=options["sentences"],
+                          translations_per_sentence=options["translations"],
+                          words_per_translation=options["words"],
+                          vocabulary_size=options["vocabulary"])
+        path = os.path.join(directory, "sentences.snapshot")
+        write_snapshot(languagebot.get_connection(), path)
+        write(f"{os.path.getsize(path) / 1024:.0f} KiB snapshot of {len(topics) * options['sentences']} sentences")
+
+        snapshot = Snapshot(path)
+        try:
+            for name, current in [("database", None), ("snapshot", snapshot)]:
+                languagebot.sentence_snapshot = current
+                start = time.perf_counter()
+                for topic in topics:
+                    languagebot.load_topic_sentences(language, topic)
+                elapsed = (time.perf_counter() - start) / len(topics)
+                write(f"{name:>9}: {elapsed * 1000:8.3f} ms to load a topic")
+        finally:
+            languagebot.sentence_snapshot = None
+            snapshot.close()
+
+
+SCENARIOS = {
+    "scoring": benchmark_scoring,
+    "tokenization": benchmark_tokenization,
+    "alignment": benchmark_alignment,
+    "best_translation": benchmark_best_translation,
+    "vectorized": benchmark_vectorized,
+    "selection": benchmark_selection,
+    "wordstore": benchmark_wordstore,
+    "snapshot": benchmark_snapshot,
+}
+
+
+class Command(BaseCommand):
+    help = "Run micro benchmarks of the sentence scoring hot paths against a synthetic database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                            help=f"Scenarios to run, defaults to all of: {', '.join(SCENARIOS)}")
+        parser.add_argument("--topics", type=int, default=20)
+        parser.add_argument("--sentences", type=int, default=10)
+        parser.add_argument("--translations", type=int, default=8)
+        parser.add_argument("--words", type=int, default=6)
+        parser.add_argument("--vocabulary", type=int, default=500)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        unknown = set(options["scenarios"]) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+        for scenario in options["scenarios"] or SCENARIOS:
+            self.stdout.write(f"== {scenario}")
+            SCENARIOS[scenario](options, self.stdout.write)
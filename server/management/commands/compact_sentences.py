@@ -0,0 +1,92 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from server import languagebot
+from server.db import transaction
+from server.dedup import SentenceIndex, fingerprints, normalize
+from server.snapshot import write_snapshot
+
+
+class Command(BaseCommand):
+    help = ("Merge the duplicate sentences stored before they were deduplicated on ingestion. Sentences whose "
+            "English only differs in case and punctuation are merged into the topic's oldest, near duplicates of an "
+            "older sentence in the topic are removed, and translations that only differ in case and punctuation are "
+            "merged. The snapshot is exported again if there is one. Restart the workers afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Report what would change without changing it")
+        parser.add_argument("--snapshot", default=getattr(settings, "SENTENCE_SNAPSHOT", None),
+                            help="The snapshot to export again, defaults to the SENTENCE_SNAPSHOT setting")
+
+    def handle(self, *args, **options):
+        connection = languagebot.get_connection()
+        with transaction(connection, "IMMEDIATE"):
+            cursor = connection.cursor()
+
+            # Older sentences are kept so their ids, and any snapshot of them, stay valid
+            indexes = {}
+            merged = {}
+            dropped = {}
+            kept = []
+            # Like ingestion, only sentences in the same topic are merged so none disappears from its topic
+            cursor.execute("SELECT id, language, english, topic FROM sentences ORDER BY id")
+            sentences = cursor.fetchall()
+            sentence_fingerprints = fingerprints(english for _, _, english, _ in sentences)
+            for sentence_id, language, english, topic in sentences:
+                english_fingerprint = sentence_fingerprints[english]
+                index = indexes.setdefault((language, topic), SentenceIndex())
+                if english_fingerprint.normalized:
+                    match = index.exact(english_fingerprint.normalized)
+                    if match is not None:
+                        merged[sentence_id] = match
+                        continue
+                    match = index.similar(english_fingerprint)
+                    if match is not None:
+                        dropped[sentence_id] = match
+                        continue
+                    index.add(sentence_id, english_fingerprint.normalized, english_fingerprint.buckets,
+                              english_fingerprint.shingles)
+                kept.append((sentence_id, language, english_fingerprint))
+
+            moved = []
+            removed = []
+            seen = set()
+            cursor.execute("SELECT sentence_id, translation FROM translations ORDER BY sentence_id, translation")
+            for sentence_id, translation in cursor.fetchall():
+                target = merged.get(sentence_id, sentence_id)
+                key = (target, normalize(translation))
+                if sentence_id in dropped or key in seen:
+                    removed.append((sentence_id, translation))
+                    continue
+                seen.add(key)
+                if target != sentence_id:
+                    moved.append((target, sentence_id, translation))
+
+            if not options["dry_run"]:
+                cursor.executemany("DELETE FROM translations WHERE sentence_id = ? AND translation = ?", removed)
+                # Moved translations are new to the sentences they move to
+                revision = languagebot.next_translation_revision(cursor)
+                cursor.executemany("UPDATE translations SET sentence_id = ?, revision = ? "
+                                   "WHERE sentence_id = ? AND translation = ?",
+                                   [(target, revision, sentence_id, translation)
+                                    for target, sentence_id, translation in moved])
+                cursor.executemany("DELETE FROM sentences WHERE id = ?",
+                                   [(sentence_id, ) for sentence_id in [*merged, *dropped]])
+                cursor.executemany("UPDATE sentences SET normalized = ? WHERE id = ?",
+                                   [(english.normalized, sentence_id) for sentence_id, _, english in kept])
+                cursor.execute("DELETE FROM sentence_fingerprints")
+                cursor.executemany("INSERT INTO sentence_fingerprints (language, band, bucket, sentence_id) "
+                                   "VALUES (?, ?, ?, ?)",
+                                   [(language, band, bucket, sentence_id) for sentence_id, language, english in kept
+                                    for band, bucket in english.buckets])
+
+        self.stdout.write(f"{'Would merge' if options['dry_run'] else 'Merged'} {len(merged)} sentences differing in "
+                          f"case and punctuation and {len(dropped)} near duplicates, moving {len(moved)} "
+                          f"translations and removing {len(removed)}, leaving {len(kept)} sentences.")
+
+        # The snapshot still has the sentences that were merged away
+        if not options["dry_run"] and options["snapshot"] and os.path.exists(options["snapshot"]):
+            count = write_snapshot(connection, options["snapshot"])
+            self.stdout.write(f"Wrote {count} sentences to {options['snapshot']}")
@@ -0,0 +1,21 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from server import languagebot
+from server.snapshot import write_snapshot
+
+
+class Command(BaseCommand):
+    help = ("Compile the sentences table into a read only snapshot that worker processes memory map at startup. "
+            "Restart the workers afterwards to pick it up.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=getattr(settings, "SENTENCE_SNAPSHOT", None),
+                            help="Defaults to the SENTENCE_SNAPSHOT setting")
+
+    def handle(self, *args, **options):
+        count = write_snapshot(languagebot.get_connection(), options["output"])
+        size = os.path.getsize(options["output"])
+        self.stdout.write(f"Wrote {count} sentences to {options['output']} ({size / 1024:.0f} KiB)")
@@ -0,0 +1,57 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from server.languagebot import store_sentence_rows
+
+
+class Command(BaseCommand):
+    help = ("Import pre-generated sentences from JSONL files. Each line is an object with english, "
+            "translations, topic and optionally language.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+")
+        parser.add_argument("--language", help="Language for lines that don't give one")
+        parser.add_argument("--batch-size", type=int, default=50000, help="Rows written per transaction")
+        parser.add_argument("--no-dedup", action="store_false", dest="deduplicate",
+                            help="Store the sentences as they are, for trusted files. Run compact_sentences "
+                                 "afterwards to merge any duplicates and find near duplicates of later ones.")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        total_inserted = total_duplicates = 0
+        rows = []
+
+        def flush():
+            nonlocal total_inserted, total_duplicates
+            result = store_sentence_rows(rows, deduplicate=options["deduplicate"])
+            total_inserted += result.inserted
+            total_duplicates += result.duplicates
+            rows.clear()
+
+        for path in options["files"]:
+            with open(path, encoding="utf-8") as file:
+                for line_number, line in enumerate(file, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        sentence = json.loads(line)
+                        language = sentence.get("language", options["language"])
+                        if not language:
+                            raise ValueError("no language given")
+                        english = sentence["english"]
+                        topic = sentence["topic"].lower().strip()
+                        rows.extend((language, english, translation, topic)
+                                    for translation in sentence["translations"])
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        raise CommandError(f"{path}:{line_number}: invalid sentence ({e!r})")
+
+                    if len(rows) >= options["batch_size"]:
+                        flush()
+        flush()
+
+        elapsed = time.perf_counter() - start
+        total = total_inserted + total_duplicates
+        self.stdout.write(f"Imported {total} rows in {elapsed:.2f}s ({total / elapsed:,.0f} rows/s): "
+                          f"{total_inserted} inserted, {total_duplicates} duplicates")
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import random
+import time
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, override_settings
+
+from server import instrumentation, languagebot, pregeneration, views
+from server.testing import temporary_database, populate, make_learner, make_submission, FakeAsyncOpenAI
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = ("Load test /getsentence and /submitsentence against a synthetic database at increasing concurrency, "
+            "reporting latency percentiles, throughput and SQLite statements per request")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--languages", type=int, default=2)
+        parser.add_argument("--topics", type=int, default=5, help="Topics per language")
+        parser.add_argument("--sentences", type=int, default=50, help="Sentences per topic")
+        parser.add_argument("--translations", type=int, default=8)
+        parser.add_argument("--words", type=int, default=6)
+        parser.add_argument("--vocabulary", type=int, default=2000)
+        parser.add_argument("--learners", type=int, default=20)
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+        parser.add_argument("--requests", type=int, default=200, help="Requests to each endpoint per level")
+        parser.add_argument("--prefetch", type=int, default=0,
+                            help="Ask /submitsentence for the next sentences instead of calling /getsentence")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--label", default="", help="Saved with the results, e.g. the commit being tested")
+        parser.add_argument("--output", help="Write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        if min(options["concurrency"]) < 1 or options["requests"] < 1:
+            raise CommandError("--concurrency and --requests must be positive")
+
+        with (temporary_database(),
+              # Requests are told which learner they're from rather than creating sessions in the real database
+              mock.patch.object(views, "get_learner", lambda request: request.headers["X-Learner"]),
+              mock.patch.object(languagebot, "async_client", FakeAsyncOpenAI()),
+              # Keep top ups of the synthetic topics off the real queue
+              mock.patch.object(pregeneration, "queue", pregeneration.PregenerationQueue()) as queue,
+              override_settings(ALLOWED_HOSTS=["testserver"])):
+            corpus = self.populate(options)
+            results = [asyncio.run(self.run_level(concurrency, corpus, options))
+                       for concurrency in options["concurrency"]]
+            queue.stop()
+
+        self.stdout.write(f"{'endpoint':>16} {'clients':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+                          f"{'req/s':>8} {'queries':>8} {'errors':>6}")
+        for level in results:
+            for endpoint, result in level.items():
+                self.stdout.write(f"{endpoint:>16} {result['concurrency']:7d} {result['p50_ms']:8.2f} "
+                                  f"{result['p95_ms']:8.2f} {result['p99_ms']:8.2f} {result['throughput']:8.1f} "
+                                  f"{result['queries_per_request']:8.2f} {result['errors']:6d}")
+
+        if options["output"]:
+            settings = {key: options[key] for key in ["languages", "topics", "sentences", "translations", "words",
+                                                      "vocabulary", "learners", "requests", "prefetch", "seed"]}
+            with open(options["output"], "w") as f:
+                json.dump({"label": options["label"], "created": time.time(), "settings": settings,
+                           "results": [result for level in results for result in level.values()]}, f, indent=2)
+
+    def populate(self, options):
+        # (language, topic, english, translations) for every sentence in the synthetic database
+        corpus = []
+        for i in range(options["languages"]):
+            language = f"language{i}"
+            for topic in populate(language, topics=options["topics"], sentences_per_topic=options["sentences"],
+                                  translations_per_sentence=options["translations"],
+                                  words_per_translation=options["words"], vocabulary_size=options["vocabulary"],
+                                  learners=options["learners"], seed=options["seed"] + i):
+                corpus.extend((language, topic, sentence.english, sentence.translations)
+                              for sentence in languagebot.get_sentences_from_db(language, topic))
+        return corpus
+
+    async def run_level(self, concurrency, corpus, options):
+        rng = random.Random(options["seed"])
+        translations = {(language, english): translations for language, _, english, translations in corpus}
+        latencies = {"/getsentence": [], "/submitsentence": []}
+        errors = {"/getsentence": 0, "/submitsentence": 0}
+        remaining = options["requests"]
+        queries = instrumentation.metrics.queries
+
+        async def post(client, learner, path, data):
+            start = time.perf_counter()
+            response = await client.post(path, json.dumps(data), content_type="application/json",
+                                         headers={"X-Learner": learner})
+            latencies[path].append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors[path] += 1
+                return None
+            return response.json()
+
+        async def session(worker):
+            nonlocal remaining
+            client = AsyncClient()
+            learner = make_learner(worker % options["learners"])
+            upcoming = []
+            language, topic, _, _ = rng.choice(corpus)
+            while remaining > 0:
+                remaining -= 1
+                if upcoming:
+                    english = upcoming.pop(0)
+                else:
+                    language, topic, _, _ = rng.choice(corpus)
+                    sentence = await post(client, learner, "/getsentence", {"language": language, "topic": topic})
+                    if sentence is None:
+                        continue
+                    english = sentence["english"]
+                submission = make_submission(rng, rng.choice(translations[(language, english)]))
+                result = await post(client, learner, "/submitsentence",
+                                    {"language": language, "english": english, "submission": submission,
+                                     "topic": topic, "prefetch": options["prefetch"]})
+                if result is not None and result.get("next"):
+                    upcoming = result["next"]
+
+        start = time.perf_counter()
+        await asyncio.gather(*[session(worker) for worker in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        requests = sum(len(endpoint_latencies) for endpoint_latencies in latencies.values())
+        queries_per_request = (instrumentation.metrics.queries - queries) / requests if requests else 0.0
+
+        results = {}
+        for path, endpoint_latencies in latencies.items():
+            ordered = sorted(endpoint_latencies) or [0.0]
+            results[path] = {
+                "endpoint": path,
+                "concurrency": concurrency,
+                "requests": len(endpoint_latencies),
+                "p50_ms": percentile(ordered, 50) * 1000,
+                "p95_ms": percentile(ordered, 95) * 1000,
+                "p99_ms": percentile(ordered, 99) * 1000,
+                "throughput": len(endpoint_latencies) / elapsed,
+                "queries_per_request": queries_per_request,
+                "errors": errors[path],
+            }
+        return results
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from openai import RateLimitError
+
+from server import languagebot
+
+
+class RateLimiter:
+    # Spaces out the start of each request so that no more than per_minute start in any minute
+
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute
+        self.next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Command(BaseCommand):
+    help = ("Generate sentences for every combination of the given languages and topics so a deployment is seeded "
+            "before launch. Each topic's sentences are stored together once they've all been generated and topics "
+            "that already have sentences are skipped, so an interrupted run can simply be started again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--languages", nargs="+", required=True)
+        parser.add_argument("--topics", nargs="+", help="Defaults to asking the LLM for a list of topics")
+        parser.add_argument("--workers", type=int, default=4, help="Topics generated at the same time")
+        parser.add_argument("--requests-per-minute", type=float, default=60)
+        parser.add_argument("--retries", type=int, default=3, help="Attempts per topic after being rate limited")
+        parser.add_argument("--min-sentences", type=int, default=1,
+                            help="Skip topics with at least this many sentences already")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["requests_per_minute"] <= 0:
+            raise CommandError("--workers and --requests-per-minute must be positive")
+        asyncio.run(self.pregenerate(options))
+
+    async def pregenerate(self, options):
+        topics = options["topics"]
+        if not topics:
+            topics = (await languagebot.get_topics_from_llm_async()).topics
+            self.stdout.write(f"Topics from LLM: {', '.join(topics)}")
+        # Topics are stored the way /getsentence asks for them
+        topics = list(dict.fromkeys(topic.lower().strip() for topic in topics))
+        pairs = [(language, topic) for language in options["languages"] for topic in topics]
+
+        limiter = RateLimiter(options["requests_per_minute"])
+        workers = asyncio.Semaphore(options["workers"])
+        totals = {"generated": 0, "skipped": 0, "failed": 0, "sentences": 0}
+        start = time.perf_counter()
+
+        async def generate(language, topic):
+            async with workers:
+                existing = await sync_to_async(languagebot.count_topic_sentences)(language, topic)
+                if existing >= options["min_sentences"]:
+                    totals["skipped"] += 1
+                    return
+
+                for attempt in range(options["retries"] + 1):
+                    await limiter.wait()
+                    try:
+                        # Not streamed, so a topic that was interrupted has no sentences and isn't skipped next time
+                        sentences = await languagebot.load_sentences_from_llm(language, topic, streaming=False)
+                        break
+                    except RateLimitError as e:
+                        if attempt == options["retries"]:
+                            totals["failed"] += 1
+                            self.stderr.write(f"{language} {topic}: still rate limited, giving up ({e})")
+                            return
+                        await asyncio.sleep(2 ** attempt)
+                    except Exception as e:
+                        totals["failed"] += 1
+                        self.stderr.write(f"{language} {topic}: failed ({e})")
+                        return
+
+                totals["generated"] += 1
+                totals["sentences"] += len(sentences)
+                self.stdout.write(f"{language} {topic}: {len(sentences)} sentences")
+
+        await asyncio.gather(*[generate(language, topic) for language, topic in pairs])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Generated {totals['generated']} topics ({totals['sentences']} sentences) in {elapsed:.2f}s "
+                          f"({totals['generated'] / elapsed * 60:.1f} topics/min, "
+                          f"{totals['sentences'] / elapsed:.1f} sentences/s), skipped {totals['skipped']} already "
+                          f"populated, {totals['failed']} failed")
@@ -0,0 +1,54 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from server import instrumentation
+
+
+def server_timing(timings, total):
+    metrics = [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in timings.phases.items()]
+    metrics.append(f'queries;desc="{timings.queries} queries / {timings.connections} new connections"')
+    metrics.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(metrics)
+
+
+class ServerTimingMiddleware:
+    # Times each request, adds the breakdown to the response as a Server-Timing header and adds it to the
+    # totals on /metrics
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = instrumentation.RequestTimings()
+        token = instrumentation.current_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            instrumentation.current_timings.reset(token)
+        return self.finish(response, timings, start)
+
+    async def __acall__(self, request):
+        timings = instrumentation.RequestTimings()
+        token = instrumentation.current_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            instrumentation.current_timings.reset(token)
+        return self.finish(response, timings, start)
+
+    @staticmethod
+    def finish(response, timings, start):
+        total = time.perf_counter() - start
+        instrumentation.metrics.add_request(total)
+        response["Server-Timing"] = server_timing(timings, total)
+        return response
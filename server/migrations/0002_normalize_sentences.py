@@ -0,0 +1,64 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="ALTER TABLE sentences RENAME TO old_sentences;",
+            reverse_sql="ALTER TABLE old_sentences RENAME TO sentences;",
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE sentences (
+                    id INTEGER PRIMARY KEY,
+                    language TEXT NOT NULL,
+                    english TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    UNIQUE (language, english)
+                );""",
+            reverse_sql="DROP TABLE sentences;",
+        ),
+        migrations.RunSQL(
+            sql="CREATE INDEX sentences_language_topic ON sentences (language, topic, english);",
+            reverse_sql="DROP INDEX sentences_language_topic;",
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE translations (
+                    sentence_id INTEGER NOT NULL REFERENCES sentences (id),
+                    translation TEXT NOT NULL,
+                    PRIMARY KEY (sentence_id, translation)
+                ) WITHOUT ROWID;""",
+            reverse_sql="DROP TABLE translations;",
+        ),
+        # Copy the existing rows across. A sentence that was stored under several topics keeps the first.
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO sentences (language, english, topic)
+                    SELECT language, english, MIN(topic) FROM old_sentences GROUP BY language, english;
+                INSERT INTO translations (sentence_id, translation)
+                    SELECT sentences.id, old_sentences.translation FROM old_sentences
+                    JOIN sentences ON sentences.language = old_sentences.language
+                        AND sentences.english = old_sentences.english;""",
+            reverse_sql="""
+                INSERT INTO old_sentences (language, english, translation, topic)
+                    SELECT language, english, translation, topic FROM sentences
+                    JOIN translations ON translations.sentence_id = sentences.id;""",
+        ),
+        migrations.RunSQL(
+            sql="DROP TABLE old_sentences;",
+            reverse_sql="""
+                CREATE TABLE old_sentences (
+                    language TEXT NOT NULL,
+                    english TEXT NOT NULL,
+                    translation TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    PRIMARY KEY (language, english, translation)
+                );""",
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # VACUUM can't run inside a transaction
+
+    atomic = False
+
+    dependencies = [
+        ('server', '0002_normalize_sentences'),
+    ]
+
+    operations = [
+        # Reclaim the space freed by moving the sentences to the normalized tables
+        migrations.RunSQL(sql="VACUUM;", reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,28 @@
+import re
+
+from django.db import migrations
+
+
+def split_translations(apps, schema_editor):
+    # Same tokenization as languagebot.split_words
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT sentence_id, translation FROM translations WHERE tokens IS NULL")
+        rows = [(" ".join(re.findall(r"[\w']+", translation)), sentence_id, translation)
+                for sentence_id, translation in cursor.fetchall()]
+        cursor.executemany("UPDATE translations SET tokens = %s WHERE sentence_id = %s AND translation = %s", rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0003_vacuum'),
+    ]
+
+    operations = [
+        # The words of each translation separated by spaces, so they don't need splitting on every request
+        migrations.RunSQL(
+            sql="ALTER TABLE translations ADD COLUMN tokens TEXT;",
+            reverse_sql="ALTER TABLE translations DROP COLUMN tokens;",
+        ),
+        migrations.RunPython(split_translations, migrations.RunPython.noop),
+    ]
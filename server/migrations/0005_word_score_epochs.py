@@ -0,0 +1,46 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0004_translation_tokens'),
+    ]
+
+    operations = [
+        # Store when each word was last seen as UTC epoch seconds so that scoring doesn't have to parse dates
+        migrations.RunSQL(
+            sql="ALTER TABLE word_scores RENAME TO old_word_scores;",
+            reverse_sql="ALTER TABLE old_word_scores RENAME TO word_scores;",
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE word_scores (
+                    language TEXT NOT NULL,
+                    word TEXT NOT NULL,
+                    score FLOAT NOT NULL,
+                    last_seen INTEGER NOT NULL,
+                    PRIMARY KEY (language, word)
+                );""",
+            reverse_sql="DROP TABLE word_scores;",
+        ),
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO word_scores (language, word, score, last_seen)
+                    SELECT language, word, score, CAST(strftime('%s', last_seen) AS INTEGER) FROM old_word_scores;""",
+            reverse_sql="""
+                INSERT INTO old_word_scores (language, word, score, last_seen)
+                    SELECT language, word, score, datetime(last_seen, 'unixepoch') FROM word_scores;""",
+        ),
+        migrations.RunSQL(
+            sql="DROP TABLE old_word_scores;",
+            reverse_sql="""
+                CREATE TABLE old_word_scores (
+                    language TEXT NOT NULL,
+                    word TEXT NOT NULL,
+                    score FLOAT NOT NULL,
+                    last_seen DATETIME NOT NULL,
+                    PRIMARY KEY (language, word)
+                );""",
+        ),
+    ]
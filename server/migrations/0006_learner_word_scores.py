@@ -0,0 +1,48 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0005_word_score_epochs'),
+    ]
+
+    operations = [
+        # Keep separate word scores for each learner. Scores recorded before this belonged to everyone, so
+        # they're kept under the empty learner.
+        migrations.RunSQL(
+            sql="ALTER TABLE word_scores RENAME TO old_word_scores;",
+            reverse_sql="ALTER TABLE old_word_scores RENAME TO word_scores;",
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE word_scores (
+                    learner TEXT NOT NULL,
+                    language TEXT NOT NULL,
+                    word TEXT NOT NULL,
+                    score FLOAT NOT NULL,
+                    last_seen INTEGER NOT NULL,
+                    PRIMARY KEY (learner, language, word)
+                ) WITHOUT ROWID;""",
+            reverse_sql="DROP TABLE word_scores;",
+        ),
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO word_scores (learner, language, word, score, last_seen)
+                    SELECT '', language, word, score, last_seen FROM old_word_scores;""",
+            reverse_sql="""
+                INSERT INTO old_word_scores (language, word, score, last_seen)
+                    SELECT language, word, score, last_seen FROM word_scores WHERE learner = '';""",
+        ),
+        migrations.RunSQL(
+            sql="DROP TABLE old_word_scores;",
+            reverse_sql="""
+                CREATE TABLE old_word_scores (
+                    language TEXT NOT NULL,
+                    word TEXT NOT NULL,
+                    score FLOAT NOT NULL,
+                    last_seen INTEGER NOT NULL,
+                    PRIMARY KEY (language, word)
+                );""",
+        ),
+    ]
@@ -0,0 +1,80 @@
+import random
+import re
+import unicodedata
+import zlib
+
+from django.db import migrations
+
+# A copy of server.dedup.fingerprint as it was when this migration was written, so changes to it don't change
+# what the migration stores
+WORD_PATTERN = re.compile(r"[\w']+")
+BANDS = 12
+ROWS_PER_BAND = 8
+PRIME = (1 << 31) - 1
+_rng = random.Random(0)
+PERMUTATIONS = [(_rng.randrange(1, PRIME), _rng.randrange(PRIME)) for _ in range(BANDS * ROWS_PER_BAND)]
+BAND_MULTIPLIERS = [pow(1000003, ROWS_PER_BAND - 1 - row, 1 << 64) for row in range(ROWS_PER_BAND)]
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text).replace("’", "'").casefold()
+    return " ".join(WORD_PATTERN.findall(text))
+
+
+def fingerprint(english):
+    # The normalized English and its (band, bucket) pairs
+    normalized = normalize(english)
+    words = normalized.split()
+    shingles = {*words, *(f"{first} {second}" for first, second in zip(words, words[1:]))} or {""}
+    hashes = [zlib.crc32(shingle.encode()) % PRIME for shingle in shingles]
+    signature = [min((a * h + b) % PRIME for h in hashes) for a, b in PERMUTATIONS]
+    buckets = [(sum(value * multiplier for value, multiplier in
+                    zip(signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND], BAND_MULTIPLIERS)) % (1 << 64)) >> 1
+               for band in range(BANDS)]
+    return normalized, list(enumerate(buckets))
+
+
+def fingerprint_sentences(apps, schema_editor):
+    # Duplicates that are already stored are left for the compact_sentences command to merge
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT id, language, english FROM sentences WHERE normalized IS NULL")
+        sentences = [(sentence_id, language, *fingerprint(english))
+                     for sentence_id, language, english in cursor.fetchall()]
+        cursor.executemany("UPDATE sentences SET normalized = %s WHERE id = %s",
+                           [(normalized, sentence_id) for sentence_id, _, normalized, _ in sentences])
+        cursor.executemany("INSERT OR IGNORE INTO sentence_fingerprints (language, band, bucket, sentence_id) "
+                           "VALUES (%s, %s, %s, %s)",
+                           [(language, band, bucket, sentence_id) for sentence_id, language, _, buckets in sentences
+                            for band, bucket in buckets])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0006_learner_word_scores'),
+    ]
+
+    operations = [
+        # The English with case and punctuation removed, so sentences differing only in those can be found
+        migrations.RunSQL(
+            sql="ALTER TABLE sentences ADD COLUMN normalized TEXT;",
+            reverse_sql="ALTER TABLE sentences DROP COLUMN normalized;",
+        ),
+        migrations.RunSQL(
+            sql="CREATE INDEX sentences_normalized ON sentences (language, normalized);",
+            reverse_sql="DROP INDEX sentences_normalized;",
+        ),
+        # The MinHash buckets of each sentence's English, to find near duplicates without comparing every pair
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE sentence_fingerprints (
+                    language TEXT NOT NULL,
+                    band INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    sentence_id INTEGER NOT NULL REFERENCES sentences (id),
+                    PRIMARY KEY (language, band, bucket, sentence_id)
+                ) WITHOUT ROWID;""",
+            reverse_sql="DROP TABLE sentence_fingerprints;",
+        ),
+        migrations.RunPython(fingerprint_sentences, migrations.RunPython.noop),
+    ]
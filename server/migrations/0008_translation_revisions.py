@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0007_sentence_fingerprints'),
+    ]
+
+    operations = [
+        # Number each batch of stored translations in order, so a snapshot can tell which translations were
+        # added after it was exported, including those added to sentences it already has. Translations that
+        # are already stored are all in revision 0.
+        migrations.RunSQL(
+            sql="ALTER TABLE translations ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;",
+            reverse_sql="ALTER TABLE translations DROP COLUMN revision;",
+        ),
+        migrations.RunSQL(
+            sql="CREATE INDEX translations_revision ON translations (revision);",
+            reverse_sql="DROP INDEX translations_revision;",
+        ),
+    ]
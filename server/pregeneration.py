@@ -0,0 +1,195 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+
+from server import languagebot
+
+logger = logging.getLogger(__name__)
+
+# Sentences scoring within this distance of the target count towards the supply for a topic
+NEAR_TARGET = 20
+# Top up a topic once it has fewer than this many sentences near the target score
+MIN_SUPPLY = 3
+# Don't ask the LLM to top up the same topic more often than this
+REFILL_INTERVAL = 10 * 60
+WORKERS = 2
+
+# Requests from a user who is waiting jump ahead of background top ups
+COLD = 0
+REFILL = 1
+
+
+@dataclass
+class Job:
+    language: str
+    topic: str
+    priority: int
+    queued_at: float
+    future: Future = field(default_factory=Future)
+    # Resolved with the sentences so far as soon as there's at least one
+    first: Future = field(default_factory=Future)
+    started: bool = False
+
+
+class PregenerationQueue:
+    # Generates sentences for (language, topic) pairs on a background event loop so that requests never
+    # have to wait on the LLM themselves. A pair is only ever queued once at a time.
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._jobs: dict[tuple[str, str], Job] = {}
+        self._last_refill: dict[tuple[str, str], float] = {}
+        self._sequence = itertools.count()
+        self._loop = None
+        self._thread = None
+        self._queue = None
+        self.completed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def _start(self):
+        # Called with the lock held
+        self._loop = asyncio.new_event_loop()
+        self._queue = asyncio.PriorityQueue()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="pregeneration", daemon=True)
+        self._thread.start()
+        # The workers would otherwise inherit the context variables of whichever request started them, such as
+        # its timings or asgiref's record of being in a sync thread
+        for _ in range(self.workers):
+            contextvars.Context().run(asyncio.run_coroutine_threadsafe, self._work(), self._loop)
+
+    def stop(self):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = self._queue = None
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self._cancel_tasks(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def submit(self, language, topic, priority=COLD) -> Future:
+        # Returns a future for the sentences generated for the topic
+        return self._submit(language, topic, priority).future
+
+    def submit_first(self, language, topic, priority=COLD) -> Future:
+        # Returns a future for the first of the sentences generated for the topic, which the rest follow
+        return self._submit(language, topic, priority).first
+
+    def _submit(self, language, topic, priority) -> Job:
+        key = (language, topic)
+        with self._lock:
+            if self._loop is None:
+                self._start()
+
+            job = self._jobs.get(key)
+            if job is not None and (job.started or job.priority <= priority):
+                return job
+
+            if job is None:
+                job = self._jobs[key] = Job(language, topic, priority, time.monotonic())
+                # Nobody waiting on the job is allowed to cancel it for everyone else
+                job.future.set_running_or_notify_cancel()
+                job.first.set_running_or_notify_cancel()
+            else:
+                # Already queued for a refill but now a user is waiting on it, so queue it again at the
+                # higher priority. The worker skips whichever copy it reaches second.
+                job.priority = priority
+
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (priority, next(self._sequence), job))
+            return job
+
+    def refill_if_low(self, language, topic, sentences_with_scores, target_score):
+        supply = sum(1 for _, score in sentences_with_scores if abs(target_score - score) <= NEAR_TARGET)
+        if supply >= MIN_SUPPLY:
+            return False
+
+        key = (language, topic)
+        now = time.monotonic()
+        with self._lock:
+            last_refill = self._last_refill.get(key)
+            if last_refill is not None and now - last_refill < REFILL_INTERVAL:
+                return False
+            # Kept in the order they were refilled so the ones that no longer hold a topic back can be dropped
+            self._last_refill.pop(key, None)
+            self._last_refill[key] = now
+            while True:
+                refilled, refilled_at = next(iter(self._last_refill.items()))
+                if now - refilled_at < REFILL_INTERVAL:
+                    break
+                del self._last_refill[refilled]
+
+        self.submit(language, topic, priority=REFILL)
+        return True
+
+    @staticmethod
+    async def _cancel_tasks():
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _work(self):
+        while True:
+            _, _, job = await self._queue.get()
+            if job.started:
+                continue
+            job.started = True
+
+            lag = time.monotonic() - job.queued_at
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+            def arrived(sentences, job=job):
+                if not job.first.done():
+                    job.first.set_result(list(sentences))
+
+            try:
+                # A request that found the topic empty may only submit after the job that filled it has finished
+                sentences = (await sync_to_async(languagebot.get_topic_sentences)(job.language, job.topic)
+                             if job.priority == COLD else None)
+                if not sentences:
+                    # A refill asks the LLM again rather than replaying the completion the topic's sentences
+                    # came from
+                    sentences = await languagebot.load_sentences_from_llm(job.language, job.topic,
+                                                                          on_sentence=arrived,
+                                                                          fresh=job.priority == REFILL)
+            except Exception as e:
+                self.failed += 1
+                logger.error("Failed to generate sentences for %s %s: %s", job.language, job.topic, e)
+                job.future.set_exception(e)
+                if not job.first.done():
+                    job.first.set_exception(e)
+            else:
+                self.completed += 1
+                job.future.set_result(sentences)
+                arrived(sentences)
+            finally:
+                with self._lock:
+                    del self._jobs[(job.language, job.topic)]
+
+    def metrics(self):
+        now = time.monotonic()
+        with self._lock:
+            waiting = [job for job in self._jobs.values() if not job.started]
+            return {
+                "depth": len(waiting),
+                "in_progress": len(self._jobs) - len(waiting),
+                "oldest_waiting_seconds": max((now - job.queued_at for job in waiting), default=0.0),
+                "last_lag_seconds": self.last_lag,
+                "max_lag_seconds": self.max_lag,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+queue = PregenerationQueue()
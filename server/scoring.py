@@ -0,0 +1,111 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SECONDS_IN_DAY = 60 * 60 * 24
+# Words we don't have a score for yet are treated as if they scored 10 five days ago
+DEFAULT_WORD_SCORE = 10
+DEFAULT_WORD_AGE = 5 * SECONDS_IN_DAY
+# Stored scores bottom out at 0, which the decay would otherwise divide by
+MIN_DECAY_SCORE = 1.0
+
+
+def decay_word_scores(words, word_scores, now) -> list[float]:
+    # word_scores are (word, score, last_seen) rows from the database
+    word_scores = {word: (score, last_seen) for word, score, last_seen in word_scores}
+
+    adjusted_scores = []
+    for word in words:
+        score, last_seen = word_scores.get(word, (DEFAULT_WORD_SCORE, now - DEFAULT_WORD_AGE))
+        adjusted_score = (-100 / max(score, MIN_DECAY_SCORE)) * ((now - last_seen) / SECONDS_IN_DAY) + 100
+        adjusted_scores.append(adjusted_score)
+    return adjusted_scores
+
+
+def calculate_words_score(words: list[str], word_scores: dict[str, float]):
+    # A translation without any words can't be scored
+    if not words:
+        return 0.0
+    return sum(word_scores[word] for word in words) / len(words)
+
+
+def score_sentences_python(sentence_words, word_scores, now) -> list[float]:
+    # sentence_words holds the words of each translation of each sentence. A sentence scores the maximum of
+    # the mean word scores of its translations.
+    words = list(dict.fromkeys(word for translations in sentence_words for words in translations for word in words))
+    scores = dict(zip(words, decay_word_scores(words, word_scores, now)))
+    return [max(calculate_words_score(words, scores) for words in translations) for translations in sentence_words]
+
+
+def score_sentences_numpy(sentence_words, word_scores, now) -> list[float]:
+    # Same as score_sentences_python but with the decay, means and maxima each done as one array operation
+    word_ids = {}
+    token_ids = [word_ids.setdefault(word, len(word_ids))
+                 for translations in sentence_words for words in translations for word in words]
+    translation_lengths = [len(words) for translations in sentence_words for words in translations]
+    sentence_lengths = [len(translations) for translations in sentence_words]
+
+    scores = np.full(len(word_ids), DEFAULT_WORD_SCORE, dtype=np.float64)
+    last_seen = np.full(len(word_ids), now - DEFAULT_WORD_AGE, dtype=np.float64)
+    for word, score, seen in word_scores:
+        i = word_ids.get(word)
+        if i is not None:
+            scores[i] = score
+            last_seen[i] = seen
+
+    decayed = (-100 / np.maximum(scores, MIN_DECAY_SCORE)) * ((now - last_seen) / SECONDS_IN_DAY) + 100
+    token_scores = decayed[np.asarray(token_ids, dtype=np.intp)]
+
+    translation_lengths = np.asarray(translation_lengths, dtype=np.intp)
+    translation_means = np.zeros(len(translation_lengths))
+    has_words = translation_lengths > 0
+    if has_words.any():
+        # reduceat sums from each start up to the next start, so leave out the translations without words
+        starts = (np.cumsum(translation_lengths) - translation_lengths)[has_words]
+        translation_means[has_words] = np.add.reduceat(token_scores, starts) / translation_lengths[has_words]
+
+    sentence_starts = np.cumsum(sentence_lengths, dtype=np.intp) - sentence_lengths
+    return np.maximum.reduceat(translation_means, sentence_starts).tolist() if len(sentence_starts) else []
+
+
+def decay_components(score, last_seen, epoch) -> tuple[float, float]:
+    # The decay is linear in time, so a word's decayed score at now is intercept - slope * (now - epoch), and
+    # so is the sum of a translation's word scores with the sums of its words' slopes and intercepts
+    slope = 100 / max(score, MIN_DECAY_SCORE) / SECONDS_IN_DAY
+    return slope, 100 - slope * (epoch - last_seen)
+
+
+# Words without a score are always DEFAULT_WORD_AGE old, so theirs never decays
+DEFAULT_COMPONENTS = (0.0, 100 - 100 / DEFAULT_WORD_SCORE * DEFAULT_WORD_AGE / SECONDS_IN_DAY)
+
+
+def evaluate_translation(slope, intercept, length, elapsed) -> float:
+    # The mean decayed word score of a translation from the sums of its words' decay components
+    return (intercept - slope * elapsed) / length if length else 0.0
+
+
+def evaluate_sentences_python(slopes, intercepts, lengths, sentence_lengths, elapsed) -> list[float]:
+    # The per translation sums of decay components laid out sentence by sentence, sentence_lengths holding the
+    # number of translations of each. Gives the same scores as score_sentences at epoch + elapsed.
+    scores = []
+    start = 0
+    for count in sentence_lengths:
+        scores.append(max(evaluate_translation(slopes[i], intercepts[i], lengths[i], elapsed)
+                          for i in range(start, start + count)))
+        start += count
+    return scores
+
+
+def evaluate_sentences_numpy(slopes, intercepts, lengths, sentence_lengths, elapsed) -> list[float]:
+    lengths = np.asarray(lengths, dtype=np.float64)
+    means = np.zeros(len(lengths))
+    has_words = lengths > 0
+    means[has_words] = ((np.asarray(intercepts)[has_words] - np.asarray(slopes)[has_words] * elapsed)
+                        / lengths[has_words])
+    sentence_starts = np.cumsum(sentence_lengths, dtype=np.intp) - sentence_lengths
+    return np.maximum.reduceat(means, sentence_starts).tolist() if len(sentence_starts) else []
+
+
+score_sentences = score_sentences_numpy if np is not None else score_sentences_python
+evaluate_sentences = evaluate_sentences_numpy if np is not None else evaluate_sentences_python
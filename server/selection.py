@@ -0,0 +1,195 @@
+import bisect
+import threading
+from collections import deque
+
+from server.cache import LRUCache
+from server.instrumentation import timed
+from server import languagebot
+from server.scoring import DEFAULT_COMPONENTS, decay_components, evaluate_sentences, evaluate_translation
+
+# Rescore a whole topic at least this often as word scores keep decaying between submissions
+REFRESH_INTERVAL = 60
+# Don't pick any of the sentences a learner was shown last in a topic, unless that's all there is
+RECENTLY_SHOWN = 3
+
+
+class SelectionIndex:
+    # The sentences of a topic ordered by one learner's scores for them. Each translation keeps the sums of
+    # its words' decay components, and an inverted index maps each word to the translations containing it. A
+    # submission only rereads the submitted words' scores and resums the translations containing them, and the
+    # decay since the last submission is applied from the sums when ranking, so no request scores the whole
+    # topic from its words again.
+
+    def __init__(self, learner, language, sentences):
+        self.learner = learner
+        self.language = language
+        self.sentences = sentences
+        # The topic's translations one after the other, sentence by sentence
+        self.translation_words = []
+        self.translation_sentence = []
+        self.sentence_lengths = []
+        for i, sentence in enumerate(sentences):
+            translations = sentence.translation_words()
+            self.translation_words.extend(translations)
+            self.translation_sentence.extend([i] * len(translations))
+            self.sentence_lengths.append(len(translations))
+        self.sentence_starts = []
+        start = 0
+        for count in self.sentence_lengths:
+            self.sentence_starts.append(start)
+            start += count
+        self.word_translations = {}
+        for t, words in enumerate(self.translation_words):
+            for word in dict.fromkeys(words):
+                self.word_translations.setdefault(word, []).append(t)
+        # Sums of the decay components of each translation's words, relative to epoch
+        self.slopes = [0.0] * len(self.translation_words)
+        self.intercepts = [0.0] * len(self.translation_words)
+        self.lengths = [len(words) for words in self.translation_words]
+        self.epoch = None
+        # The (slope, intercept) decay components of the learner's scores for the topic's words
+        self.word_components = {}
+        self.changed_words = set()
+        self.scores = [0.0] * len(sentences)
+        # (score, sentence index) pairs in score order
+        self.ordered = []
+        self.refreshed = None
+        self.positions = {sentence.english: i for i, sentence in enumerate(sentences)}
+        self.recent = deque(maxlen=max(0, min(RECENTLY_SHOWN, len(sentences) - 1)))
+        self.lock = threading.Lock()
+
+    def words_changed(self, words):
+        with self.lock:
+            self.changed_words.update(word for word in words if word in self.word_translations)
+
+    def select(self, target, now):
+        # Returns the sentence that wasn't recently shown with the score closest to the target, and its score
+        return self.select_many(target, now, 1)[0]
+
+    @timed("selection")
+    def select_many(self, target, now, count, shown=True):
+        # Returns up to count (sentence, score) pairs, closest to the target first, that weren't recently shown.
+        # There's always at least one. Without shown set they aren't counted as shown, e.g. when the client may
+        # never show them.
+        with self.lock:
+            self._refresh(now)
+            selected = []
+            right = bisect.bisect_left(self.ordered, (target, -1))
+            left = right - 1
+            while len(selected) < count and (left >= 0 or right < len(self.ordered)):
+                if right >= len(self.ordered) or (left >= 0 and
+                                                  target - self.ordered[left][0] <= self.ordered[right][0] - target):
+                    score, i = self.ordered[left]
+                    left -= 1
+                else:
+                    score, i = self.ordered[right]
+                    right += 1
+                if i not in self.recent:
+                    selected.append((score, i))
+            if shown:
+                for _, i in selected:
+                    self._shown(i)
+            return [(self.sentences[i], score) for score, i in selected]
+
+    def shown(self, english):
+        # Count a sentence as shown, e.g. once one that was selected without being counted is submitted
+        i = self.positions.get(english)
+        if i is not None:
+            with self.lock:
+                self._shown(i)
+
+    def _shown(self, i):
+        if i in self.recent:
+            self.recent.remove(i)
+        self.recent.append(i)
+
+    def near(self, target, distance):
+        # The (sentence, score) pairs within distance of the target as of the last select
+        with self.lock:
+            start = bisect.bisect_left(self.ordered, (target - distance, -1))
+            end = bisect.bisect_right(self.ordered, (target + distance, len(self.sentences)))
+            return [(self.sentences[i], score) for score, i in self.ordered[start:end]]
+
+    def _refresh(self, now):
+        if self.refreshed is None or now - self.refreshed >= REFRESH_INTERVAL:
+            # Every so often start again from the database, which has other workers' submissions that neither
+            # words_changed nor the word score store see. Keep the intercepts small so summing them doesn't
+            # lose precision.
+            self.epoch = now
+            self._read_word_components(self.word_translations, fresh=self.refreshed is not None)
+            self._sum_components(range(len(self.translation_words)))
+            self._rank(now)
+        elif self.changed_words:
+            translations = sorted({t for word in self.changed_words for t in self.word_translations[word]})
+            changed = sorted({self.translation_sentence[t] for t in translations})
+            for i in changed:
+                del self.ordered[bisect.bisect_left(self.ordered, (self.scores[i], i))]
+            self._read_word_components(self.changed_words)
+            self._sum_components(translations)
+            elapsed = now - self.epoch
+            for i in changed:
+                start = self.sentence_starts[i]
+                self.scores[i] = max(evaluate_translation(self.slopes[t], self.intercepts[t], self.lengths[t], elapsed)
+                                     for t in range(start, start + self.sentence_lengths[i]))
+                bisect.insort(self.ordered, (self.scores[i], i))
+        self.changed_words.clear()
+
+    def _read_word_components(self, words, fresh=False):
+        words = list(words)
+        for word in words:
+            self.word_components[word] = DEFAULT_COMPONENTS
+        read = languagebot.get_word_scores_from_db if fresh else languagebot.read_word_scores
+        for word, score, last_seen in read(self.learner, self.language, words):
+            self.word_components[word] = decay_components(score, last_seen, self.epoch)
+
+    def _sum_components(self, translations):
+        for t in translations:
+            components = [self.word_components[word] for word in self.translation_words[t]]
+            self.slopes[t] = sum(slope for slope, _ in components)
+            self.intercepts[t] = sum(intercept for _, intercept in components)
+
+    def _rank(self, now):
+        with timed("scoring"):
+            self.scores = evaluate_sentences(self.slopes, self.intercepts, self.lengths, self.sentence_lengths,
+                                             now - self.epoch)
+        self.ordered = sorted((score, i) for i, score in enumerate(self.scores))
+        self.refreshed = now
+
+
+def indexes_size(indexes):
+    # Rough size of a learner's indexes, counting each sentence, translation and distinct word
+    return sum(200 * len(index.sentences) + 100 * len(index.translation_words) + 100 * len(index.word_translations)
+               for index in indexes.values())
+
+
+class SentenceSelector:
+    # Keeps a SelectionIndex for each topic a learner has recently asked for
+
+    def __init__(self, max_learners=10000, max_bytes=64 * 1024 * 1024):
+        # Keyed by (learner, language) so a submission can find all of the learner's topics
+        self.indexes = LRUCache(max_entries=max_learners, max_bytes=max_bytes, sizeof=indexes_size)
+        self._lock = threading.Lock()
+
+    def index(self, learner, language, topic, sentences) -> SelectionIndex:
+        key = (learner, language)
+        with self._lock:
+            topics = self.indexes.get(key) or {}
+            index = topics.get(topic)
+            # The topic's sentences are reloaded when new ones are stored, so start again from those
+            if index is None or index.sentences is not sentences:
+                index = SelectionIndex(learner, language, sentences)
+                topics = {**topics, topic: index}
+                self.indexes.put(key, topics)
+            return index
+
+    def words_changed(self, learner, language, words):
+        for index in (self.indexes.get((learner, language)) or {}).values():
+            index.words_changed(words)
+
+    def shown(self, learner, language, topic, english):
+        index = (self.indexes.get((learner, language)) or {}).get(topic)
+        if index is not None:
+            index.shown(english)
+
+
+selector = SentenceSelector()
@@ -0,0 +1,40 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    # Coalesces concurrent calls for the same key so that only the first caller does the work and the
+    # others wait for its result. The shared result is a concurrent Future so callers can be on any
+    # thread or event loop.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict[object, Future] = {}
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key, function):
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+                # Mark it as running so a cancelled follower can't cancel it for everyone else
+                future.set_running_or_notify_cancel()
+
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        try:
+            result = await function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
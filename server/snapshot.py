@@ -0,0 +1,187 @@
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# A read-only snapshot of the sentences table that every worker process maps into memory, so they share one
+# copy in the page cache instead of each querying SQLite and holding their own. Layout, all little endian:
+#
+#   header        MAGIC, then the HEADER fields: the latest translation revision in the snapshot, the counts of
+#                 the sections below and their offsets
+#   string data   the UTF-8 bytes of every distinct string
+#   string ends   uint32 end offset of each string in the string data
+#   sentences     uint32 (language, topic, english, first translation, translation count) per sentence, ordered
+#                 by (language, topic, english) so each topic is a contiguous range
+#   translations  uint32 (translation, tokens) strings per translation
+#   topics        uint32 (language, topic, first sentence, sentence count) per topic, in order
+#   english       uint32 sentence number of each sentence, ordered by (language, english)
+MAGIC = b"LBSNAP02"
+HEADER = struct.Struct("<QIIIIIQQQQQQ")
+# Stands in for the tokens of translations stored before tokens were
+NO_STRING = 0xFFFFFFFF
+SENTENCE_FIELDS = 5
+TRANSLATION_FIELDS = 2
+TOPIC_FIELDS = 4
+
+
+def write_snapshot(connection, path):
+    # Writes the sentences in the database to a new snapshot at path, replacing any that's there. Returns the
+    # number of sentences written.
+    rows = connection.execute("SELECT revision, language, topic, english, translation, tokens FROM sentences "
+                              "JOIN translations ON translations.sentence_id = sentences.id "
+                              "ORDER BY language, topic, english, translation").fetchall()
+
+    string_ids = {}
+    string_data = bytearray()
+    string_ends = []
+
+    def intern(string):
+        if string is None:
+            return NO_STRING
+        string_id = string_ids.get(string)
+        if string_id is None:
+            string_id = string_ids[string] = len(string_ends)
+            string_data.extend(string.encode("utf-8"))
+            string_ends.append(len(string_data))
+        return string_id
+
+    sentences = []
+    translations = []
+    topics = []
+    english_keys = []
+    revision = 0
+    last_sentence = None
+    for translation_revision, language, topic, english, translation, tokens in rows:
+        revision = max(revision, translation_revision)
+        if (language, english) != last_sentence:
+            last_sentence = (language, english)
+            if not topics or tuple(topics[-1][:2]) != (language, topic):
+                topics.append([language, topic, len(sentences), 0])
+            topics[-1][3] += 1
+            english_keys.append((language, english, len(sentences)))
+            sentences.append([intern(language), intern(topic), intern(english), len(translations), 0])
+        sentences[-1][4] += 1
+        translations.append((intern(translation), intern(tokens)))
+
+    english_keys.sort()
+    sections = [
+        bytes(string_data),
+        struct.pack(f"<{len(string_ends)}I", *string_ends),
+        struct.pack(f"<{len(sentences) * SENTENCE_FIELDS}I", *(field for sentence in sentences for field in sentence)),
+        struct.pack(f"<{len(translations) * TRANSLATION_FIELDS}I",
+                    *(field for translation in translations for field in translation)),
+        struct.pack(f"<{len(topics) * TOPIC_FIELDS}I",
+                    *(field for language, topic, first, count in topics
+                      for field in (intern(language), intern(topic), first, count))),
+        struct.pack(f"<{len(english_keys)}I", *(sentence for _, _, sentence in english_keys)),
+    ]
+
+    # Each section starts on an 8 byte boundary
+    offsets = []
+    position = len(MAGIC) + HEADER.size
+    for section in sections:
+        position += -position % 8
+        offsets.append(position)
+        position += len(section)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(HEADER.pack(revision, len(string_ends), len(sentences), len(translations), len(topics),
+                                len(english_keys), *offsets))
+            for offset, section in zip(offsets, sections):
+                f.write(b"\0" * (offset - f.tell()))
+                f.write(section)
+        # Workers that already have the old snapshot mapped keep reading it until they reopen
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    return len(sentences)
+
+
+class Snapshot:
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a sentence snapshot")
+
+        (self.revision, strings, sentences, translations, topics, english,
+         strings_at, string_ends_at, sentences_at, translations_at, topics_at, english_at) = \
+            HEADER.unpack_from(self._mmap, len(MAGIC))
+        data = memoryview(self._mmap)
+        self._strings = data[strings_at:string_ends_at]
+        self._string_ends = data[string_ends_at:string_ends_at + strings * 4].cast("I")
+        self._sentences = data[sentences_at:sentences_at + sentences * SENTENCE_FIELDS * 4].cast("I")
+        self._translations = data[translations_at:translations_at + translations * TRANSLATION_FIELDS * 4].cast("I")
+        self._topics = data[topics_at:topics_at + topics * TOPIC_FIELDS * 4].cast("I")
+        self._english = data[english_at:english_at + english * 4].cast("I")
+        self.sentence_count = sentences
+        self.topic_count = topics
+
+    def close(self):
+        for view in [self._strings, self._string_ends, self._sentences, self._translations, self._topics,
+                     self._english]:
+            view.release()
+        self._mmap.close()
+
+    def string(self, string_id):
+        if string_id == NO_STRING:
+            return None
+        start = self._string_ends[string_id - 1] if string_id else 0
+        return str(self._strings[start:self._string_ends[string_id]], "utf-8")
+
+    def _sentence_field(self, sentence, field):
+        return self._sentences[sentence * SENTENCE_FIELDS + field]
+
+    def _topic_key(self, topic):
+        return (self.string(self._topics[topic * TOPIC_FIELDS]), self.string(self._topics[topic * TOPIC_FIELDS + 1]))
+
+    def _english_key(self, i):
+        sentence = self._english[i]
+        return self.string(self._sentence_field(sentence, 0)), self.string(self._sentence_field(sentence, 2))
+
+    def translation_rows(self, sentence):
+        # The (translation, tokens) pairs of a sentence
+        first = self._sentence_field(sentence, 3)
+        count = self._sentence_field(sentence, 4)
+        return [(self.string(self._translations[i * TRANSLATION_FIELDS]),
+                 self.string(self._translations[i * TRANSLATION_FIELDS + 1])) for i in range(first, first + count)]
+
+    def topic_sentences(self, language, topic):
+        # (english, translation rows) of each of the topic's sentences, in English order
+        i = bisect_left(range(self.topic_count), (language, topic), key=self._topic_key)
+        if i == self.topic_count or self._topic_key(i) != (language, topic):
+            return []
+        first = self._topics[i * TOPIC_FIELDS + 2]
+        count = self._topics[i * TOPIC_FIELDS + 3]
+        return [(self.string(self._sentence_field(sentence, 2)), self.translation_rows(sentence))
+                for sentence in range(first, first + count)]
+
+    def sentence(self, language, english):
+        # (topic, translation rows) of the sentence, or None
+        i = bisect_left(range(self.sentence_count), (language, english), key=self._english_key)
+        if i == self.sentence_count or self._english_key(i) != (language, english):
+            return None
+        sentence = self._english[i]
+        return self.string(self._sentence_field(sentence, 1)), self.translation_rows(sentence)
+
+
+def open_snapshot(path) -> Snapshot | None:
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return Snapshot(path)
+    except ValueError as e:
+        # e.g. one exported by an older version, which is ignored until it's exported again
+        logger.warning("Not using the sentence snapshot: %s", e)
+        return None
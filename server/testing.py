@@ -0,0 +1,280 @@
+import asyncio
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from difflib import SequenceMatcher
+from importlib import import_module
+from pkgutil import iter_modules
+
+from django.db.migrations import RunSQL
+
+import server.migrations
+from server import languagebot, llmcache, selection
+from server.db import pool
+
+
+def create_schema(db_path, after=None, until=None):
+    # Apply the raw SQL from our migrations so tests and benchmarks can use a throwaway database. The Python
+    # data migrations only backfill existing rows so there's nothing for them to do here.
+    connection = sqlite3.connect(db_path)
+    try:
+        for module_info in sorted(iter_modules(server.migrations.__path__), key=lambda m: m.name):
+            if after is not None and module_info.name <= after:
+                continue
+            if until is not None and module_info.name > until:
+                break
+            migration = import_module(f"server.migrations.{module_info.name}").Migration
+            for operation in migration.operations:
+                if isinstance(operation, RunSQL):
+                    connection.executescript(operation.sql)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+@contextmanager
+def temporary_database():
+    # Point languagebot at an empty database for the duration of the block
+    fd, db_path = tempfile.mkstemp(suffix=".sqlite3")
+    os.close(fd)
+    previous_path = languagebot.DB_PATH
+    previous_llm_cache_mode = languagebot.llm_cache.mode
+    previous_snapshot = languagebot.sentence_snapshot
+    try:
+        create_schema(db_path)
+        languagebot.DB_PATH = db_path
+        # Made up completions mustn't end up in the real LLM cache, nor real ones stand in for them
+        languagebot.llm_cache.mode = llmcache.OFF
+        # The snapshot holds the real database's sentences
+        languagebot.sentence_snapshot = None
+        languagebot.sentence_cache_check.reset()
+        yield db_path
+    finally:
+        languagebot.llm_cache.mode = previous_llm_cache_mode
+        languagebot.sentence_snapshot = previous_snapshot
+        # Write any buffered word scores to the temporary database rather than the next one
+        languagebot.word_score_buffer.stop()
+        languagebot.word_score_buffer.clear()
+        languagebot.word_score_store.clear()
+        languagebot.DB_PATH = previous_path
+        languagebot.topic_cache.clear()
+        languagebot.sentence_cache.clear()
+        languagebot.sentence_cache_check.reset()
+        selection.selector.indexes.clear()
+        pool.close_all()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+
+def make_word(i):
+    return f"w{i}"
+
+
+def make_learner(i):
+    return f"session:learner{i}"
+
+
+def populate(language="italian", topics=1, sentences_per_topic=10, translations_per_sentence=8,
+             words_per_translation=6, vocabulary_size=500, scored_fraction=0.8, learners=1, seed=0):
+    # Fill the current database with synthetic sentences and word scores
+    rng = random.Random(seed)
+    vocabulary = [make_word(i) for i in range(vocabulary_size)]
+    topic_names = [f"topic {t}" for t in range(topics)]
+
+    for topic in topic_names:
+        sentences = []
+        for s in range(sentences_per_topic):
+            translations = [" ".join(rng.choices(vocabulary, k=words_per_translation)) + "."
+                            for _ in range(translations_per_sentence)]
+            sentences.append(languagebot.Sentence(english=f"{topic} sentence {s}", translations=translations,
+                                                  topic=topic))
+        languagebot.store_sentences_in_db(language, sentences)
+
+    now = time.time()
+    word_scores = []
+    for learner in [make_learner(i) for i in range(learners)]:
+        for word in rng.sample(vocabulary, int(vocabulary_size * scored_fraction)):
+            last_seen = int(now - rng.uniform(0, 30) * 24 * 60 * 60)
+            word_scores.append((learner, language, word, rng.uniform(1, 100), last_seen))
+
+    connection = sqlite3.connect(languagebot.DB_PATH)
+    try:
+        connection.executemany("INSERT OR REPLACE INTO word_scores (learner, language, word, score, last_seen) "
+                               "VALUES (?, ?, ?, ?, ?)", word_scores)
+        connection.commit()
+    finally:
+        connection.close()
+
+    return topic_names
+
+
+def fake_sentences(messages, count=3):
+    # Make up a response for a sentence prompt built by languagebot.get_prompt
+    topic = re.search(r"following topic: (.*?)\. ", messages[-1]["content"]).group(1)
+    return languagebot.Sentences(sentences=[
+        languagebot.Sentence(english=f"{topic} sentence {i}", translations=[f"frase {i}", f"la frase {i}"],
+                             topic=topic)
+        for i in range(count)
+    ])
+
+
+class FakeAsyncOpenAI:
+    # Stands in for openai.AsyncOpenAI. Each completion takes `latency` seconds and is built by `respond`.
+
+    def __init__(self, latency=0.0, respond=fake_sentences, chunk_size=16):
+        self.latency = latency
+        self.respond = respond
+        self.chunk_size = chunk_size
+        self.calls = 0
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(parse=self.parse,
+                                                                                     stream=self.stream)))
+
+    async def parse(self, model, messages, response_format, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        parsed = self.respond(messages)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))])
+
+    @asynccontextmanager
+    async def stream(self, model, messages, response_format, **kwargs):
+        self.calls += 1
+
+        async def events():
+            await asyncio.sleep(self.latency)
+            content = self.respond(messages).model_dump_json()
+            for i in range(0, len(content), self.chunk_size):
+                yield SimpleNamespace(type="content.delta", delta=content[i:i + self.chunk_size])
+                await asyncio.sleep(0)
+
+        yield events()
+
+
+class FakeStreamingServer:
+    # A local HTTP server that streams chat completions like the OpenAI API, for use as the base_url of a
+    # real AsyncOpenAI client. With hold set, it stops after the first sentence until release is set.
+
+    def __init__(self, respond=fake_sentences, chunk_size=16, hold=False):
+        self.respond = respond
+        self.chunk_size = chunk_size
+        self.hold = hold
+        self.release = threading.Event()
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.requests += 1
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                content = server.respond(body["messages"]).model_dump_json()
+                first_end = content.index("}") + 1
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for part in [content[:first_end], content[first_end:]]:
+                    for i in range(0, len(part), server.chunk_size):
+                        self.send_chunk({"content": part[i:i + server.chunk_size]}, None)
+                    if server.hold and not server.release.is_set():
+                        server.release.wait(timeout=10)
+                self.send_chunk({}, "stop")
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def send_chunk(self, delta, finish_reason):
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0,
+                         "model": "gpt-4o-mini",
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def count_calls(function):
+    # Patch a languagebot function with a mock that counts its calls but still runs it
+    return mock.patch.object(languagebot, function.__name__, wraps=function)
+
+
+def regex_find_matches_in_strings(str1, str2):
+    # The original regex based word alignment, kept as a reference for the linear time version
+    str2matches = {}
+    str1_words = []
+
+    for word_match in re.finditer(r'[\w\']+', str1):
+        word = word_match.group()
+        str1_idx = word_match.start()
+        prev_str2_idx = str2matches.get(word, -1)
+
+        str2_idx = -1
+
+        # Search the other string for the same word
+        for str2_match in re.finditer(rf"\b{re.escape(word)}\b", str2, re.IGNORECASE):
+            if str2_match.start() > prev_str2_idx:
+                str2_idx = str2_match.start()
+                str2matches[word] = str2_idx
+                break
+
+        str1_words.append((word, str1_idx, str2_idx))
+
+    return str1_words
+
+
+def sequential_find_best_translation(sentence, submission):
+    # The original best translation search that computes the full ratio for every translation, kept as a
+    # reference for the pruned version
+    for translation in sentence.translations:
+        if submission == translation:
+            return translation
+
+    best_translation = None
+    best_translation_score = 0
+
+    for translation in sentence.translations:
+        s = SequenceMatcher(None, translation, submission)
+        if s.ratio() > best_translation_score:
+            best_translation_score = s.ratio()
+            best_translation = translation
+
+    return best_translation
+
+
+def make_translation_variants(rng, count, words=8):
+    # Translations that differ in a few words, like the enumerated gender and formality variants from the LLM
+    base = [f"parola{rng.randrange(50)}" for _ in range(words)]
+    variants = []
+    for _ in range(count):
+        variant = list(base)
+        for _ in range(rng.randint(1, 3)):
+            variant[rng.randrange(words)] = rng.choice(["lui", "lei", "voi", "loro", "tu", "Lei", "noi"])
+        variants.append(" ".join(variant))
+    return variants
+
+
+def make_submission(rng, translation, typos=3, repeat=1):
+    # A submission close to the translation with a few characters changed
+    submission = list(" ".join([translation] * repeat))
+    for _ in range(typos * repeat):
+        submission[rng.randrange(len(submission))] = rng.choice("abcdefghijklmnopqrstuvwxyz ")
+    return "".join(submission)
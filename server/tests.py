@@ -1,3 +1,1086 @@
-from django.test import TestCase
+import asyncio
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from openai import AsyncOpenAI
+
+from server import dedup, instrumentation, languagebot, llmcache, pregeneration, scoring, views
+from server.cache import LRUCache
+from server.db import pool, transaction
+from server.jsonstream import ObjectStreamParser
+from server.llmcache import CompletionCache
+from server.selection import SelectionIndex
+from server.snapshot import Snapshot
+from server.wordstore import WordScoreStore
+from server.writebehind import WordScoreBuffer
+from server.testing import (temporary_database, populate, make_learner, create_schema, count_calls, regex_find_matches_in_strings,
+                            sequential_find_best_translation, make_translation_variants, make_submission,
+                            FakeAsyncOpenAI, FakeStreamingServer, fake_sentences)
+
+LEARNER = make_learner(0)
+
+
+class SentenceScoreTests(SimpleTestCase):
+
+    def test_batched_scores_match_per_translation_scores(self):
+        with temporary_database():
+            topic = populate("italian", sentences_per_topic=5, vocabulary_size=50)[0]
+            sentences = languagebot.get_sentences_from_db("italian", topic)
+
+            scores = languagebot.calculate_sentence_scores(LEARNER, "italian", sentences)
+
+            for sentence, score in scores:
+                expected = max(languagebot.calculate_translation_score(LEARNER, "italian", translation)
+                               for translation in sentence.translations)
+                self.assertAlmostEqual(expected, score, places=3)
+
+    def test_word_scores_are_fetched_in_chunks(self):
+        with temporary_database():
+            words = [f"w{i}" for i in range(languagebot.MAX_QUERY_WORDS * 2 + 5)]
+            languagebot.update_word_scores_in_db(LEARNER, "italian", [(word, 50.0) for word in words])
+
+            self.assertEqual(len(words), len(languagebot.get_word_scores_from_db(LEARNER, "italian", words)))
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def test_connections_are_reused_per_thread(self):
+        with temporary_database() as db_path:
+            connection = pool.connection(db_path)
+            self.assertIs(connection, pool.connection(db_path))
+            self.assertEqual("wal", connection.execute("PRAGMA journal_mode").fetchone()[0])
+
+            other_thread = []
+            thread = threading.Thread(target=lambda: other_thread.append(pool.connection(db_path)))
+            thread.start()
+            thread.join()
+            self.assertIsNot(connection, other_thread[0])
+
+    def test_close_all_reconnects_on_next_use(self):
+        with temporary_database() as db_path:
+            connection = pool.connection(db_path)
+            pool.close_all()
+
+            self.assertIsNot(connection, pool.connection(db_path))
+            self.assertEqual([], languagebot.get_sentences_from_db("italian", "food"))
+
+
+class ColdTopicTests(SimpleTestCase):
+
+    async def test_concurrent_requests_share_one_completion(self):
+        fake_client = FakeAsyncOpenAI(latency=0.2)
+        with temporary_database(), mock.patch.object(languagebot, "async_client", fake_client):
+            start = time.perf_counter()
+            results = await asyncio.gather(*[languagebot.load_sentences_from_llm("italian", "food")
+                                             for _ in range(10)])
+
+            self.assertEqual(1, fake_client.calls)
+            self.assertLess(time.perf_counter() - start, 1.0)
+            self.assertTrue(all(result == results[0] for result in results))
+            self.assertEqual(3, len(languagebot.get_sentences_from_db("italian", "food")))
+
+    async def test_failed_completion_is_shared_and_not_cached(self):
+        def respond(messages):
+            raise RuntimeError("LLM unavailable")
+
+        fake_client = FakeAsyncOpenAI(latency=0.05, respond=respond)
+        with temporary_database(), mock.patch.object(languagebot, "async_client", fake_client):
+            results = await asyncio.gather(*[languagebot.load_sentences_from_llm("italian", "food")
+                                             for _ in range(3)], return_exceptions=True)
+            self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+            self.assertEqual(1, fake_client.calls)
+
+            fake_client.respond = FakeAsyncOpenAI().respond
+            await languagebot.load_sentences_from_llm("italian", "food")
+            self.assertEqual(2, fake_client.calls)
+
+
+
+def post_json(client, path, data):
+    return client.post(path, json.dumps(data), content_type="application/json")
+
+
+class PregenerationTests(SimpleTestCase):
+    # Sessions are stored in Django's database
+    databases = {"default"}
+
+    def setUp(self):
+        self.fake_client = FakeAsyncOpenAI(latency=0.2)
+        self.queue = pregeneration.PregenerationQueue()
+        for patcher in [temporary_database(), mock.patch.object(languagebot, "async_client", self.fake_client),
+                        mock.patch.object(pregeneration, "queue", self.queue)]:
+            patcher.__enter__()
+            self.addCleanup(patcher.__exit__, None, None, None)
+        self.addCleanup(self.queue.stop)
+
+    async def test_get_sentence_view_coalesces_cold_topic(self):
+        responses = await asyncio.gather(*[post_json(self.async_client, "/getsentence",
+                                                     {"language": "italian", "topic": "Food"})
+                                           for _ in range(5)])
+
+        self.assertEqual(1, self.fake_client.calls)
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        self.assertTrue(all(response.json()["english"].startswith("food sentence") for response in responses))
+
+    async def test_get_sentence_view_does_not_wait_longer_than_timeout(self):
+        with mock.patch.object(views, "COLD_TOPIC_TIMEOUT", 0.05):
+            response = await post_json(self.async_client, "/getsentence", {"language": "italian", "topic": "food"})
+        self.assertEqual(202, response.status_code)
+        self.assertEqual({"pending": True}, response.json())
+
+        # The generation carries on in the background and the next request is served from the database
+        await asyncio.wrap_future(self.queue.submit("italian", "food"))
+        response = await post_json(self.async_client, "/getsentence", {"language": "italian", "topic": "food"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, self.fake_client.calls)
+
+    def test_refills_topics_running_low_once_per_interval(self):
+        sentence = languagebot.Sentence(english="hello", translations=["ciao"], topic="food")
+
+        self.assertFalse(self.queue.refill_if_low("italian", "food", [(sentence, 65)] * 3, 65))
+        self.assertTrue(self.queue.refill_if_low("italian", "food", [(sentence, 10)] * 3, 65))
+        self.assertFalse(self.queue.refill_if_low("italian", "food", [(sentence, 10)] * 3, 65))
+
+        self.queue.submit("italian", "food").result(timeout=5)
+        self.assertEqual(1, self.fake_client.calls)
+        self.assertEqual(3, len(languagebot.get_sentences_from_db("italian", "food")))
+
+    def test_refill_times_are_forgotten_once_the_interval_has_passed(self):
+        sentence = languagebot.Sentence(english="hello", translations=["ciao"], topic="food")
+        with (mock.patch.object(self.queue, "submit"),
+              mock.patch.object(pregeneration.time, "monotonic", side_effect=[0, 2, pregeneration.REFILL_INTERVAL + 1])):
+            for topic in ["food", "sport", "travel"]:
+                self.assertTrue(self.queue.refill_if_low("italian", topic, [(sentence, 10)], 65))
+        self.assertEqual([("italian", "sport"), ("italian", "travel")], list(self.queue._last_refill))
+
+    async def test_get_sentence_view_reports_failed_generation(self):
+        def respond(messages):
+            raise RuntimeError("LLM unavailable")
+
+        self.fake_client.respond = respond
+        response = await post_json(self.async_client, "/getsentence", {"language": "italian", "topic": "food"})
+        self.assertEqual(502, response.status_code)
+        self.assertIn("error", response.json())
+
+    def test_refills_ask_the_llm_again(self):
+        completions = itertools.count()
+        self.fake_client.latency = 0
+        self.fake_client.respond = lambda messages: fake_sentences(messages, count=3 * (next(completions) + 1))
+        cache = CompletionCache(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, cache.directory)
+        with mock.patch.object(languagebot, "llm_cache", cache):
+            self.queue.submit("italian", "food").result(timeout=5)
+            self.queue.submit("italian", "food", priority=pregeneration.REFILL).result(timeout=5)
+
+        self.assertEqual(2, self.fake_client.calls)
+        self.assertEqual(6, len(languagebot.get_sentences_from_db("italian", "food")))
+
+    def test_metrics_report_depth_and_lag(self):
+        self.queue.workers = 1
+        first = self.queue.submit("italian", "food")
+        self.queue.submit("italian", "sport")
+        time.sleep(0.05)
+
+        metrics = self.queue.metrics()
+        self.assertEqual(1, metrics["depth"])
+        self.assertEqual(1, metrics["in_progress"])
+        self.assertGreater(metrics["oldest_waiting_seconds"], 0)
+
+        first.result(timeout=5)
+        self.queue.submit("italian", "sport").result(timeout=5)
+        metrics = self.queue.metrics()
+        self.assertEqual(0, metrics["depth"])
+        self.assertEqual(2, metrics["completed"])
+        self.assertGreater(metrics["max_lag_seconds"], 0.1)
+
+        response = self.client.get("/metrics")
+        self.assertEqual(2, response.json()["pregeneration"]["completed"])
+
+
+class StoreSentencesTests(SimpleTestCase):
+
+    def test_reports_inserted_and_duplicate_rows(self):
+        with temporary_database():
+            sentences = [languagebot.Sentence(english="I am happy", translations=["Sono felice"], topic="mood")]
+            self.assertEqual((1, 0), languagebot.store_sentences_in_db("italian", sentences)[:2])
+
+            sentences[0].translations.append("Io sono felice")
+            self.assertEqual((1, 1), languagebot.store_sentences_in_db("italian", sentences)[:2])
+
+    def test_failed_store_writes_nothing(self):
+        with temporary_database():
+            rows = [("italian", "I am happy", "Sono felice", "mood"), ("italian", "I am sad", "Sono triste", ("mood", ))]
+            with self.assertRaises(sqlite3.Error):
+                languagebot.store_sentence_rows(rows)
+
+            self.assertEqual([], languagebot.get_sentences_from_db("italian", "mood"))
+
+
+class UpdateWordScoresTests(SimpleTestCase):
+
+    def test_scores_are_updated_from_current_scores(self):
+        with temporary_database():
+            translation = "Sono felice"
+            matches = languagebot.find_matches_in_strings(translation, "Sono triste")
+            languagebot.update_word_scores(LEARNER, "italian", translation, matches)
+
+            scores = {word: score for word, score, _ in
+                      languagebot.get_word_scores_from_db(LEARNER, "italian", ["Sono", "felice"])}
+            # Unseen words start at a decayed score of 50
+            self.assertAlmostEqual(55.0, scores["Sono"], places=3)
+            self.assertAlmostEqual(45.0, scores["felice"], places=3)
+
+    def test_updates_from_other_workers_are_not_lost(self):
+        with temporary_database(), self.settings(WORD_SCORE_WRITE_BEHIND=False, WORD_SCORE_STORE=True):
+            connection = languagebot.get_connection()
+            now = int(time.time())
+            with transaction(connection):
+                languagebot.upsert_word_score_rows(connection.cursor(), [(LEARNER, "italian", "ciao", 80.0, now)])
+            languagebot.read_word_scores(LEARNER, "italian", ["ciao"])
+            # Another worker's update, which this worker's store doesn't see
+            with transaction(connection):
+                languagebot.upsert_word_score_rows(connection.cursor(), [(LEARNER, "italian", "ciao", 20.0,
+                                                                          now - scoring.SECONDS_IN_DAY)])
+
+            languagebot.update_word_scores(LEARNER, "italian", "ciao",
+                                           languagebot.find_matches_in_strings("ciao", "addio"))
+            (_, score, _), = languagebot.get_word_scores_from_db(LEARNER, "italian", ["ciao"])
+            # Decayed by a day from 20 to 95 before the wrong answer
+            self.assertAlmostEqual(90.0, score, places=1)
+
+class NormalizeSentencesMigrationTests(SimpleTestCase):
+
+    def test_existing_rows_are_copied_to_normalized_tables(self):
+        with temporary_database() as db_path:
+            os.remove(db_path)
+            create_schema(db_path, until="0001_initial")
+            connection = sqlite3.connect(db_path)
+            connection.executemany("INSERT INTO sentences (language, english, translation, topic) VALUES (?, ?, ?, ?)",
+                                   [("italian", "I am happy", "Sono felice", "mood"),
+                                    ("italian", "I am happy", "Io sono felice", "mood"),
+                                    ("french", "I am happy", "Je suis heureux", "mood")])
+            connection.commit()
+            connection.close()
+            create_schema(db_path, after="0001_initial")
+
+            sentence = languagebot.get_sentence_from_db("italian", "I am happy")
+            self.assertEqual(["Io sono felice", "Sono felice"], sentence.translations)
+            self.assertEqual("mood", sentence.topic)
+            self.assertEqual(1, len(languagebot.get_sentences_from_db("french", "mood")))
+
+
+class SentenceCacheTests(SimpleTestCase):
+
+    def test_lru_cache_is_bounded_by_entries_and_bytes(self):
+        cache = LRUCache(max_entries=2, max_bytes=100, sizeof=len)
+        cache.put("a", "x" * 10)
+        cache.put("b", "x" * 10)
+        cache.get("a")
+        cache.put("c", "x" * 10)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual("x" * 10, cache.get("a"))
+
+        cache.put("d", "x" * 95)
+        self.assertEqual(1, len(cache))
+        self.assertEqual({"entries": 1, "bytes": 95, "hits": 2, "misses": 1, "hit_rate": 2 / 3, "evictions": 3},
+                         cache.stats())
+
+    def test_lru_cache_ignores_values_read_before_an_invalidation(self):
+        cache = LRUCache(max_entries=2, max_bytes=100, sizeof=len)
+        version = cache.version
+        cache.pop("a")
+        cache.put("a", "stale", version)
+        self.assertIsNone(cache.get("a"))
+
+    def test_topics_are_served_from_cache_until_sentences_are_stored(self):
+        with temporary_database():
+            sentences = [languagebot.Sentence(english="I am happy", translations=["Sono felice"], topic="mood")]
+            languagebot.store_sentences_in_db("italian", sentences)
+
+            first = languagebot.get_topic_sentences("italian", "mood")
+            with count_calls(languagebot.get_sentences_from_db) as loads:
+                self.assertIs(first, languagebot.get_topic_sentences("italian", "mood"))
+                self.assertIs(first[0], languagebot.get_sentence("italian", "I am happy"))
+                self.assertEqual(0, loads.call_count)
+
+            # The sentence is stored again under another topic which adds a translation to the mood topic
+            sentences = [languagebot.Sentence(english="I am happy", translations=["Io sono felice"], topic="other")]
+            languagebot.store_sentences_in_db("italian", sentences)
+
+            self.assertEqual(["Io sono felice", "Sono felice"],
+                             languagebot.get_topic_sentences("italian", "mood")[0].translations)
+            self.assertEqual(["Io sono felice", "Sono felice"],
+                             languagebot.get_sentence("italian", "I am happy").translations)
+
+    def test_sentences_stored_by_other_processes_are_seen_after_the_check_interval(self):
+        with temporary_database() as db_path:
+            sentences = [languagebot.Sentence(english="I am happy", translations=["Sono felice"], topic="mood")]
+            languagebot.store_sentences_in_db("italian", sentences)
+            self.assertEqual(["Sono felice"], languagebot.get_topic_sentences("italian", "mood")[0].translations)
+
+            # Another process adds a translation, which doesn't invalidate this process's caches
+            connection = sqlite3.connect(db_path)
+            connection.execute("INSERT INTO translations (sentence_id, translation, tokens, revision) "
+                               "SELECT id, 'Io sono felice', 'Io sono felice', 2 FROM sentences")
+            connection.commit()
+            connection.close()
+            self.assertEqual(["Sono felice"], languagebot.get_topic_sentences("italian", "mood")[0].translations)
+
+            later = time.monotonic() + languagebot.sentence_cache_check.interval
+            with mock.patch("server.cache.time.monotonic", return_value=later):
+                self.assertEqual(["Io sono felice", "Sono felice"],
+                                 languagebot.get_sentence("italian", "I am happy").translations)
+                self.assertEqual(["Io sono felice", "Sono felice"],
+                                 languagebot.get_topic_sentences("italian", "mood")[0].translations)
+
+
+class StoredTokensTests(SimpleTestCase):
+
+    def test_translation_words_are_loaded_with_sentences(self):
+        with temporary_database():
+            sentences = [languagebot.Sentence(english="I want water", translations=["Voglio dell'acqua."],
+                                              topic="food")]
+            languagebot.store_sentences_in_db("italian", sentences)
+
+            with mock.patch.object(languagebot, "split_words") as split_words:
+                sentence = languagebot.get_sentence_from_db("italian", "I want water")
+                self.assertEqual([["Voglio", "dell'acqua"]], sentence.translation_words())
+                self.assertEqual([["voglio", "dell'acqua"]], sentence.translation_folded_words())
+                split_words.assert_not_called()
+
+    def test_translation_words_are_split_when_not_stored(self):
+        sentence = languagebot.Sentence(english="I want water", translations=["Voglio dell'acqua."], topic="food")
+        self.assertEqual(["Voglio", "dell'acqua"], sentence.words_of("Voglio dell'acqua."))
+
+
+class WordAlignmentTests(SimpleTestCase):
+
+    # Includes words that appear inside others, like "tu" in "tutto" and "che" in "perché", but not next to an
+    # apostrophe, where the reference's \b matched "dell" or "acqua" inside "dell'acqua" and
+    # find_matches_in_strings only matches whole words
+    vocabulary = ["Voglio", "voglio", "che", "tu", "vada", "Vada", "andiate", "dell'acqua", "Je", "suis",
+                  "heureux", "heureuse", "Konnichiwa", "genki", "ogenki", "città", "CITTÀ", "perché", "l'amico",
+                  "tutto", "Tutti", "ché"]
+
+    def assert_equivalent(self, str1, str2):
+        self.assertEqual(regex_find_matches_in_strings(str1, str2), languagebot.find_matches_in_strings(str1, str2))
+        str1_words, str2_words, _ = languagebot.find_matches_with_positions(str1, str2)
+        self.assertEqual(regex_find_matches_in_strings(str1, str2), str1_words)
+        self.assertEqual(regex_find_matches_in_strings(str2, str1), str2_words)
+
+    def test_matches_regex_alignment_on_examples(self):
+        examples = [
+            ("Voglio che tu vada.", "Voglio che vada"),
+            ("Voglio che tu vada.", "voglio che tu VADA"),
+            ("Je suis heureux", "Je suis heureuse"),
+            ("che che che", "che"),
+            ("che", "che che che"),
+            ("Che che", "che Che"),
+            ("Voglio dell'acqua, perché ho sete.", "voglio dell'acqua perche ho sete"),
+            ("", "Voglio che tu vada."),
+            ("Konnichiwa, ogenki desu ka?", "Konnichiwa genki desu ka"),
+            ("tu sei tutto", "tutto tu"),
+            ("che", "perché che"),
+        ]
+        for str1, str2 in examples:
+            with self.subTest(str1=str1, str2=str2):
+                self.assert_equivalent(str1, str2)
+
+    def test_matches_regex_alignment_on_random_sentences(self):
+        rng = random.Random(0)
+        punctuation = [" ", " ", " ", ", ", "! ", "? ", " - ", ". "]
+        for _ in range(500):
+            str1, str2 = ("".join(word + rng.choice(punctuation)
+                                  for word in rng.choices(self.vocabulary, k=rng.randint(0, 12)))
+                          for _ in range(2))
+            with self.subTest(str1=str1, str2=str2):
+                self.assert_equivalent(str1, str2)
+
+    def test_uses_pre_split_words(self):
+        translation = "Voglio dell'acqua, perché ho sete."
+        sentence = languagebot.Sentence(english="I want water", translations=[translation], topic="food")
+        self.assertEqual(languagebot.find_matches_with_positions(translation, "voglio acqua"),
+                         languagebot.find_matches_with_positions(translation, "voglio acqua",
+                                                                 sentence.words_of(translation),
+                                                                 sentence.folded_words_of(translation)))
+
+    def test_only_whole_words_match(self):
+        self.assertEqual([("a", 0, -1)], languagebot.find_matches_in_strings("a", "ab"))
+        self.assertEqual([("l'", 0, -1)], languagebot.find_matches_in_strings("l'", "l'acqua"))
+        # The regex alignment found words either side of an apostrophe inside another word
+        for word, position in [("dell", 0), ("acqua", 5)]:
+            self.assertEqual([(word, 0, position)], regex_find_matches_in_strings(word, "dell'acqua"))
+            self.assertEqual([(word, 0, -1)], languagebot.find_matches_in_strings(word, "dell'acqua"))
+
+
+class BestTranslationTests(SimpleTestCase):
+
+    def assert_same_as_sequential(self, translations, submission):
+        sentence = languagebot.Sentence(english="english", translations=translations, topic="topic")
+        self.assertEqual(sequential_find_best_translation(sentence, submission),
+                         languagebot.find_best_translation(sentence, submission))
+
+    def test_matches_sequential_search(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            translations = make_translation_variants(rng, rng.randint(1, 60), words=rng.randint(1, 8))
+            submission = make_submission(rng, rng.choice(translations), typos=rng.randint(0, 5),
+                                         repeat=rng.choice([1, 1, 3]))
+            with self.subTest(translations=translations, submission=submission):
+                self.assert_same_as_sequential(translations, submission)
+
+    def test_ties_go_to_first_translation(self):
+        self.assert_same_as_sequential(["ab", "ba", "ab"], "a")
+        self.assert_same_as_sequential(["xyz", "abc", "abd"], "ab")
+        self.assert_same_as_sequential(["abc", "abc"], "abd")
+
+    def test_no_similarity_finds_nothing(self):
+        self.assert_same_as_sequential(["abc", "def"], "xyz")
+        self.assert_same_as_sequential(["abc", "def"], "")
+
+
+@skipIf(scoring.np is None, "NumPy is not installed")
+class VectorizedScoringTests(SimpleTestCase):
+
+    def test_numpy_scores_match_python_scores(self):
+        rng = random.Random(0)
+        now = time.time()
+        vocabulary = [f"w{i}" for i in range(100)]
+        word_scores = [(word, rng.choice([0.0, rng.uniform(0, 100)]), int(now - rng.uniform(0, 60) * 86400))
+                       for word in rng.sample(vocabulary, 70)]
+
+        for _ in range(50):
+            sentence_words = [[rng.choices(vocabulary, k=rng.randint(0, 10)) for _ in range(rng.randint(1, 10))]
+                              for _ in range(rng.randint(0, 20))]
+            python_scores = scoring.score_sentences_python(sentence_words, word_scores, now)
+            numpy_scores = scoring.score_sentences_numpy(sentence_words, word_scores, now)
+
+            self.assertEqual(len(python_scores), len(numpy_scores))
+            for python_score, numpy_score in zip(python_scores, numpy_scores):
+                self.assertAlmostEqual(python_score, numpy_score, places=6)
+
+    def test_numpy_evaluation_matches_python_evaluation(self):
+        rng = random.Random(0)
+        sentence_lengths = [rng.randint(1, 5) for _ in range(30)]
+        translations = sum(sentence_lengths)
+        slopes = [rng.uniform(0, 0.01) for _ in range(translations)]
+        intercepts = [rng.uniform(0, 800) for _ in range(translations)]
+        lengths = [rng.randint(0, 8) for _ in range(translations)]
+
+        self.assertEqual(scoring.evaluate_sentences_python(slopes, intercepts, lengths, sentence_lengths, 5000.0),
+                         scoring.evaluate_sentences_numpy(slopes, intercepts, lengths, sentence_lengths, 5000.0))
+
+
+class LearnerWordScoreTests(SimpleTestCase):
+    databases = {"default"}
+
+    def test_learners_have_separate_scores(self):
+        with temporary_database():
+            languagebot.update_word_scores_in_db("session:a", "italian", [("ciao", 80.0)])
+            languagebot.update_word_scores_in_db("session:b", "italian", [("ciao", 20.0)])
+
+            self.assertEqual(80.0, languagebot.get_word_scores_from_db("session:a", "italian", ["ciao"])[0][1])
+            self.assertEqual(20.0, languagebot.get_word_scores_from_db("session:b", "italian", ["ciao"])[0][1])
+            self.assertEqual([], languagebot.get_word_scores_from_db("session:c", "italian", ["ciao"]))
+
+    def test_submissions_update_the_session_learner(self):
+        with temporary_database():
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="Hello", translations=["Ciao"], topic="greetings")])
+
+            response = post_json(self.client, "/submitsentence",
+                                 {"language": "italian", "english": "Hello", "submission": "Ciao"})
+            self.assertTrue(response.json()["correct"])
+
+            learner = f"session:{self.client.session.session_key}"
+            self.assertEqual(1, len(languagebot.get_word_scores_from_db(learner, "italian", ["Ciao"])))
+
+            # The same browser keeps its scores and other browsers start afresh
+            post_json(self.client, "/submitsentence", {"language": "italian", "english": "Hello", "submission": "Cia"})
+            self.assertEqual(learner, f"session:{self.client.session.session_key}")
+            self.assertEqual([], languagebot.get_word_scores_from_db("", "italian", ["Ciao"]))
+
+
+class WriteBehindTests(SimpleTestCase):
+
+    def stored_scores(self, db_path):
+        connection = sqlite3.connect(db_path)
+        try:
+            return {word: score for word, score in connection.execute("SELECT word, score FROM word_scores")}
+        finally:
+            connection.close()
+
+    def test_updates_are_visible_before_they_are_flushed(self):
+        with temporary_database() as db_path, self.settings(WORD_SCORE_WRITE_BEHIND=True):
+            matches = languagebot.find_matches_in_strings("Sono felice", "Sono triste")
+            languagebot.update_word_scores(LEARNER, "italian", "Sono felice", matches)
+            languagebot.update_word_scores(LEARNER, "italian", "Sono felice", matches)
+
+            self.assertEqual({}, self.stored_scores(db_path))
+            scores = {word: score for word, score, _ in
+                      languagebot.get_word_scores_from_db(LEARNER, "italian", ["Sono", "felice"])}
+            # The second submission saw the first one's scores, just seen and so barely decayed
+            self.assertAlmostEqual(100.0, scores["Sono"], places=3)
+            self.assertAlmostEqual(95.0, scores["felice"], places=3)
+
+            languagebot.word_score_buffer.flush()
+            stored = self.stored_scores(db_path)
+            self.assertAlmostEqual(100.0, stored["Sono"], places=3)
+            # Both submissions were merged into one entry per word
+            self.assertEqual(2, languagebot.word_score_buffer.metrics()["last_batch_size"])
+
+    def test_failed_flushes_keep_newer_entries(self):
+        rows = []
+        buffer = WordScoreBufferForTests(rows)
+        buffer.add(LEARNER, "italian", [("ciao", 50.0)], 1)
+        buffer.fail = True
+        buffer.flush()
+        buffer.flush()
+        # Backing off while the database is locked
+        self.assertEqual(4 * buffer.flush_interval, buffer.retry_interval())
+        buffer.add(LEARNER, "italian", [("ciao", 55.0), ("sono", 45.0)], 2)
+        buffer.fail = False
+        buffer.stop()
+
+        self.assertEqual([(LEARNER, "italian", "ciao", 55.0, 2), (LEARNER, "italian", "sono", 45.0, 2)], sorted(rows))
+        self.assertEqual(2, buffer.failed_flushes)
+        self.assertEqual(0, buffer.metrics()["pending"])
+        self.assertEqual(buffer.flush_interval, buffer.retry_interval())
+
+
+class WordScoreBufferForTests(WordScoreBuffer):
+
+    def __init__(self, rows):
+        super().__init__(self.write_rows, flush_interval=10)
+        self.rows = rows
+        self.fail = False
+
+    def write_rows(self, rows):
+        if self.fail:
+            raise sqlite3.OperationalError("database is locked")
+        self.rows.extend(rows)
+
+
+class SelectionIndexTests(SimpleTestCase):
+
+    def test_selection_matches_a_full_sort(self):
+        with temporary_database():
+            topic = populate("italian", sentences_per_topic=30, vocabulary_size=60)[0]
+            sentences = languagebot.get_sentences_from_db("italian", topic)
+            now = time.time()
+
+            index = SelectionIndex(LEARNER, "italian", sentences)
+            sentence, score = index.select(views.TARGET_SCORE, now)
+
+            sentence_words = [sentence.translation_words() for sentence in sentences]
+            words = {word for translations in sentence_words for words in translations for word in words}
+            scores = scoring.score_sentences(sentence_words,
+                                             languagebot.get_word_scores_from_db(LEARNER, "italian", words), now)
+            closest = min(abs(views.TARGET_SCORE - score) for score in scores)
+            self.assertAlmostEqual(closest, abs(views.TARGET_SCORE - score))
+            # Summing the words' decay components rounds a little differently to averaging their decayed scores
+            for expected, (actual, _) in zip(sorted(scores), index.ordered):
+                self.assertAlmostEqual(expected, actual, places=6)
+
+    def test_recently_shown_sentences_are_skipped(self):
+        with temporary_database():
+            topic = populate("italian", sentences_per_topic=5, vocabulary_size=40)[0]
+            sentences = languagebot.get_sentences_from_db("italian", topic)
+            index = SelectionIndex(LEARNER, "italian", sentences)
+
+            shown = [index.select(views.TARGET_SCORE, 0)[0].english for _ in range(4)]
+            self.assertEqual(4, len(set(shown)))
+            # Once the topic runs out we go back to the sentences shown longest ago
+            self.assertNotIn(index.select(views.TARGET_SCORE, 0)[0].english, shown[1:])
+
+    def test_changed_words_are_rescored(self):
+        with temporary_database():
+            topic = populate("italian", sentences_per_topic=20, vocabulary_size=40)[0]
+            sentences = languagebot.get_sentences_from_db("italian", topic)
+            now = time.time()
+            index = SelectionIndex(LEARNER, "italian", sentences)
+            index.select(views.TARGET_SCORE, now)
+
+            words = sentences[0].translation_words()[0]
+            languagebot.update_word_scores_in_db(LEARNER, "italian", [(word, 100.0) for word in words])
+            index.words_changed(words)
+            with count_calls(languagebot.read_word_scores) as lookups:
+                index.select(views.TARGET_SCORE, now)
+
+            self.assertEqual(1, lookups.call_count)
+            fresh = SelectionIndex(LEARNER, "italian", sentences)
+            fresh.select(views.TARGET_SCORE, now)
+            self.assertEqual(fresh.ordered, index.ordered)
+
+    def test_topic_is_rescored_from_the_database_every_refresh_interval(self):
+        with temporary_database():
+            topic = populate("italian", sentences_per_topic=20, vocabulary_size=40)[0]
+            sentences = languagebot.get_sentences_from_db("italian", topic)
+            now = time.time()
+            index = SelectionIndex(LEARNER, "italian", sentences)
+            index.select(views.TARGET_SCORE, now)
+
+            # Another worker's submission, which neither words_changed nor the word score store are told about
+            connection = languagebot.get_connection()
+            with transaction(connection):
+                languagebot.upsert_word_scores(connection.cursor(), LEARNER, "italian",
+                                               [(word, 100.0) for word in sentences[0].translation_words()[0]])
+            scores = list(index.scores)
+            with count_calls(languagebot.get_word_scores_from_db) as lookups:
+                index.select(views.TARGET_SCORE, now + 1)
+                self.assertEqual(0, lookups.call_count)
+                self.assertEqual(scores, index.scores)
+
+                later = now + 3 * 24 * 60 * 60
+                index.select(views.TARGET_SCORE, later)
+                self.assertEqual(1, lookups.call_count)
+
+            sentence_words = [sentence.translation_words() for sentence in sentences]
+            words = {word for translations in sentence_words for words in translations for word in words}
+            expected = scoring.score_sentences(sentence_words,
+                                               languagebot.get_word_scores_from_db(LEARNER, "italian", words), later)
+            for expected_score, actual_score in zip(expected, index.scores):
+                self.assertAlmostEqual(expected_score, actual_score, places=6)
+
+class StreamingGenerationTests(SimpleTestCase):
+
+    def test_objects_are_parsed_across_chunk_boundaries(self):
+        document = json.dumps({"sentences": [
+            {"english": 'He said "}{[" \\ ok', "translations": ["a]", "b"], "topic": "t"},
+            {"english": "Bye", "translations": [], "topic": "t"}]})
+        for chunk_size in [1, 2, 5, len(document)]:
+            parser = ObjectStreamParser(depth=2)
+            objects = []
+            for i in range(0, len(document), chunk_size):
+                objects.extend(parser.feed(document[i:i + chunk_size]))
+            self.assertEqual(json.loads(document)["sentences"], objects)
+
+    def test_first_sentence_is_served_before_the_batch_completes(self):
+        queue = pregeneration.PregenerationQueue()
+        self.addCleanup(queue.stop)
+        with (temporary_database(), FakeStreamingServer(hold=True) as server,
+              mock.patch.object(languagebot, "async_client", AsyncOpenAI(api_key="test", base_url=server.base_url))):
+            first = queue.submit_first("italian", "food")
+            generated = queue.submit("italian", "food")
+
+            self.assertEqual(["food sentence 0"], [sentence.english for sentence in first.result(timeout=10)])
+            self.assertFalse(generated.done())
+            self.assertEqual(1, len(languagebot.get_sentences_from_db("italian", "food")))
+
+            server.release.set()
+            self.assertEqual(3, len(generated.result(timeout=10)))
+            self.assertEqual(3, len(languagebot.get_sentences_from_db("italian", "food")))
+            self.assertEqual(1, server.requests)
+
+
+class LLMCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    async def test_completions_are_reused(self):
+        fake_client = FakeAsyncOpenAI()
+        cache = CompletionCache(self.directory)
+        with (temporary_database(), mock.patch.object(languagebot, "async_client", fake_client),
+              mock.patch.object(languagebot, "llm_cache", cache)):
+            first = await languagebot.get_sentences_from_llm_async("italian", "food")
+            self.assertEqual(first, await languagebot.get_sentences_from_llm_async("italian", "food"))
+            await languagebot.get_sentences_from_llm_async("italian", "sport")
+
+            # Streaming shares the same entries
+            with self.settings(LLM_STREAMING=True):
+                streamed = [sentence async for sentence in languagebot.stream_sentences_from_llm("italian", "food")]
+            self.assertEqual(first, streamed)
+
+            self.assertEqual(2, fake_client.calls)
+            self.assertEqual({"hits": 2, "misses": 2, "writes": 2}, {key: cache.stats()[key]
+                                                                     for key in ["hits", "misses", "writes"]})
+
+            cache.mode = llmcache.REPLAY
+            await languagebot.get_sentences_from_llm_async("italian", "food")
+            with self.assertRaises(llmcache.LLMCacheMiss):
+                await languagebot.get_sentences_from_llm_async("italian", "music")
+            self.assertEqual(2, fake_client.calls)
+
+    def test_entries_expire_and_are_evicted(self):
+        cache = CompletionCache(self.directory, max_entries=2, ttl=60)
+        messages = [[{"role": "user", "content": f"topics {i}"}] for i in range(3)]
+        for i, message in enumerate(messages):
+            cache.put("model", message, languagebot.Topics, languagebot.Topics(topics=[str(i)]))
+            # Make sure the entries are ordered by age
+            path = cache.path(cache.key("model", message, languagebot.Topics))
+            os.utime(path, (time.time() - 10 + i, time.time() - 10 + i))
+
+        cache.evict()
+        self.assertEqual(2, len(cache.entries()))
+        self.assertIsNone(cache.get("model", messages[0], languagebot.Topics))
+        self.assertEqual(["2"], cache.get("model", messages[2], languagebot.Topics).topics)
+
+        with mock.patch.object(llmcache.time, "time", return_value=time.time() + 120):
+            self.assertIsNone(cache.get("model", messages[2], languagebot.Topics))
+
+    def test_entries_are_only_listed_when_the_cache_is_full(self):
+        cache = CompletionCache(self.directory, max_entries=10)
+        with mock.patch.object(cache, "entries", wraps=cache.entries) as listings:
+            for i in range(20):
+                cache.put("model", [{"role": "user", "content": f"topics {i}"}], languagebot.Topics,
+                          languagebot.Topics(topics=[str(i)]))
+        # Counted at the first put, then each time it filled up again, which was every other put as a tenth of
+        # ten entries is one
+        self.assertEqual(6, listings.call_count)
+        self.assertEqual(10, len(cache.entries()))
+
+
+class PregenerateCommandTests(SimpleTestCase):
+
+    def test_generates_missing_topics_and_skips_populated_ones(self):
+        fake_client = FakeAsyncOpenAI(latency=0.05)
+        with temporary_database(), mock.patch.object(languagebot, "async_client", fake_client):
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="Hello", translations=["Ciao"], topic="greetings")])
+
+            out = io.StringIO()
+            call_command("pregenerate", languages=["italian", "french"], topics=["Food ", "greetings"],
+                         workers=2, requests_per_minute=6000, stdout=out)
+
+            self.assertEqual(3, fake_client.calls)
+            self.assertEqual(3, len(languagebot.get_sentences_from_db("french", "food")))
+            self.assertEqual(1, languagebot.count_topic_sentences("italian", "greetings"))
+            self.assertIn("Generated 3 topics (9 sentences)", out.getvalue())
+            self.assertIn("skipped 1 already populated", out.getvalue())
+
+            # Running it again finds everything done
+            call_command("pregenerate", languages=["italian", "french"], topics=["food", "greetings"],
+                         stdout=io.StringIO())
+            self.assertEqual(3, fake_client.calls)
+
+    def test_topics_are_not_streamed(self):
+        # A streamed topic that was interrupted would keep the sentences that had arrived and be skipped next time
+        fake_client = FakeAsyncOpenAI()
+        with (temporary_database(), mock.patch.object(languagebot, "async_client", fake_client),
+              mock.patch.object(fake_client.beta.chat.completions, "stream", side_effect=AssertionError),
+              self.settings(LLM_STREAMING=True)):
+            call_command("pregenerate", languages=["italian"], topics=["food"], stdout=io.StringIO())
+            self.assertEqual(3, languagebot.count_topic_sentences("italian", "food"))
+
+class LoadTestCommandTests(SimpleTestCase):
+
+    def test_results_are_saved_for_each_endpoint_and_level(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            call_command("loadtest", languages=1, topics=2, sentences=5, concurrency=[1, 2], requests=6,
+                         label="test", output=output, stdout=io.StringIO())
+            with open(output) as f:
+                results = json.load(f)
+
+        self.assertEqual("test", results["label"])
+        self.assertEqual([("/getsentence", 1), ("/submitsentence", 1), ("/getsentence", 2), ("/submitsentence", 2)],
+                         [(result["endpoint"], result["concurrency"]) for result in results["results"]])
+        for result in results["results"]:
+            self.assertEqual(6, result["requests"])
+            self.assertEqual(0, result["errors"])
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+            self.assertGreater(result["queries_per_request"], 0)
+
+
+class InstrumentationTests(SimpleTestCase):
+    databases = {"default"}
+
+    def test_requests_report_their_timing_breakdown(self):
+        with temporary_database(), mock.patch.object(pregeneration.queue, "refill_if_low"):
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="Hello", translations=["Ciao"], topic="greetings")])
+            queries = instrumentation.metrics.queries
+
+            response = post_json(self.client, "/getsentence", {"language": "italian", "topic": "greetings"})
+            timing = dict(metric.split(";", 1) for metric in response["Server-Timing"].split(", "))
+            self.assertEqual({"db", "selection", "scoring", "queries", "total"}, set(timing))
+            self.assertRegex(timing["queries"], r'desc="[1-9]\d* queries')
+            self.assertGreater(instrumentation.metrics.queries, queries)
+
+            response = post_json(self.client, "/submitsentence",
+                                 {"language": "italian", "english": "Hello", "submission": "Ciao"})
+            self.assertIn("matching;dur=", response["Server-Timing"])
+
+            metrics = self.client.get("/metrics").json()["requests"]
+            self.assertGreaterEqual(metrics["requests"], 2)
+            self.assertGreater(metrics["phases"]["matching"]["count"], 0)
+
+
+class SubmissionPrefetchTests(SimpleTestCase):
+    databases = {"default"}
+
+    def test_submissions_return_the_next_sentences(self):
+        with temporary_database(), mock.patch.object(pregeneration.queue, "refill_if_low"):
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english=english, translations=[translation], topic="greetings")
+                for english, translation in [("Hello", "Ciao"), ("Good morning", "Buongiorno"),
+                                             ("Good evening", "Buonasera"), ("Goodbye", "Arrivederci")]])
+
+            english = post_json(self.client, "/getsentence",
+                                {"language": "italian", "topic": "greetings"}).json()["english"]
+            result = post_json(self.client, "/submitsentence",
+                               {"language": "italian", "english": english, "submission": "Ciao", "topic": "Greetings",
+                                "prefetch": 2}).json()
+
+            self.assertEqual(2, len(set(result["next"])))
+            self.assertNotIn(english, result["next"])
+
+            result = post_json(self.client, "/submitsentence",
+                               {"language": "italian", "english": result["next"][0], "submission": "Ciao"}).json()
+            self.assertNotIn("next", result)
+            self.assertEqual(400, post_json(self.client, "/submitsentence",
+                                            {"language": "italian", "english": "Hello", "submission": "Ciao",
+                                             "prefetch": "some"}).status_code)
+
+    def test_prefetched_sentences_count_as_shown_once_submitted(self):
+        with temporary_database(), mock.patch.object(pregeneration.queue, "refill_if_low"):
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english=english, translations=[translation], topic="greetings")
+                for english, translation in [("Hello", "Ciao"), ("Good morning", "Buongiorno"),
+                                             ("Good evening", "Buonasera"), ("Goodbye", "Arrivederci")]])
+
+            english = post_json(self.client, "/getsentence",
+                                {"language": "italian", "topic": "greetings"}).json()["english"]
+            first, second = post_json(self.client, "/submitsentence",
+                                      {"language": "italian", "english": english, "submission": "Ciao",
+                                       "topic": "greetings", "prefetch": 2}).json()["next"]
+            result = post_json(self.client, "/submitsentence",
+                               {"language": "italian", "english": first, "submission": "Ciao", "topic": "greetings",
+                                "prefetch": 2}).json()
+
+            # The second prefetched sentence was never submitted so it can be picked again
+            self.assertIn(second, result["next"])
+            self.assertNotIn(first, result["next"])
+            self.assertNotIn(english, result["next"])
+
+    def test_invalid_topics_fall_back_to_the_sentence_topic(self):
+        with temporary_database(), mock.patch.object(pregeneration.queue, "refill_if_low"):
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english=english, translations=[translation], topic="greetings")
+                for english, translation in [("Hello", "Ciao"), ("Goodbye", "Arrivederci")]])
+
+            for topic in [None, 3, ["greetings"], " "]:
+                response = post_json(self.client, "/submitsentence",
+                                     {"language": "italian", "english": "Hello", "submission": "Ciao", "topic": topic,
+                                      "prefetch": 1})
+                self.assertEqual(200, response.status_code)
+                self.assertEqual(["Goodbye"], response.json()["next"])
+
+
+class WordScoreStoreTests(SimpleTestCase):
+
+    def test_scores_are_read_from_memory_once_loaded(self):
+        with temporary_database(), self.settings(WORD_SCORE_STORE=True, WORD_SCORE_WRITE_BEHIND=True):
+            languagebot.update_word_scores_in_db(LEARNER, "italian", [("ciao", 80.0), ("sono", 20.0)])
+
+            store = languagebot.word_score_store
+            with mock.patch.object(store, "load", wraps=store.load) as loads:
+                self.assertEqual({"ciao": 80.0}, {word: score for word, score, _ in
+                                                  languagebot.read_word_scores(LEARNER, "italian", ["ciao", "nuovo"])})
+                matches = languagebot.find_matches_in_strings("Ciao", "Ciao")
+                languagebot.update_word_scores(LEARNER, "italian", "Ciao", matches)
+                self.assertEqual(1, len(languagebot.read_word_scores(LEARNER, "italian", ["Ciao"])))
+            self.assertEqual(1, loads.call_count)
+
+            # The database catches up once the write behind buffer is flushed
+            languagebot.word_score_buffer.flush()
+            languagebot.word_score_store.clear()
+            self.assertEqual(languagebot.get_word_scores_from_db(LEARNER, "italian", ["Ciao", "ciao", "sono"]),
+                             languagebot.read_word_scores(LEARNER, "italian", ["Ciao", "ciao", "sono"]))
+
+    def test_large_vocabularies_are_compact(self):
+        store = WordScoreStore(lambda learner, language: [(f"w{i}", 50.0, i) for i in range(100000)])
+        self.assertEqual([("w99999", 50.0, 99999)], store.rows(LEARNER, "italian", ["w99999", "missing"]))
+        self.assertLess(store.learners.stats()["bytes"], 2 * 1024 * 1024)
+
+    def test_learners_only_keep_the_words_they_have_seen(self):
+        store = WordScoreStore(lambda learner, language: [(f"w{i}", 50.0, i) for i in range(100000)]
+                               if learner == LEARNER else [("w99999", 80.0, 1)])
+        store.rows(LEARNER, "italian", [])
+        learner = make_learner(1)
+        self.assertEqual([("w99999", 80.0, 1)], store.rows(learner, "italian", ["w99999", "w5"]))
+        self.assertLess(store.learner_scores(learner, "italian").nbytes(), 100)
+
+        store.update(learner, "italian", [("w5", 55.0), ("w99999", 85.0)], 2)
+        self.assertEqual([("w5", 55.0, 2), ("w99999", 85.0, 2)], store.rows(learner, "italian", ["w5", "w99999"]))
+
+    def test_learners_are_measured_again_as_they_see_new_words(self):
+        store = WordScoreStore(lambda learner, language: [], max_bytes=16 * 100)
+        store.rows(LEARNER, "italian", [])
+        store.update(LEARNER, "italian", [(f"w{i}", 50.0) for i in range(50)], 1)
+        self.assertEqual(16 * 50, store.learners.stats()["bytes"])
+
+        learner = make_learner(1)
+        store.rows(learner, "italian", [])
+        store.update(learner, "italian", [(f"w{i}", 50.0) for i in range(60)], 1)
+        # The first learner made room
+        self.assertEqual(16 * 60, store.learners.stats()["bytes"])
+        self.assertIsNone(store.learners.get((LEARNER, "italian")))
+
+
+class SentenceSnapshotTests(SimpleTestCase):
+
+    def test_snapshot_sentences_are_merged_with_newer_ones(self):
+        with temporary_database(), tempfile.TemporaryDirectory() as directory:
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="I am happy", translations=["Sono felice", "Sono contenta"], topic="mood"),
+                languagebot.Sentence(english="I am tired", translations=["Sono stanco"], topic="mood"),
+                languagebot.Sentence(english="Coffee", translations=["Caffè"], topic="food"),
+            ])
+            path = os.path.join(directory, "sentences.snapshot")
+            call_command("export_snapshot", output=path, stdout=io.StringIO())
+
+            languagebot.sentence_snapshot = Snapshot(path)
+            try:
+                languagebot.store_sentences_in_db("italian", [
+                    languagebot.Sentence(english="I am hungry", translations=["Ho fame"], topic="mood"),
+                    # Merged into the sentence the snapshot has
+                    languagebot.Sentence(english="I am tired!", translations=["Sono stanca"], topic="mood")])
+                languagebot.topic_cache.clear()
+                languagebot.sentence_cache.clear()
+
+                self.assertEqual(languagebot.get_sentences_from_db("italian", "mood"),
+                                 languagebot.get_topic_sentences("italian", "mood"))
+                self.assertEqual([], languagebot.get_topic_sentences("french", "mood"))
+                languagebot.sentence_cache.clear()
+                self.assertEqual(["Sono stanca", "Sono stanco"],
+                                 languagebot.get_sentence("italian", "I am tired").translations)
+                self.assertEqual([["Sono", "stanca"], ["Sono", "stanco"]],
+                                 languagebot.get_sentence("italian", "I am tired").translation_words())
+                with count_calls(languagebot.get_sentence_from_db) as reads:
+                    sentence = languagebot.get_sentence("italian", "Coffee")
+                    self.assertEqual(["caffè"], [word.casefold() for word in sentence.translation_words()[0]])
+                    self.assertEqual("mood", languagebot.get_sentence("italian", "I am hungry").topic)
+                # Only for the translations stored since the export
+                self.assertEqual(2, reads.call_count)
+            finally:
+                languagebot.sentence_snapshot.close()
+
+    def test_compacting_exports_the_snapshot_again(self):
+        with temporary_database(), tempfile.TemporaryDirectory() as directory:
+            connection = languagebot.get_connection()
+            with transaction(connection):
+                connection.executemany("INSERT INTO sentences (id, language, english, topic) VALUES (?, ?, ?, ?)",
+                                       [(1, "italian", "I am sad", "mood"), (2, "italian", "I am happy", "mood"),
+                                        (3, "italian", "i am happy", "mood")])
+                connection.executemany("INSERT INTO translations (sentence_id, translation) VALUES (?, ?)",
+                                       [(1, "Sono triste"), (2, "Sono felice"), (3, "Sono contento")])
+            path = os.path.join(directory, "sentences.snapshot")
+            call_command("export_snapshot", output=path, stdout=io.StringIO())
+
+            call_command("compact_sentences", snapshot=path, stdout=io.StringIO())
+            # Stored under the id of the sentence that was merged away
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="I am hungry", translations=["Ho fame"], topic="mood")])
+
+            languagebot.sentence_snapshot = Snapshot(path)
+            try:
+                languagebot.topic_cache.clear()
+                self.assertEqual(languagebot.get_sentences_from_db("italian", "mood"),
+                                 languagebot.get_topic_sentences("italian", "mood"))
+            finally:
+                languagebot.sentence_snapshot.close()
+
+
+class DeduplicationTests(SimpleTestCase):
+    databases = {"default"}
+
+    def test_sentences_differing_in_case_and_punctuation_are_merged(self):
+        with temporary_database():
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="I want you to go.", translations=["Voglio che tu vada."], topic="plans")])
+            result = languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="i want you to go", translations=["voglio che tu vada", "Voglio che vada"],
+                                     topic="plans"),
+                languagebot.Sentence(english="Could you please tell me how far the station is from the hotel we are "
+                                             "staying at?",
+                                     translations=["Mi può dire quanto dista la stazione dal nostro albergo?"],
+                                     topic="plans"),
+                languagebot.Sentence(english="Could you tell me how far the station is from the hotel we are staying at?",
+                                     translations=["Mi dici quanto dista la stazione dal nostro albergo?"],
+                                     topic="plans"),
+                # Sharing most words doesn't make a short sentence the same prompt
+                languagebot.Sentence(english="I want you to go now", translations=["Voglio che tu vada ora"],
+                                     topic="plans"),
+            ])
+
+            self.assertEqual((3, 2), result[:2])
+            sentences = languagebot.get_sentences_from_db("italian", "plans")
+            self.assertEqual(["Could you please tell me how far the station is from the hotel we are staying at?",
+                              "I want you to go now", "I want you to go."],
+                             [sentence.english for sentence in sentences])
+            # Translations that differ in a word are variants the learner can give, so both are kept
+            self.assertEqual(["Voglio che tu vada.", "Voglio che vada"], sentences[2].translations)
+
+    def test_existing_duplicates_are_compacted(self):
+        with temporary_database() as db_path:
+            connection = sqlite3.connect(db_path)
+            connection.executemany("INSERT INTO sentences (id, language, english, topic) VALUES (?, ?, ?, ?)",
+                                   [(1, "italian", "I am happy.", "mood"), (2, "italian", "i am happy", "mood"),
+                                    (3, "italian", "I am sad", "mood")])
+            connection.executemany("INSERT INTO translations (sentence_id, translation) VALUES (?, ?)",
+                                   [(1, "Sono felice."), (2, "sono felice"), (2, "Sono contento"), (3, "Sono triste")])
+            connection.commit()
+            connection.close()
+
+            call_command("compact_sentences", dry_run=True, stdout=io.StringIO())
+            self.assertEqual(3, len(languagebot.get_sentences_from_db("italian", "mood")))
+
+            call_command("compact_sentences", snapshot=None, stdout=io.StringIO())
+            sentences = languagebot.get_sentences_from_db("italian", "mood")
+            self.assertEqual(["I am happy.", "I am sad"], [sentence.english for sentence in sentences])
+            self.assertEqual(["Sono contento", "Sono felice."], sentences[0].translations)
+
+            # Ingestion finds the compacted sentences
+            self.assertEqual((0, 1), languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="I am SAD!", translations=["Sono triste!"], topic="mood")])[:2])
+
+    def test_trusted_rows_are_stored_as_they_are_until_compacted(self):
+        with temporary_database():
+            rows = [("italian", "I am happy.", "Sono felice.", "mood"), ("italian", "i am happy", "sono felice", "mood")]
+            self.assertEqual((2, 0), languagebot.store_sentence_rows(rows, deduplicate=False)[:2])
+            self.assertEqual(2, len(languagebot.get_sentences_from_db("italian", "mood")))
+
+            call_command("compact_sentences", snapshot=None, stdout=io.StringIO())
+            self.assertEqual(["I am happy."], [sentence.english for sentence in
+                                               languagebot.get_sentences_from_db("italian", "mood")])
+            self.assertEqual((0, 1), languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="I am happy!", translations=["Sono felice!"], topic="mood")])[:2])
+
+    def test_fingerprints_are_the_same_in_batches(self):
+        texts = ["I want you to go.", "Is he here?", "", "Could you tell me how far the station is?"]
+        self.assertEqual({text: dedup.fingerprint(text) for text in texts}, dedup.fingerprints(texts))
+
+    def test_new_topic_is_served_its_merged_sentences(self):
+        def respond(messages):
+            return languagebot.Sentences(sentences=[
+                languagebot.Sentence(english=english, translations=["Voglio che tu vada"], topic="leaving")
+                for english in ["I want you to go!", "i want you to go."]])
+
+        fake_client = FakeAsyncOpenAI(respond=respond)
+        with (temporary_database(), mock.patch.object(languagebot, "async_client", fake_client),
+              mock.patch.object(pregeneration.queue, "refill_if_low")):
+            languagebot.store_sentences_in_db("italian", [
+                languagebot.Sentence(english="I want you to go", translations=["Voglio che tu vada"], topic="plans")])
+
+            english = post_json(self.client, "/getsentence",
+                                {"language": "italian", "topic": "leaving"}).json()["english"]
+            self.assertEqual("I want you to go!", english)
+            self.assertEqual([english], [sentence.english for sentence in
+                                         languagebot.get_sentences_from_db("italian", "leaving")])
+            self.assertEqual(200, post_json(self.client, "/submitsentence",
+                                            {"language": "italian", "english": english,
+                                             "submission": "Voglio che tu vada"}).status_code)
@@ -1,7 +1,7 @@
 from django.urls import path
 from django.shortcuts import render
 
-from server.views import GetSentenceView, SubmitSentenceView
+from server.views import GetSentenceView, SubmitSentenceView, MetricsView
 
 
 # A simple view function to return a response
@@ -18,4 +18,5 @@ urlpatterns = [
     path('test', test),
     path('getsentence', GetSentenceView.as_view(), name="Get sentence"),
     path('submitsentence', SubmitSentenceView.as_view(), name="Submit sentence"),
+    path('metrics', MetricsView.as_view(), name="Metrics"),
 ]
@@ -1,72 +1,91 @@
+import asyncio
 import json
+import logging
+import time
 
+from asgiref.sync import sync_to_async
 from django.http import JsonResponse, HttpResponseBadRequest
 from django.views import View
 
-from server.languagebot import (get_sentence_from_db, get_sentences_from_db, calculate_sentence_scores,
-                                get_sentences_from_llm, store_sentences_in_db, find_matches_with_positions,
-                                update_word_scores, find_best_translation)
+from server import instrumentation, pregeneration
+from server.instrumentation import timed
+from server.languagebot import (Sentence, get_sentence, get_topic_sentences,
+                                find_matches_with_positions, update_word_scores, find_best_translation,
+                                topic_cache, sentence_cache, word_score_buffer, word_score_store, llm_cache)
+from server.selection import selector
+
+logger = logging.getLogger(__name__)
 
 TARGET_SCORE = 65
+# Most upcoming sentences /submitsentence returns
+MAX_PREFETCH = 5
+# Longest /getsentence waits for a brand new topic before telling the client to try again
+COLD_TOPIC_TIMEOUT = 10
+
+
+def get_learner(request):
+    # Word scores are kept for each learner, which is the signed in user or otherwise their browser session
+    if request.user.is_authenticated:
+        return f"user:{request.user.pk}"
+    if request.session.session_key is None:
+        request.session.create()
+    return f"session:{request.session.session_key}"
+
+
+def select_sentences(learner, language, topic, sentences, count, shown=True) -> list[Sentence]:
+    # Pick the sentences scoring closest to the target that the learner hasn't just been shown. Unless shown is
+    # set they're only counted as shown once they're submitted.
+    index = selector.index(learner, language, topic, sentences)
+    selected = index.select_many(TARGET_SCORE, time.time(), count, shown)
+
+    logger.debug("Best sentences %s", selected)
+
+    # If we're running out of sentences near the target score then generate some more in the background
+    pregeneration.queue.refill_if_low(language, topic, index.near(TARGET_SCORE, pregeneration.NEAR_TARGET),
+                                      TARGET_SCORE)
+
+    return [sentence for sentence, _ in selected]
 
 
 class GetSentenceView(View):
 
     # Get a sentence with the given topic
-    def post(self, request):
+    async def post(self, request):
         body = json.loads(request.body)
 
         language = body["language"]
         topic = body["topic"].lower().strip()
+        learner = await sync_to_async(get_learner)(request)
 
-        print(f"Request for sentence with language {language}, topic {topic}")
+        logger.debug("Request for sentence with language %s, topic %s", language, topic)
 
-        # Either try to get the best sentence from the db or load more from chatgpt
+        # Either try to get the best sentence from the db or wait a bounded time for the LLM to generate some
 
-        sentences = get_sentences_from_db(language, topic)
+        sentences = await sync_to_async(get_topic_sentences)(language, topic)
 
-        print("Sentences from db", sentences)
+        logger.debug("Sentences from db: %d", len(sentences))
 
         if not sentences:
-            print("No sentences available in the database for topic. Getting sentences from LLM...")
-            sentences = get_sentences_from_llm(language, topic)
-            print("Sentences from llm", sentences)
-
-            store_sentences_in_db(language, sentences)
-
-        sentences_with_scores = calculate_sentence_scores(language, sentences)
-
-        print("Sentence scores ", sentences_with_scores)
-
-        # def sort_to_target_score(s):
-        #     print("Sorting ", s, "Value:", abs(s[1] - TARGET_SCORE))
-        #     return TARGET_SCORE - s[1]
-
-        # Find the sentence with the best scores
-        sorted_sentences = sorted(sentences_with_scores, key=lambda s: abs(TARGET_SCORE - s[1]))
-
-        print("Sorted sentences", sorted_sentences)
-
-        best_sentence = sorted_sentences[0][0]
-
-        # if the best sentence score is too far from the target then request some more
-        # if abs(sorted_sentences[0][1] - TARGET_SCORE) > 20:
-        #     print("Target score is more than 20 away. Getting some new sentences from LLM")
-        #     sentences = get_sentences_from_llm(language, topic)
-        #     print("Sentences from llm", sentences)
-        #
-        #     store_sentences_in_db(language, sentences)
-        #
-        #     sentences_with_scores = calculate_sentence_scores(language, sentences)
-        #
-        #     print("Sentence scores ", sentences_with_scores)
-        #
-        #     # Find the sentence with the best scores
-        #     sorted_sentences = sorted(sentences_with_scores, key=lambda s: abs(TARGET_SCORE - s[1]))
-        #
-        #     print("Sorted sentences", sorted_sentences)
-        #
-        #     best_sentence = sorted_sentences[0][0]
+            logger.info("No sentences available in the database for %s %s. Getting sentences from LLM...",
+                        language, topic)
+            # The rest of the sentences keep arriving in the background after the first
+            generated = pregeneration.queue.submit_first(language, topic)
+            try:
+                with timed("llm_wait"):
+                    sentences = await asyncio.wait_for(asyncio.wrap_future(generated), COLD_TOPIC_TIMEOUT)
+            except asyncio.TimeoutError:
+                sentences = None
+            except Exception as e:
+                # Already logged by the pregeneration worker
+                logger.warning("Can't serve %s %s as generating its sentences failed: %s", language, topic, e)
+                return JsonResponse({"error": "Couldn't generate sentences for this topic, please try again"},
+                                    status=502)
+            if not sentences:
+                # Still generating. The client should ask again shortly.
+                return JsonResponse({"pending": True}, status=202)
+            logger.debug("Sentences from llm: %d", len(sentences))
+
+        best_sentence = (await sync_to_async(select_sentences)(learner, language, topic, sentences, 1))[0]
 
         return JsonResponse({"english": best_sentence.english}, status=200)
 
@@ -74,30 +93,64 @@ class GetSentenceView(View):
 class SubmitSentenceView(View):
 
     # Submit a sentence with the given topic
-    def post(self, request):
+    async def post(self, request):
         body = json.loads(request.body)
 
         language = body["language"]
         english = body["english"]
         submission = body["submission"]
-        sentence = get_sentence_from_db(language, english)
+        try:
+            prefetch = min(int(body.get("prefetch", 0)), MAX_PREFETCH)
+        except (TypeError, ValueError):
+            return HttpResponseBadRequest("Invalid prefetch")
+        learner = await sync_to_async(get_learner)(request)
+        sentence = await sync_to_async(get_sentence)(language, english)
 
         if sentence is None:
-            print("Error can't find sentence with English " + english + " in the database.")
+            logger.warning("Can't find sentence with English %r in the database", english)
             return HttpResponseBadRequest("Invalid english sentence")
 
-        print("Language", language, "Submitted", submission, "sentence", sentence)
+        logger.debug("Language %s submitted %s for sentence %s", language, submission, sentence)
 
         # Check if any translations are an exact match
         translation = find_best_translation(sentence, submission)
 
         # Compare the pre-calculated translation and the submission
         original_word_matches, entered_word_matches, correct = \
-            find_matches_with_positions(translation, submission)
+            find_matches_with_positions(translation, submission, sentence.words_of(translation),
+                                        sentence.folded_words_of(translation))
 
         # Update our word scores
-        update_word_scores(language, translation, original_word_matches)
-
-        return JsonResponse({"original_word_matches": original_word_matches,
-                             "entered_word_matches": entered_word_matches, "correct": correct,
-                             "translation": translation}, status=200)
+        await sync_to_async(update_word_scores)(learner, language, translation, original_word_matches)
+        selector.words_changed(learner, language, [match[0] for match in original_word_matches])
+
+        result = {"original_word_matches": original_word_matches, "entered_word_matches": entered_word_matches,
+                  "correct": correct, "translation": translation}
+
+        # A prefetched sentence is only counted as shown now, as the client may never have shown it
+        topic = body.get("topic")
+        topic = topic.lower().strip() if isinstance(topic, str) and topic.strip() else sentence.topic
+        selector.shown(learner, language, topic, sentence.english)
+
+        # Save the client asking for the next sentence separately by choosing it now from the updated scores
+        if prefetch > 0:
+            sentences = await sync_to_async(get_topic_sentences)(language, topic)
+            if sentences:
+                result["next"] = [next_sentence.english for next_sentence in
+                                  await sync_to_async(select_sentences)(learner, language, topic, sentences, prefetch,
+                                                                        shown=False)]
+
+        return JsonResponse(result, status=200)
+
+
+class MetricsView(View):
+
+    def get(self, request):
+        return JsonResponse({"pregeneration": pregeneration.queue.metrics(),
+                             "topic_cache": topic_cache.stats(),
+                             "sentence_cache": sentence_cache.stats(),
+                             "word_score_buffer": word_score_buffer.metrics(),
+                             "word_score_store": word_score_store.stats(),
+                             "selection": selector.indexes.stats(),
+                             "llm_cache": llm_cache.stats(),
+                             "requests": instrumentation.metrics.snapshot()}, status=200)
@@ -0,0 +1,122 @@
+import bisect
+import threading
+from array import array
+
+from server.cache import LRUCache
+
+
+class Vocabulary:
+    # Interns the words of a language to small integer ids, shared by all its learners
+
+    def __init__(self):
+        self.ids = {}
+        self._lock = threading.Lock()
+
+    def intern(self, word) -> int:
+        word_id = self.ids.get(word)
+        if word_id is None:
+            with self._lock:
+                word_id = self.ids.setdefault(word, len(self.ids))
+        return word_id
+
+
+class LearnerScores:
+    # One learner's scores and last seen epochs for a language. Only the words the learner has seen are kept,
+    # in arrays ordered by word id, so a learner takes 16 bytes per word they've seen however large the
+    # language's vocabulary gets.
+
+    __slots__ = ("word_ids", "scores", "last_seen")
+
+    def __init__(self, entries=()):
+        # entries are (word id, score, last_seen) for distinct words
+        entries = sorted(entries)
+        self.word_ids = array("I", [word_id for word_id, _, _ in entries])
+        self.scores = array("d", [score for _, score, _ in entries])
+        self.last_seen = array("I", [last_seen for _, _, last_seen in entries])
+
+    def get(self, word_id):
+        # The (score, last_seen) of the word, or None if the learner hasn't seen it
+        i = bisect.bisect_left(self.word_ids, word_id)
+        if i < len(self.word_ids) and self.word_ids[i] == word_id:
+            return self.scores[i], self.last_seen[i]
+        return None
+
+    def set(self, word_id, score, last_seen):
+        i = bisect.bisect_left(self.word_ids, word_id)
+        if i < len(self.word_ids) and self.word_ids[i] == word_id:
+            self.scores[i] = score
+            self.last_seen[i] = last_seen
+        else:
+            self.word_ids.insert(i, word_id)
+            self.scores.insert(i, score)
+            self.last_seen.insert(i, last_seen)
+
+    def nbytes(self):
+        return sum(len(values) * values.itemsize for values in (self.word_ids, self.scores, self.last_seen))
+
+
+class WordScoreStore:
+    # Keeps the word scores of recently active learners in memory so that reading them never touches the
+    # database. A learner's scores are loaded in one go the first time they're needed and then kept up to date
+    # by update().
+
+    def __init__(self, load, max_learners=10000, max_bytes=256 * 1024 * 1024):
+        # load takes a learner and language and returns all their (word, score, last_seen) rows
+        self.load = load
+        self.vocabularies = {}
+        self.learners = LRUCache(max_entries=max_learners, max_bytes=max_bytes, sizeof=LearnerScores.nbytes)
+        self._lock = threading.Lock()
+
+    def vocabulary(self, language) -> Vocabulary:
+        vocabulary = self.vocabularies.get(language)
+        if vocabulary is None:
+            with self._lock:
+                vocabulary = self.vocabularies.setdefault(language, Vocabulary())
+        return vocabulary
+
+    def learner_scores(self, learner, language) -> LearnerScores:
+        key = (learner, language)
+        scores = self.learners.get(key)
+        if scores is None:
+            version = self.learners.version
+            vocabulary = self.vocabulary(language)
+            scores = LearnerScores((vocabulary.intern(word), score, last_seen)
+                                   for word, score, last_seen in self.load(learner, language))
+            # Not kept if an update came in while we were loading, as we may have missed it
+            self.learners.put(key, scores, version)
+        return scores
+
+    def rows(self, learner, language, words):
+        # The (word, score, last_seen) rows of the words the learner has seen, like the database returns
+        scores = self.learner_scores(learner, language)
+        ids = self.vocabulary(language).ids
+        rows = []
+        for word in words:
+            word_id = ids.get(word)
+            seen = scores.get(word_id) if word_id is not None else None
+            if seen is not None:
+                rows.append((word, *seen))
+        return rows
+
+    def update(self, learner, language, word_scores, last_seen):
+        key = (learner, language)
+        scores = self.learners.get(key)
+        if scores is None:
+            # Make sure a load that's under way doesn't keep scores from before this update
+            self.learners.pop(key)
+            return
+        vocabulary = self.vocabulary(language)
+        for word, score in word_scores:
+            scores.set(vocabulary.intern(word), score, last_seen)
+        # The learner's arrays grow with the new words they've seen
+        self.learners.resize(key)
+
+    def clear(self):
+        self.learners.clear()
+        with self._lock:
+            self.vocabularies = {}
+
+    def stats(self):
+        stats = self.learners.stats()
+        stats["words"] = {language: len(vocabulary.ids) for language, vocabulary in self.vocabularies.items()}
+        return stats
@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Write pending word scores at least this often
+FLUSH_INTERVAL = 2.0
+# or as soon as this many are waiting
+MAX_PENDING = 5000
+# After a failed flush, e.g. while another process holds SQLite's write lock, wait twice as long each time up
+# to this long before trying again
+MAX_BACKOFF = 60.0
+
+
+class WordScoreBuffer:
+    # Collects word score updates in memory and writes them to the database in batches, so submissions don't
+    # each have to wait for SQLite's write lock. Reads see the pending scores straight away. Repeated updates
+    # to the same word are merged and only the latest score is written.
+
+    def __init__(self, write, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        # write takes a list of (learner, language, word, score, last_seen) rows and stores them in one go
+        self.write = write
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # Held while a submission reads the current scores and adds the new ones
+        self.lock = threading.RLock()
+        self._pending = {}
+        self._flushing = {}
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.consecutive_failures = 0
+        self.flushed_entries = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    def add(self, learner, language, word_scores, last_seen):
+        with self.lock:
+            for word, score in word_scores:
+                self._pending[(learner, language, word)] = (score, last_seen)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="word-score-flush", daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.max_pending:
+                self._wake.set()
+
+    def overlay(self, learner, language, words, word_scores):
+        # Replace the (word, score, last_seen) rows read from the database with any newer scores
+        with self.lock:
+            if not self._pending and not self._flushing:
+                return word_scores
+
+            merged = {word: (score, last_seen) for word, score, last_seen in word_scores}
+            for word in words:
+                key = (learner, language, word)
+                pending = self._pending.get(key) or self._flushing.get(key)
+                if pending is not None:
+                    merged[word] = pending
+            return [(word, score, last_seen) for word, (score, last_seen) in merged.items()]
+
+    def overlay_learner(self, learner, language, word_scores):
+        # Like overlay but for all of a learner's words
+        with self.lock:
+            if not self._pending and not self._flushing:
+                return word_scores
+
+            merged = {word: (score, last_seen) for word, score, last_seen in word_scores}
+            for entries in [self._flushing, self._pending]:
+                for (entry_learner, entry_language, word), value in entries.items():
+                    if entry_learner == learner and entry_language == language:
+                        merged[word] = value
+            return [(word, score, last_seen) for word, (score, last_seen) in merged.items()]
+
+    def flush(self):
+        with self._flush_lock:
+            with self.lock:
+                # Keep the entries visible to reads until they're in the database
+                self._flushing, self._pending = self._pending, {}
+                batch = self._flushing
+            if not batch:
+                return
+
+            start = time.perf_counter()
+            try:
+                self.write([key + value for key, value in batch.items()])
+            except Exception as e:
+                self.failed_flushes += 1
+                self.consecutive_failures += 1
+                logger.warning("Failed to write %d word scores, retrying in %.0f seconds: %s", len(batch),
+                               self.retry_interval(), e)
+                with self.lock:
+                    # Try again next time, unless there's a newer score for the word by then
+                    self._pending = {**batch, **self._pending}
+                    self._flushing = {}
+                return
+
+            with self.lock:
+                self._flushing = {}
+            self.consecutive_failures = 0
+
+            elapsed = time.perf_counter() - start
+            self.flushes += 1
+            self.flushed_entries += len(batch)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+
+    def clear(self):
+        with self.lock:
+            self._pending = {}
+
+    def stop(self):
+        # Write everything that's still pending, e.g. at shutdown
+        with self.lock:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+        if thread is not None:
+            self._wake.set()
+            thread.join()
+        self._stopping = False
+        self.flush()
+
+    def retry_interval(self):
+        return min(self.flush_interval * 2 ** self.consecutive_failures, MAX_BACKOFF)
+
+    def _run(self):
+        while not self._stopping:
+            self._wait()
+            self.flush()
+
+    def _wait(self):
+        if not self.consecutive_failures:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            return
+        # Being woken for a full buffer doesn't cut a back off short, only stopping does
+        deadline = time.monotonic() + self.retry_interval()
+        while not self._stopping and time.monotonic() < deadline:
+            self._wake.wait(max(0.0, deadline - time.monotonic()))
+            self._wake.clear()
+
+    def metrics(self):
+        with self.lock:
+            pending = len(self._pending)
+            flushing = len(self._flushing)
+        return {
+            "pending": pending,
+            "flushing": flushing,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "consecutive_failures": self.consecutive_failures,
+            "flushed_entries": self.flushed_entries,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+        }
@@ -1,6 +1,10 @@
 var topic = undefined;
 var english = undefined;
 var language = undefined;
+// Sentences the server picked for us after the last submission, in the order to show them
+var upcoming = [];
+// How many upcoming sentences to ask for with each submission
+const PREFETCH = 2;
 
 function addBotText(text) {
     const chatDiv = document.getElementById("chat");
@@ -16,7 +20,6 @@ function addHumanText(text) {
 
 // Function to send the POST request with the content of the text field
 function getSentence(topic) {
-    const textField = document.getElementById("textfield")
     const statusField = document.getElementById('status');
 
     // Get the CSRF token from the meta tag
@@ -41,9 +44,12 @@ function getSentence(topic) {
     })
     .then(data => {
         console.log('Server response:', data);
-        english = data.english;
-        addBotText("Translate the following:\n" + data.english)
-        textField.value = "";
+        if (data.pending) {
+            // The server is still generating sentences for this topic so ask again shortly
+            setTimeout(() => getSentence(topic), 2000);
+            return;
+        }
+        showSentence(data.english);
     })
     .catch(error => {
         console.error('Error during POST request:', error);
@@ -51,6 +57,25 @@ function getSentence(topic) {
     });
 }
 
+function showSentence(sentence) {
+    english = sentence;
+    addBotText("Translate the following:\n" + sentence)
+    document.getElementById("textfield").value = "";
+}
+
+// Show the next sentence the server sent with the submission result, or one prefetched earlier, and only ask
+// for one if there aren't any
+function nextSentence(next) {
+    if (next && next.length > 0) {
+        upcoming = next.slice(1);
+        showSentence(next[0]);
+    } else if (upcoming.length > 0) {
+        showSentence(upcoming.shift());
+    } else {
+        getSentence(topic);
+    }
+}
+
 function getFormattedString(matches, str) {
     var formattedString = "";
     var lastIdx = 0;
@@ -83,7 +108,7 @@ function submitSentence(entry) {
             'Content-Type': 'application/json',
             'X-CSRFToken': csrftoken,
         },
-        body: JSON.stringify({ language: language, english: english, submission: entry }),
+        body: JSON.stringify({ language: language, english: english, submission: entry, topic: topic, prefetch: PREFETCH }),
     })
     .then(response => {
         if (response.ok) {
@@ -99,12 +124,12 @@ function submitSentence(entry) {
         if (data.correct) {
             addHumanText(entry);
             addBotText("<span class=\"c\">Correct!</span>")
-            getSentence(topic); // Get the next sentence for the topic
+            nextSentence(data.next);
         } else {
             var formattedEntry = getFormattedString(data.entered_word_matches, entry)
             addHumanText(formattedEntry);
             addBotText("Incorrect. The correct translation is: <br>" + data.translation)
-            getSentence(topic); // Get the next sentence for the topic
+            nextSentence(data.next);
         }
     })
     .catch(error => {